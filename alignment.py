@@ -0,0 +1,443 @@
+import codecs
+import os
+import re
+import tempfile
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from convert import Record, nexus_rows, nexus_sequence
+from formats import NEXUS, PHYLIP, PHYLIP_NAME_WIDTH, phylip_layout, split_phylip_name
+from instrument import timed
+from stats import line_bounds
+from workers import chunk_source, line_chunks, read_source
+
+GAP = ord("-")
+MISSING = ord("?")
+# Matrices larger than this are kept in a temporary file rather than in memory
+MEMORY_LIMIT = 1 << 30
+# Bytes of the matrix compared at a time by one worker
+BLOCK_BYTES = 1 << 22
+# Taxa counted at a time, so that the counts of a column fit 16 bits
+ROW_GROUP = (1 << 16) - 1
+
+_WHITESPACE = b" \t\r\n"
+_SPACE = np.zeros(256, dtype=bool)
+_SPACE[list(_WHITESPACE)] = True
+_QUOTED_NAME = re.compile(rb"'(?:[^']|'')*'")
+
+# Where the matrix of an alignment document is, see matrix_lines
+MatrixLines = namedtuple("MatrixLines", ["taxa", "names", "nchar", "ntax", "interleaved", "header", "split"])
+
+
+def _allocate(ntax, nchar):
+    if ntax * nchar > MEMORY_LIMIT:
+        return np.memmap(tempfile.TemporaryFile(), dtype=np.uint8, mode="w+", shape=(ntax, nchar))
+    return np.empty((ntax, nchar), dtype=np.uint8)
+
+
+class LineMap:
+    """
+    Where the sites of an alignment are in its document: for every matrix
+    line its taxon, the first site on it, the column the sequence starts at
+    (-1 if unknown) and the number of sites, sorted by line.
+    """
+
+    def __init__(self, lines, taxa, sites, columns, counts):
+        order = np.argsort(np.frombuffer(lines, dtype=np.int64), kind="stable")
+        self.lines = np.frombuffer(lines, dtype=np.int64)[order]
+        self.taxa = np.frombuffer(taxa, dtype=np.int64)[order]
+        self.sites = np.frombuffer(sites, dtype=np.int64)[order]
+        self.columns = np.frombuffer(columns, dtype=np.int64)[order]
+        self.counts = np.frombuffer(counts, dtype=np.int64)[order]
+
+    def on_lines(self, start, stop):
+        """Positions [first, last) of the matrix lines among lines [start, stop)."""
+        return np.searchsorted(self.lines, start), np.searchsorted(self.lines, stop)
+
+
+class Alignment:
+    """
+    The matrix of a NEXUS or PHYLIP alignment as a taxa × sites array of
+    residue bytes, rows shorter than the others padded with gaps.
+
+    Column operations work on blocks of columns spread over worker threads,
+    comparing a block against one symbol at a time, so they run at memory
+    speed whatever the number of taxa. Residues are counted without regard
+    to case.
+    """
+
+    def __init__(self, names, matrix, lines=None):
+        self.names = names
+        self.matrix = matrix
+        # LineMap of the document the alignment was read from
+        self.lines = lines
+        self._present = None
+        self._variable = None
+
+    @property
+    def ntax(self):
+        return self.matrix.shape[0]
+
+    @property
+    def nchar(self):
+        return self.matrix.shape[1]
+
+    def row(self, taxon):
+        return self.matrix[taxon].tobytes().decode("ascii")
+
+    def records(self):
+        for taxon, name in enumerate(self.names):
+            yield Record(name, self.row(taxon), None)
+
+    @property
+    def present(self):
+        """Which of the 256 byte values occur in the matrix."""
+        if self._present is None:
+            counts = np.zeros(256, dtype=np.int64)
+            rows = max(1, BLOCK_BYTES // max(self.nchar, 1))
+            for start in range(0, self.ntax, rows):
+                counts += np.bincount(self.matrix[start:start + rows].reshape(-1), minlength=256)
+            self._present = counts > 0
+        return self._present
+
+    def _symbols(self, residues_only=False):
+        """Groups of the bytes present that count as one symbol, an upper case letter with its lower case."""
+        groups = {}
+        for value in np.flatnonzero(self.present):
+            if residues_only and value in (GAP, MISSING):
+                continue
+            groups.setdefault(ord(chr(value).upper()), []).append(int(value))
+        return list(groups.items())
+
+    def _count_block(self, variants, start, stop):
+        counts = np.zeros((len(variants), stop - start), dtype=np.int64)
+        if not self.ntax:
+            return counts
+        equal = np.empty((min(self.ntax, ROW_GROUP), stop - start), dtype=bool)
+        for first in range(0, self.ntax, ROW_GROUP):
+            block = self.matrix[first:first + ROW_GROUP, start:stop]
+            out = equal[:len(block)]
+            for i, values in enumerate(variants):
+                for value in values:
+                    np.equal(block, value, out=out)
+                    counts[i] += np.add.reduce(out.view(np.uint8), axis=0, dtype=np.uint16)
+        return counts
+
+    @timed("alignment.counts", lambda self, variants, start=0, stop=None: {"symbols": len(variants)})
+    def count(self, variants, start=0, stop=None):
+        """
+        Number of taxa with each symbol in every column of [start, stop), as
+        a symbols × columns array. variants holds the byte values of every
+        symbol.
+        """
+        stop = self.nchar if stop is None else stop
+        width = max(1, BLOCK_BYTES // max(min(self.ntax, ROW_GROUP), 1))
+        bounds = [(a, min(a + width, stop)) for a in range(start, stop, width)]
+        with ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as pool:
+            blocks = list(pool.map(lambda bound: self._count_block(variants, *bound), bounds))
+        if not blocks:
+            return np.zeros((len(variants), 0), dtype=np.int64)
+        return np.concatenate(blocks, axis=1)
+
+    def column_counts(self, start=0, stop=None):
+        """The symbols of the alignment as bytes and the count of each in every column."""
+        symbols = self._symbols()
+        counts = self.count([values for _, values in symbols], start, stop)
+        return bytes(symbol for symbol, _ in symbols), counts
+
+    def gap_fraction(self, start=0, stop=None):
+        return self.count([[GAP]], start, stop)[0] / max(self.ntax, 1)
+
+    def missing_fraction(self, start=0, stop=None):
+        return self.count([[MISSING]], start, stop)[0] / max(self.ntax, 1)
+
+    def gap_only(self):
+        """Columns with nothing but gaps."""
+        return self.count([[GAP]])[0] == self.ntax
+
+    def consensus(self):
+        """The most frequent residue of every column, a gap where there is none."""
+        symbols = self._symbols(residues_only=True)
+        counts = self.count([values for _, values in symbols])
+        if not symbols:
+            return "-" * self.nchar
+        row = np.frombuffer(bytes(symbol for symbol, _ in symbols), dtype=np.uint8)[counts.argmax(axis=0)]
+        row[counts.max(axis=0) == 0] = GAP
+        return row.tobytes().decode("ascii")
+
+    def variable_sites(self):
+        """Columns with more than one residue, gaps and missing data aside."""
+        if self._variable is None:
+            symbols = self._symbols(residues_only=True)
+            counts = self.count([values for _, values in symbols])
+            self._variable = np.count_nonzero(counts, axis=0) > 1
+        return self._variable
+
+    def keep(self, columns):
+        """A new alignment of the given columns, a boolean mask or indices."""
+        columns = np.flatnonzero(columns) if columns.dtype == bool else columns
+        matrix = _allocate(self.ntax, len(columns))
+        width = max(1, BLOCK_BYTES // max(self.ntax, 1))
+        for start in range(0, len(columns), width):
+            matrix[:, start:start + width] = self.matrix[:, columns[start:start + width]]
+        return Alignment(self.names, matrix)
+
+    def strip_gap_only(self):
+        return self.keep(~self.gap_only())
+
+    def extract(self, start, stop):
+        """Sites [start, stop) as a new alignment sharing this one's matrix."""
+        return Alignment(self.names, self.matrix[:, start:stop])
+
+
+def matrix_lines(document, file_format):
+    """
+    MatrixLines of a NEXUS or PHYLIP document: the lines of every taxon as
+    [(line, starts with the name)], the taxon names where the format gives
+    them up front, the numbers of sites and taxa declared, whether the matrix
+    is interleaved, the line declaring its dimensions and a function
+    splitting a line into its name and its sequence part.
+    """
+    if file_format == PHYLIP:
+        layout = phylip_layout(document)
+        if not layout.valid:
+            raise ValueError(layout.error)
+        if layout.interleaved:
+            taxa = [[(layout.taxon_line(taxon, block), block == 0) for block in range(len(layout.block_starts))]
+                    for taxon in range(layout.num_species)]
+        else:
+            ends = layout.taxon_lines[1:] + [len(document)]
+            taxa = [[(line, line == start) for line in range(start, stop)]
+                    for start, stop in zip(layout.taxon_lines, ends)]
+        split = lambda line, named: split_phylip_name(line, layout.strict) if named else (None, line)
+        return MatrixLines(taxa, None, layout.seq_length, layout.num_species, layout.interleaved,
+                           layout.header_line, split)
+    if file_format == NEXUS:
+        matrix = nexus_rows(document)
+        taxa = [[(n if n >= 0 else -n - 1, n >= 0) for n in matrix.rows[name]] for name in matrix.names]
+        return MatrixLines(taxa, matrix.names, matrix.nchar, matrix.ntax, matrix.interleaved, matrix.dimensions,
+                           lambda line, named: (None, nexus_sequence(line, named)))
+    raise ValueError("Only NEXUS and PHYLIP files are alignments")
+
+
+def _sequence_bytes(text):
+    return text.encode("ascii", errors="replace").translate(None, _WHITESPACE)
+
+
+def _line_arrays(document, file_format):
+    """
+    The matrix lines of a NEXUS or PHYLIP document in file order as arrays
+    of their line, their taxon and whether they start with the name, with
+    the number of taxa, their names where the format gives them up front
+    and the number of sites declared.
+    """
+    if file_format == PHYLIP:
+        layout = phylip_layout(document)
+        if not layout.valid:
+            raise ValueError(layout.error)
+        ntax = layout.num_species
+        if layout.interleaved:
+            blocks = np.array(layout.block_starts, dtype=np.int64)
+            lines = (blocks[:, None] + np.arange(ntax)).reshape(-1)
+            taxa = np.tile(np.arange(ntax), len(blocks))
+            named = np.arange(len(lines)) < ntax
+        else:
+            starts = np.array(layout.taxon_lines, dtype=np.int64)
+            lines = np.arange(starts[0], len(document))
+            taxa = np.searchsorted(starts, lines, side="right") - 1
+            named = lines == starts[taxa]
+        return lines, taxa, named, ntax, None, layout.seq_length
+    if file_format == NEXUS:
+        matrix = nexus_rows(document)
+        rows = [np.frombuffer(matrix.rows[name], dtype=np.int64) for name in matrix.names]
+        numbers = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64)
+        taxa = np.repeat(np.arange(len(rows)), [len(row) for row in rows])
+        named = numbers >= 0
+        lines = np.where(named, numbers, -numbers - 1)
+        order = np.argsort(lines, kind="stable")
+        return lines[order], taxa[order], named[order], len(rows), list(matrix.names), matrix.nchar
+    raise ValueError("Only NEXUS and PHYLIP files are alignments")
+
+
+def _positions(begin, end):
+    """Every position inside the given spans, which are short such as names and comments."""
+    lengths = end - begin
+    return np.arange(int(lengths.sum())) + np.repeat(begin - (np.cumsum(lengths) - lengths), lengths)
+
+
+def _count(positions, begin, end):
+    """Number of the sorted positions inside every span [begin, end)."""
+    return np.searchsorted(positions, end) - np.searchsorted(positions, begin)
+
+
+def _first(flags, begin, end):
+    """Position of the first set flag in every span [begin, end), end where there is none."""
+    found = end.copy()
+    todo = np.flatnonzero(begin < end)
+    start = begin[todo]
+    # Mostly the flag is on the first position or close to it
+    width = 1
+    while len(todo):
+        positions = start[:, None] + np.arange(width)
+        inside = positions < end[todo, None]
+        hits = flags[np.minimum(positions, len(flags) - 1)] & inside
+        hit = hits.any(axis=1)
+        found[todo[hit]] = start[hit] + hits[hit].argmax(axis=1)
+        more = ~hit & inside[:, -1]
+        todo, start = todo[more], start[more] + width
+        width *= 2
+    return found
+
+
+def _comments(data, starts):
+    """Positions of a chunk of NEXUS inside comments, which are [...] on one line."""
+    opens, closes = np.flatnonzero(data == ord("[")), np.flatnonzero(data == ord("]"))
+    after = np.searchsorted(closes, opens)
+    closed = after < len(closes)
+    opens, after = opens[closed], after[closed]
+    line = np.searchsorted(starts, opens, side="right")
+    same = line == np.searchsorted(starts, closes[after], side="right")
+    # An opening bracket inside a comment belongs to it
+    after, first = np.unique(after[same], return_index=True)
+    return _positions(opens[same][first], closes[after] + 1)
+
+
+def _read_chunk(data, lines, named, file_format, strict, encoding):
+    """
+    Residues of the given lines of a chunk, numbered from its first line,
+    as (residues, count and column of every line, the span of each name).
+    Names are cut at the fixed width of strict PHYLIP or as the first word
+    and comments found by their brackets, and what is left of the lines
+    taken whole but for whitespace, so no step goes line by line.
+    """
+    starts, ends = line_bounds(data)
+    if len(starts) <= lines[-1]:
+        # An empty last line without a line ending
+        starts, ends = np.append(starts, len(data)), np.append(ends, len(data))
+    begin, end = starts[lines], ends[lines]
+    # Bytes up to the space are mostly whitespace, other control bytes are kept
+    blank = data <= 32
+    spaces = np.flatnonzero(blank)
+    blank[spaces[~_SPACE[data[spaces]]]] = False
+    keep = ~blank
+    if file_format == NEXUS:
+        comments = _comments(data, starts)
+        blank[comments] = True
+        # Comments and semicolons are left out of the sequence
+        skipped = np.union1d(comments, np.flatnonzero(data == ord(";")))
+        keep[skipped] = False
+    sequence = begin.copy()
+    if strict:
+        names = (begin[named], np.minimum(begin[named] + PHYLIP_NAME_WIDTH, end[named]))
+    else:
+        token = _first(~blank, begin[named], end[named])
+        names = (token, _first(blank, token, end[named]))
+        if file_format == NEXUS:
+            # Quoted names may hold spaces
+            for i in np.flatnonzero((token < end[named]) & (data[np.minimum(token, len(data) - 1)] == ord("'"))):
+                m = _QUOTED_NAME.match(data[token[i]:end[named][i]].tobytes())
+                if m:
+                    names[1][i] = token[i] + m.end()
+    sequence[named] = names[1]
+    keep[_positions(begin, sequence)] = False
+    high = np.flatnonzero(data >= 0x80) if len(data) and data.max() >= 0x80 else None
+    if high is not None and codecs.lookup(encoding).name == "utf-8":
+        # One replacement per character, not per byte
+        keep[high[data[high] < 0xC0]] = False
+    residues = data[keep]
+    if high is not None:
+        residues[residues >= 0x80] = ord("?")
+    dropped = np.flatnonzero(~keep)
+    counts = end - sequence - _count(dropped, sequence, end)
+    first = _first(keep, sequence, end)
+    columns = first - begin
+    if high is not None:
+        # Columns count characters
+        for i in np.flatnonzero(_count(high, begin, first) > 0):
+            columns[i] = len(data[begin[i]:first[i]].tobytes().decode(encoding, errors="replace"))
+    if file_format == NEXUS:
+        # Sites are found again by skipping spaces, which a comment among them breaks
+        last = len(data) - _first(keep[::-1], len(data) - end, len(data) - sequence)
+        columns[_count(skipped, first, np.maximum(first, last)) > 0] = -1
+    return residues, counts, columns, names
+
+
+def _place(matrix, residues, taxa, sites, counts):
+    """Copy the residues of consecutive lines into the matrix, a block of rows at a time."""
+    if not len(counts):
+        return
+    offsets = np.cumsum(counts) - counts
+    # Lines going on with the row of the line before are one run
+    joined = np.r_[False, (taxa[1:] == taxa[:-1]) & (sites[1:] == sites[:-1] + counts[:-1])]
+    runs = np.flatnonzero(~joined)
+    widths = np.add.reduceat(counts, runs)
+    taxa, sites, offsets = taxa[runs], sites[runs], offsets[runs]
+    # Runs of the same sites of consecutive taxa, an interleaved block, are one block
+    stacked = np.r_[False, (taxa[1:] == taxa[:-1] + 1) & (sites[1:] == sites[:-1]) & (widths[1:] == widths[:-1])]
+    blocks = np.flatnonzero(~stacked)
+    rows = np.diff(np.append(blocks, len(taxa)))
+    for block, count in zip(blocks.tolist(), rows.tolist()):
+        taxon, site, width, offset = int(taxa[block]), int(sites[block]), int(widths[block]), int(offsets[block])
+        matrix[taxon:taxon + count, site:site + width] = residues[offset:offset + count * width].reshape(count, width)
+
+
+@timed("alignment.load")
+def read_alignment(document, file_format):
+    """
+    Read the matrix of a NEXUS or PHYLIP document, interleaved or not, into
+    an Alignment with a LineMap of where its sites are in the document.
+    The matrix lines are read a chunk of bytes at a time and their residues
+    copied into the matrix in blocks, see _read_chunk().
+    """
+    lines, taxa, named, ntax, names, nchar = _line_arrays(document, file_format)
+    if nchar is None:
+        # Without NCHAR the first taxon gives the number of sites
+        first = taxa == 0
+        nchar = sum(len(_sequence_bytes(nexus_sequence(document.line(line), line_named)))
+                    for line, line_named in zip(lines[first].tolist(), named[first].tolist()))
+    names = names if names is not None else [""] * ntax
+    strict = file_format == PHYLIP and phylip_layout(document).strict
+    matrix = _allocate(ntax, nchar)
+    filled = np.zeros(ntax, dtype=np.int64)
+    found = []
+    for start, stop in line_chunks(document, int(lines[-1]) + 1 if len(lines) else 0):
+        a, b = np.searchsorted(lines, [start, stop])
+        if a == b:
+            continue
+        first, last = int(lines[a]), int(lines[b - 1]) + 1
+        data = np.frombuffer(read_source(chunk_source(document, first, last)), dtype=np.uint8)
+        residues, counts, columns, (name_begin, name_end) = _read_chunk(
+            data, lines[a:b] - first, named[a:b], file_format, strict, document.encoding)
+        if file_format == PHYLIP:
+            for taxon, begin, end in zip(taxa[a:b][named[a:b]].tolist(), name_begin.tolist(), name_end.tolist()):
+                names[taxon] = data[begin:end].tobytes().decode(document.encoding, errors="replace").strip()
+        filled_lines = counts > 0
+        chunk_taxa, counts = taxa[a:b][filled_lines], counts[filled_lines]
+        # Sites of the lines follow on from those of the lines of their taxon before
+        order = np.argsort(chunk_taxa, kind="stable")
+        before = np.cumsum(counts[order]) - counts[order]
+        group = np.r_[True, chunk_taxa[order][1:] != chunk_taxa[order][:-1]]
+        sites = np.empty_like(before)
+        sites[order] = filled[chunk_taxa[order]] + before - np.maximum.accumulate(np.where(group, before, 0))
+        filled += np.bincount(chunk_taxa, weights=counts, minlength=ntax).astype(np.int64)
+        over = np.flatnonzero(filled > nchar)
+        if len(over):
+            raise ValueError("{} has more than the {} sites of the alignment".format(names[over[0]], nchar))
+        _place(matrix, residues, chunk_taxa, sites, counts)
+        found.append((lines[a:b][filled_lines], chunk_taxa, sites, columns[filled_lines], counts))
+    for taxon in np.flatnonzero(filled < nchar).tolist():
+        matrix[taxon, filled[taxon]:] = GAP
+    found = [np.concatenate(parts) for parts in zip(*found)] if found else [np.zeros(0, dtype=np.int64)] * 5
+    return Alignment(names, matrix, LineMap(*found))
+
+
+def load(document, file_format):
+    """The alignment of a document, cached on it until the next edit."""
+    cached = document.analysis.get("alignment")
+    if cached is not None and cached[0] == (document.version, len(document)):
+        return cached[1]
+    alignment = read_alignment(document, file_format)
+    document.analysis["alignment"] = ((document.version, len(document)), alignment)
+    return alignment
@@ -0,0 +1,419 @@
+"""
+Benchmarks of the editor on synthetic sequence files.
+
+    python benchmark.py --sizes 1M,100M,10G --formats fasta,fastq --output results.json
+    python benchmark.py --compare before.json after.json
+
+Files are generated once per format and size from a fixed seed, so every
+run measures the same bytes, and kept in --data for the next run. Every
+file is measured in a fresh process with the offscreen Qt platform, which
+makes the peak RSS reported that of one file. Startup is measured in a
+process of its own too, from its launch to the first window showing the
+file given on the command line.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+FORMATS = ("fasta", "fastq", "nexus", "phylip")
+EXTENSIONS = {"fasta": "fas", "fastq": "fastq", "nexus": "nex", "phylip": "phy"}
+DEFAULT_SIZES = "1M,10M,100M"
+SEED = 1
+# Bases per FASTA record and per line
+FASTA_RECORD = 10000
+FASTA_WIDTH = 60
+FASTQ_READ = 150
+# Bytes generated per write
+GENERATE_CHUNK = 1 << 24
+# Searched for in every file, present in the random sequences roughly every 4^8 bases
+SEARCH_PATTERN = "ACGTACGT"
+# Scroll steps of each kind
+LINE_STEPS = 200
+PAGE_STEPS = 100
+JUMP_STEPS = 50
+# Lines styled per lexer measurement
+LEX_LINES = 2000
+# Seconds to wait for a background task before giving up
+TIMEOUT = 3600
+# Seconds from launch to the first window showing the file, runs above it are flagged
+STARTUP_TARGET = 1.0
+
+_BASES = np.frombuffer(b"ACGT", dtype=np.uint8)
+_SIZE_SUFFIXES = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+
+
+def parse_size(text):
+    text = text.strip().upper().rstrip("B")
+    if text and text[-1] in _SIZE_SUFFIXES:
+        return int(float(text[:-1]) * _SIZE_SUFFIXES[text[-1]])
+    return int(text)
+
+
+def _bases(rng, n):
+    return _BASES[rng.integers(0, 4, n, dtype=np.uint8)]
+
+
+def _lines(data, width):
+    """Cut an array of bases into newline terminated lines of width bases."""
+    full = len(data) // width * width
+    rows = np.empty((len(data) // width, width + 1), dtype=np.uint8)
+    rows[:, :width] = data[:full].reshape(-1, width)
+    rows[:, width] = 10
+    tail = data[full:].tobytes()
+    return rows.tobytes() + (tail + b"\n" if tail else b"")
+
+
+def _write_fasta(f, size, rng):
+    written = i = 0
+    while written < size:
+        record = b">seq%d synthetic record\n" % i + _lines(_bases(rng, FASTA_RECORD), FASTA_WIDTH)
+        f.write(record)
+        written += len(record)
+        i += 1
+
+
+def _write_fastq(f, size, rng):
+    written = i = 0
+    per_chunk = max(1, GENERATE_CHUNK // (2 * FASTQ_READ + 32))
+    while written < size:
+        bases = _bases(rng, per_chunk * FASTQ_READ).reshape(per_chunk, -1)
+        qualities = rng.integers(33, 75, (per_chunk, FASTQ_READ), dtype=np.uint8)
+        parts = []
+        for j in range(per_chunk):
+            parts.append(b"@read%d synthetic\n%s\n+\n%s\n" % (i + j, bases[j].tobytes(), qualities[j].tobytes()))
+        chunk = b"".join(parts)
+        f.write(chunk)
+        written += len(chunk)
+        i += per_chunk
+
+
+def _matrix_shape(size):
+    # Square-ish alignments, so neither the taxa nor the sites dominate
+    ntax = max(4, int((size / 16) ** 0.5))
+    nchar = max(16, size // ntax - 16)
+    return ntax, nchar
+
+
+def _write_rows(f, ntax, nchar, rng, label):
+    for i in range(ntax):
+        f.write(label(i))
+        for start in range(0, nchar, GENERATE_CHUNK):
+            f.write(_bases(rng, min(GENERATE_CHUNK, nchar - start)).tobytes())
+        f.write(b"\n")
+
+
+def _write_phylip(f, size, rng):
+    ntax, nchar = _matrix_shape(size)
+    f.write(b"%d %d\n" % (ntax, nchar))
+    _write_rows(f, ntax, nchar, rng, lambda i: b"t%-9d " % i)
+
+
+def _write_nexus(f, size, rng):
+    ntax, nchar = _matrix_shape(size)
+    f.write(b"#NEXUS\n\nbegin data;\n  dimensions ntax=%d nchar=%d;\n"
+            b"  format datatype=dna missing=? gap=-;\n  matrix\n" % (ntax, nchar))
+    _write_rows(f, ntax, nchar, rng, lambda i: b"    taxon_%d  " % i)
+    f.write(b"  ;\nend;\n")
+
+
+WRITERS = {"fasta": _write_fasta, "fastq": _write_fastq, "nexus": _write_nexus, "phylip": _write_phylip}
+
+
+def generate(file_format, size, directory):
+    """Path of the synthetic file of a format and size, written if it is not there yet."""
+    path = os.path.join(directory, "synthetic-{}.{}".format(size, EXTENSIONS[file_format]))
+    if os.path.exists(path):
+        return path
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng([SEED, FORMATS.index(file_format), size])
+    fd, tmp = tempfile.mkstemp(dir=directory)
+    try:
+        with open(fd, "wb") as f:
+            WRITERS[file_format](f, size, rng)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return path
+
+
+def peak_rss():
+    """Peak resident set size of this process in bytes."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class _Timer:
+    def __init__(self):
+        self.start = time.perf_counter()
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+
+def _wait(app, done):
+    timer = _Timer()
+    while not done():
+        if timer.elapsed > TIMEOUT:
+            raise TimeoutError("Gave up waiting after {} s".format(TIMEOUT))
+        app.processEvents()
+        time.sleep(0.001)
+    app.processEvents()
+
+
+def _thread_done(thread):
+    from PyQt5 import sip
+    return thread is None or sip.isdeleted(thread) or thread.isFinished()
+
+
+def _scroll(app, window, values):
+    times = []
+    for value in values:
+        timer = _Timer()
+        window.scroll.setValue(value)
+        app.processEvents()
+        times.append(timer.elapsed)
+    times.sort()
+    return {"steps": len(times), "total": sum(times), "mean": sum(times) / max(len(times), 1),
+            "p95": times[int(len(times) * 0.95)] if times else 0}
+
+
+def run_case(file_format, path):
+    """Measure one file in this process, returns the results as a dict."""
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    from PyQt5.QtWidgets import QApplication, QDialog, QFileDialog
+    from PyQt5.Qsci import QsciScintilla, QsciLexerCustom
+    app = QApplication.instance() or QApplication([])
+    import main
+
+    answers = {}
+    QFileDialog.getOpenFileName = staticmethod(lambda *args, **kwargs: (answers["open"], ""))
+    QFileDialog.getSaveFileName = staticmethod(lambda *args, **kwargs: (answers["save"], ""))
+
+    class FindAnswer(main.FindInputDialog):
+        def exec_(self):
+            return QDialog.Accepted
+
+        def getInputs(self):
+            return SEARCH_PATTERN, False, False, False
+
+    main.FindInputDialog = FindAnswer
+
+    results = {"format": file_format, "bytes": os.path.getsize(path), "timings": {}, "rss": {}}
+    timings, rss = results["timings"], results["rss"]
+    window = main.SequenceEditor()
+    window.resize(1200, 900)
+    window.show()
+    app.processEvents()
+    rss["start"] = peak_rss()
+
+    answers["open"] = path
+    timer = _Timer()
+    window.file_open()
+    app.processEvents()
+    timings["open_first_window"] = timer.elapsed
+    _wait(app, lambda: _thread_done(window.index_thread))
+    timings["open_indexed"] = timer.elapsed
+    results["lines"] = len(window.document)
+    rss["open"] = peak_rss()
+
+    lines = len(window.document)
+    page = window.window_lines()
+    rng = random.Random(SEED)
+    timings["scroll_line"] = _scroll(app, window, range(1, min(LINE_STEPS, lines) + 1))
+    timings["scroll_page"] = _scroll(app, window, range(0, min(PAGE_STEPS * page, lines), page))
+    timings["scroll_jump"] = _scroll(app, window, [rng.randrange(max(lines, 1)) for _ in range(JUMP_STEPS)])
+    rss["scroll"] = peak_rss()
+
+    timer = _Timer()
+    window.find_search()
+    first_hit = []
+
+    def searched():
+        if not first_hit and len(window.find):
+            first_hit.append(timer.elapsed)
+        return _thread_done(window.search_thread)
+
+    _wait(app, searched)
+    timings["search_first_hit"] = first_hit[0] if first_hit else None
+    timings["search"] = timer.elapsed
+    results["matches"] = len(window.find)
+    rss["search"] = peak_rss()
+
+    # Every lexer of the file's type over the same lines, in an editor of its own
+    document = window.document
+    start = max(0, min(lines - LEX_LINES, lines // 2))
+    text = document.text(start, start + LEX_LINES)
+    editor = QsciScintilla()
+    lexer = window.LEXERS[EXTENSIONS[file_format]](editor)
+    set_context = getattr(lexer, "set_context", None)
+    if set_context is not None:
+        set_context(document, start)
+    editor.setLexer(lexer)
+    editor.setText(text)
+    if isinstance(lexer, QsciLexerCustom):
+        timer = _Timer()
+        lexer.styleText(0, editor.length())
+        elapsed = timer.elapsed
+        timings["lex"] = {"lexer": type(lexer).__name__, "bytes": editor.length(), "seconds": elapsed,
+                          "bytes_per_second": editor.length() / elapsed if elapsed else None}
+    rss["lex"] = peak_rss()
+
+    # An edit at the top, so saving copies the rest of the file around it
+    directory = tempfile.mkdtemp(prefix="benchmark-")
+    try:
+        window.scroll.setValue(0)
+        window.editor.insertAt(">", 0, 0)
+        answers["save"] = os.path.join(directory, os.path.basename(path))
+        timer = _Timer()
+        window.file_saveAs()
+        timings["save"] = timer.elapsed
+        _wait(app, lambda: _thread_done(window.index_thread))
+        rss["save"] = peak_rss()
+        window.close()
+        app.processEvents()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    rss["peak"] = peak_rss()
+    return results
+
+
+def run_startup(path, launched):
+    """Seconds from launched, the time.time() the process was started at, to the first window with the file."""
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    import main
+    app, window = main.start([main.__file__, path])
+    app.processEvents()
+    elapsed = time.time() - launched
+    window.close()
+    return elapsed
+
+
+def _commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run(formats, sizes, directory, progress=print):
+    """Generate and measure every format at every size, each file in a process of its own."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, QT_QPA_PLATFORM="offscreen")
+    report = {"commit": _commit(), "date": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(),
+              "platform": platform.platform(), "cpus": os.cpu_count(), "results": []}
+    for size in sizes:
+        for file_format in formats:
+            timer = _Timer()
+            path = generate(file_format, size, directory)
+            progress("{} {}: generated in {:.1f} s".format(file_format, size, timer.elapsed))
+            startup = subprocess.run([sys.executable, os.path.abspath(__file__), "--startup", path, repr(time.time())],
+                                     cwd=here, env=env, capture_output=True, text=True)
+            out = subprocess.run([sys.executable, os.path.abspath(__file__), "--case", file_format, path],
+                                 cwd=here, env=env, capture_output=True, text=True)
+            if out.returncode:
+                result = {"format": file_format, "error": out.stderr.strip().splitlines()[-1:]}
+            else:
+                result = json.loads(out.stdout.strip().splitlines()[-1])
+                if not startup.returncode:
+                    result["timings"]["startup"] = float(startup.stdout.strip().splitlines()[-1])
+            result["size"] = size
+            report["results"].append(result)
+            progress(summary(result))
+    return report
+
+
+def summary(result):
+    if "error" in result:
+        return "{} {}: failed {}".format(result["format"], result["size"], result["error"])
+    t = result["timings"]
+    line = ("{format} {size}: open {0:.2f} s (first window {1:.3f} s), scroll {2:.1f} ms/page, "
+            "search {3:.2f} s, save {4:.2f} s, peak RSS {5:.0f} MiB").format(
+        t["open_indexed"], t["open_first_window"], t["scroll_page"]["mean"] * 1000, t["search"],
+        t["save"], result["rss"]["peak"] / (1 << 20), **result)
+    if "startup" in t:
+        line += ", startup {:.2f} s{}".format(
+            t["startup"], " (over the {} s target)".format(STARTUP_TARGET) if t["startup"] > STARTUP_TARGET else "")
+    return line
+
+
+def _metrics(result, prefix=""):
+    """Flatten the numbers of a result into {name: value}."""
+    out = {}
+    for key, value in result.items():
+        if isinstance(value, dict):
+            out.update(_metrics(value, prefix + key + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            out[prefix + key] = value
+    return out
+
+
+def compare(before, after):
+    """Lines comparing two reports, the ratio after / before of every metric."""
+    keyed = {(r["format"], r["size"]): r for r in before["results"] if "error" not in r}
+    lines = ["{} -> {}".format(before.get("commit"), after.get("commit"))]
+    for result in after["results"]:
+        old = keyed.get((result["format"], result.get("size")))
+        if old is None or "error" in result:
+            continue
+        lines.append("{} {}".format(result["format"], result["size"]))
+        new_metrics, old_metrics = _metrics(result), _metrics(old)
+        for name in sorted(new_metrics):
+            if name in ("bytes", "size", "lines", "matches") or not old_metrics.get(name):
+                continue
+            ratio = new_metrics[name] / old_metrics[name]
+            lines.append("  {:<32} {:>12.4g} {:>12.4g} {:>7.2f}x".format(name, old_metrics[name], new_metrics[name], ratio))
+    return lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--formats", default=",".join(FORMATS), help="comma separated, of " + ", ".join(FORMATS))
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="comma separated sizes such as 1M,1G,10G")
+    parser.add_argument("--data", default=os.path.join(tempfile.gettempdir(), "sequence-editor-benchmark"),
+                        help="directory the synthetic files are kept in")
+    parser.add_argument("--output", help="JSON file to write the results to")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="compare two result files")
+    parser.add_argument("--case", nargs=2, metavar=("FORMAT", "PATH"), help=argparse.SUPPRESS)
+    parser.add_argument("--startup", nargs=2, metavar=("PATH", "LAUNCHED"), help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.case:
+        print(json.dumps(run_case(*args.case)))
+        return
+    if args.startup:
+        print(run_startup(args.startup[0], float(args.startup[1])))
+        return
+    if args.compare:
+        with open(args.compare[0]) as a, open(args.compare[1]) as b:
+            print("\n".join(compare(json.load(a), json.load(b))))
+        return
+
+    formats = [f.strip() for f in args.formats.split(",") if f.strip()]
+    unknown = set(formats) - set(FORMATS)
+    if unknown:
+        parser.error("unknown formats: " + ", ".join(sorted(unknown)))
+    sizes = [parse_size(s) for s in args.sizes.split(",") if s.strip()]
+    report = run(formats, sizes, args.data, progress=lambda line: print(line, file=sys.stderr))
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
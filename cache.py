@@ -0,0 +1,288 @@
+"""
+What opening a file works out, kept for the next time it is opened.
+
+On disk, under the XDG cache directory, an entry per file holds its line
+offsets, its .fai record index and the analyses worth keeping: the
+statistics of its chunks and the PHYLIP layout. Entries are keyed by the
+path, size and modification time of the file and a hash of its first
+bytes, so an entry is never used for a file that changed, and the least
+recently used ones are removed once the cache grows past MAX_BYTES. The
+line offsets are memory mapped back, so reopening a large file costs no
+scan of it.
+
+Entries are written by a thread of their own, so saving one never holds
+up the editor, and shutdown() waits for the writes still running.
+
+In the process, RecentDocuments keeps the last few documents open with
+everything worked out on them, so switching back to one redoes nothing.
+"""
+import hashlib
+import io
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from document import ORIGINAL
+from faidx import FastaIndex
+from formats import PHYLIP
+
+CACHE_NAME = "sequence-editor"
+# Bytes the cache may take before entries are evicted
+MAX_BYTES = 1 << 30
+# Smaller files are indexed faster than an entry is read back
+MIN_FILE_BYTES = 1 << 20
+# Bytes of the head of a file hashed into its key
+HEAD_BYTES = 1 << 16
+# Line starts checked against the file when an entry is read
+CHECKED_LINES = 1024
+# Documents kept open by RecentDocuments
+RECENT_DOCUMENTS = 4
+
+LINES = "lines.npy"
+RECORDS = "records.fai"
+RECORD_LINES = "records.npy"
+ANALYSIS = "analysis.pickle"
+# Key of the entry of a document, kept with its analyses
+KEY = "cache"
+
+_writer = None
+# save() is called from the GUI and index threads
+_writer_lock = threading.Lock()
+
+
+def cache_dir():
+    root = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(root, CACHE_NAME)
+
+
+def file_key(path):
+    """Key of the entry of a file as it is now."""
+    stat = os.stat(path)
+    digest = hashlib.sha256()
+    digest.update(os.path.realpath(path).encode("utf-8", "surrogateescape"))
+    digest.update(b"\0%d\0%d\0" % (stat.st_size, stat.st_mtime_ns))
+    with open(path, "rb") as f:
+        digest.update(f.read(HEAD_BYTES))
+    return digest.hexdigest()[:32]
+
+
+def _cacheable(document):
+    # Compressed files are indexed together with their decompression, which is not kept
+    return not document.compressed and document.size is not None and document.size >= MIN_FILE_BYTES
+
+
+def _write(path, dump):
+    """Write a file of an entry through a temporary file, so it is whole or missing."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".", suffix=".tmp")
+    try:
+        with open(fd, "wb") as f:
+            dump(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def _checked(document, offsets):
+    """Whether a sample of saved line starts all follow a newline of the file."""
+    if not len(offsets) or offsets[0] != 0 or offsets[-1] >= document.size:
+        return False
+    sample = offsets[np.linspace(1, len(offsets) - 1, min(CHECKED_LINES, len(offsets) - 1), dtype=np.int64)]
+    return bool((document.bytes_at(np.asarray(sample) - 1) == 10).all())
+
+
+def load(document):
+    """
+    Give a document just opened, without an index, the line index and the
+    analyses the cache holds for its file. Returns whether there was an
+    entry, the record index is read by load_records().
+    """
+    if not _cacheable(document):
+        return False
+    try:
+        key = file_key(document.path)
+        entry = os.path.join(cache_dir(), key)
+        document.analysis[KEY] = key
+        offsets = np.load(os.path.join(entry, LINES), mmap_mode="r")
+        if not _checked(document, offsets):
+            shutil.rmtree(entry, ignore_errors=True)
+            return False
+        analysis = {}
+        if os.path.exists(os.path.join(entry, ANALYSIS)):
+            with open(os.path.join(entry, ANALYSIS), "rb") as f:
+                analysis = pickle.load(f)
+        # The entry was used now, as far as eviction goes
+        os.utime(entry)
+    except (OSError, ValueError, EOFError, pickle.UnpicklingError):
+        return False
+    document.adopt_index(offsets)
+    document.analysis.update(analysis)
+    return True
+
+
+def load_records(document, file_format):
+    """The record index kept for the file of a document, None if there is none."""
+    key = document.analysis.get(KEY)
+    if key is None:
+        return None
+    entry = os.path.join(cache_dir(), key)
+    try:
+        lines = np.load(os.path.join(entry, RECORD_LINES)).tolist()
+        index = FastaIndex.read(os.path.join(entry, RECORDS), file_format)
+    except (OSError, ValueError):
+        return None
+    if len(lines) != len(index):
+        return None
+    return FastaIndex(index.entries, file_format, lines)
+
+
+def _analyses(document):
+    """The analyses of a document that hold for its file, whatever the edits."""
+    analyses = {}
+    # Statistics are cached per chunk, those of unedited lines are those of the file
+    statistics = {key: value for key, value in document.analysis.get("statistics", {}).items()
+                  if key[0] == ORIGINAL}
+    if statistics:
+        analyses["statistics"] = statistics
+    layout = document.analysis.get(PHYLIP)
+    if document.version == 0 and layout is not None and layout[0][1]:
+        analyses[PHYLIP] = layout
+    return analyses
+
+
+def save(document, record_index=None):
+    """
+    Keep what has been worked out for the file of a fully indexed document:
+    its line index and record index the first time, its analyses every
+    time. The entry is written in the background, in the order of the
+    calls, failures are silently skipped. Safe to call from any thread.
+    """
+    global _writer
+    key = document.analysis.get(KEY)
+    if key is None or not document.indexed or not _cacheable(document):
+        return
+    # Only what the document holds now is written, whatever happens to it next
+    entry = (os.path.join(cache_dir(), key), document.line_offsets(), record_index, _analyses(document))
+    with _writer_lock:
+        if _writer is None:
+            _writer = ThreadPoolExecutor(max_workers=1)
+        _writer.submit(_store, *entry)
+
+
+def shutdown():
+    """Wait for the entries still being written."""
+    global _writer
+    with _writer_lock:
+        if _writer is not None:
+            _writer.shutdown()
+            _writer = None
+
+
+def _store(entry, offsets, record_index, analyses):
+    try:
+        os.makedirs(entry, exist_ok=True)
+        if not os.path.exists(os.path.join(entry, LINES)):
+            _write(os.path.join(entry, LINES), lambda f: np.save(f, offsets))
+        # Records with uneven lines have no .fai, they are indexed again
+        if record_index is not None and not record_index.uneven and not os.path.exists(os.path.join(entry, RECORDS)):
+            lines = np.asarray(record_index.lines, dtype=np.int64)
+            _write(os.path.join(entry, RECORD_LINES), lambda f: np.save(f, lines))
+            text = io.StringIO()
+            record_index.dump(text)
+            _write(os.path.join(entry, RECORDS), lambda f: f.write(text.getvalue().encode("utf-8")))
+        if analyses:
+            _write(os.path.join(entry, ANALYSIS), lambda f: pickle.dump(analyses, f, pickle.HIGHEST_PROTOCOL))
+        evict(keep=entry)
+    except OSError:
+        pass
+
+
+def _entry_size(path):
+    size = 0
+    for name in os.listdir(path):
+        try:
+            size += os.path.getsize(os.path.join(path, name))
+        except OSError:
+            pass
+    return size
+
+
+def evict(limit=MAX_BYTES, keep=None):
+    """
+    Remove the least recently used entries until the cache takes at most
+    limit bytes, or only keep left if that alone takes more.
+    """
+    root = cache_dir()
+    entries = []
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        if path == keep:
+            continue
+        try:
+            entries.append((os.path.getmtime(path), _entry_size(path), path))
+        except OSError:
+            pass
+    total = sum(size for _, size, _ in entries) + (_entry_size(keep) if keep is not None else 0)
+    for _, size, path in sorted(entries):
+        if total <= limit:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+
+
+def _stamp(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+class RecentDocuments:
+    """
+    The last documents set aside, kept open with their line index, record
+    index and analyses, most recently used last. Only fully indexed
+    documents without edits are kept, and one is only handed back while
+    its file is unchanged.
+    """
+
+    def __init__(self, size=RECENT_DOCUMENTS):
+        self.size = size
+        self._entries = OrderedDict()
+
+    def put(self, document, record_index=None):
+        """Set a document aside, or close it if it cannot be kept."""
+        if document.version or not document.indexed or document.stamp != _stamp(document.path):
+            document.close()
+            return
+        path = os.path.realpath(document.path)
+        old = self._entries.pop(path, None)
+        if old is not None and old[0] is not document:
+            old[0].close()
+        self._entries[path] = (document, record_index)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)[1][0].close()
+
+    def take(self, path):
+        """(document, record index) set aside for a file, (None, None) if there is none."""
+        entry = self._entries.pop(os.path.realpath(path), None)
+        if entry is None:
+            return None, None
+        document, record_index = entry
+        if document.stamp != _stamp(path):
+            document.close()
+            return None, None
+        return document, record_index
+
+    def __len__(self):
+        return len(self._entries)
+
+    def close(self):
+        while self._entries:
+            self._entries.popitem()[1][0].close()
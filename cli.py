@@ -0,0 +1,279 @@
+"""
+Command line tools over the sequence files the editor reads, for machines
+without a display. Nothing here imports Qt.
+
+    python cli.py convert in.fas out.nex
+    zcat reads.fastq.gz | python cli.py grep --from fastq --sequences ACGTACGT
+    python cli.py grep --dna -k 2 --both-strands AGATCGGAAGAGC reads.fastq
+    python cli.py stats *.fastq
+    python cli.py validate data/*.fas
+
+Paths default to - for stdin or stdout, where the format has to be given
+with --from or --to. FASTA, FASTQ and GenBank input is read from stdin as
+it streams in, the other formats and the commands that need the whole file
+spool it to a temporary file first.
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+from contextlib import contextmanager
+
+import stats
+import workers
+from convert import READERS, WRITERS, INTERLEAVED_FORMATS, write_records
+from document import Document
+from faidx import FastaIndex, save_index
+from formats import FASTA, FASTQ, GENBANK, EXTENSIONS, detect_format
+from search import Search, SequenceSearch, compile_pattern, scan_lines, NAME, SEQUENCE
+from validate import validate
+
+STDIO = "-"
+# Formats the readers only go through once, line by line
+STREAMED_FORMATS = (FASTA, FASTQ, GENBANK)
+FORMATS = sorted(set(EXTENSIONS.values()))
+# Problems listed per file by validate
+MAX_PROBLEMS = 100
+
+
+class _Stream:
+    """Lines of a text stream, for the readers that go through them once."""
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def iter_lines(self, start=0, stop=None):
+        return iter(self.stream)
+
+
+def _format(path, given):
+    file_format = given or (detect_format(path) if path != STDIO else None)
+    if file_format is None:
+        raise SystemExit("error: give the format of {} with --from".format("stdin" if path == STDIO else path))
+    return file_format
+
+
+@contextmanager
+def open_document(path):
+    """A Document of a path, or of stdin spooled to a temporary file."""
+    if path != STDIO:
+        document = Document(path)
+        try:
+            yield document
+        finally:
+            document.close()
+        return
+    with tempfile.NamedTemporaryFile(suffix=".tmp", delete=False) as spool:
+        shutil.copyfileobj(sys.stdin.buffer, spool)
+    try:
+        document = Document(spool.name)
+        try:
+            yield document
+        finally:
+            document.close()
+    finally:
+        os.remove(spool.name)
+
+
+def command_convert(args):
+    source_format = _format(args.input, args.source_format)
+    target_format = args.target_format or (detect_format(args.output) if args.output != STDIO else None)
+    if source_format not in READERS:
+        raise SystemExit("error: cannot read {} files".format(source_format))
+    if target_format not in WRITERS:
+        raise SystemExit("error: give a format to write with --to, one of " + ", ".join(sorted(WRITERS)))
+
+    def write(records):
+        if args.output == STDIO:
+            kwargs = {"interleaved": args.interleaved} if target_format in INTERLEAVED_FORMATS else {}
+            WRITERS[target_format](records, sys.stdout, **kwargs)
+        else:
+            write_records(records, args.output, target_format, args.interleaved)
+
+    if args.input == STDIO and source_format in STREAMED_FORMATS:
+        write(READERS[source_format](_Stream(sys.stdin)))
+        return 0
+    with open_document(args.input) as document:
+        write(READERS[source_format](document))
+    return 0
+
+
+def command_index(args):
+    file_format = _format(args.input, args.source_format)
+    if file_format not in (FASTA, FASTQ):
+        raise SystemExit("error: only FASTA and FASTQ files can be indexed")
+    with open_document(args.input) as document:
+        index = FastaIndex.build(document, file_format)
+    if index.uneven:
+        raise SystemExit("error: different line lengths in record {}, it cannot be indexed".format(index.uneven_name()))
+    if args.output == STDIO or args.input == STDIO and args.output is None:
+        index.dump(sys.stdout)
+    elif args.output:
+        index.write(args.output)
+    else:
+        save_index(index, args.input)
+    return 0
+
+
+def _print_hits(label, hits, line_text):
+    shown = None
+    for hit in hits:
+        if hit.line == shown:
+            continue
+        shown = hit.line
+        print("{}{}:{}:{}".format(label, hit.line + 1, hit.column + 1, line_text(hit.line).rstrip("\r\n")))
+
+
+def command_grep(args):
+    kinds = [NAME] if args.names else [SEQUENCE] if args.sequences else None
+    found = 0
+    for path in args.inputs:
+        file_format = args.source_format or (detect_format(path) if path != STDIO else None)
+        label = path + ":" if len(args.inputs) > 1 else ""
+        count = 0
+        if args.dna:
+            file_format = _format(path, args.source_format)
+            try:
+                with open_document(path) as document:
+                    search = SequenceSearch(document, args.pattern, file_format, args.differences, args.edits,
+                                            args.both_strands)
+                    for hits in search:
+                        count += len(hits)
+                        if not args.count:
+                            _print_hits(label, hits, document.line)
+            finally:
+                workers.shutdown()
+        elif path == STDIO:
+            pattern = compile_pattern(args.pattern, args.regex, args.ignore_case)
+            for first_line, lines, hits in scan_lines(sys.stdin, pattern, file_format, kinds):
+                count += len(hits)
+                if not args.count:
+                    _print_hits(label, hits, lambda line: lines[line - first_line])
+        else:
+            with open_document(path) as document:
+                search = Search(document, args.pattern, args.regex, file_format, kinds, ignore_case=args.ignore_case)
+                for hits in search:
+                    count += len(hits)
+                    if not args.count:
+                        _print_hits(label, hits, document.line)
+        if args.count:
+            print("{}{}".format(label, count))
+        found += count
+    return 0 if found else 1
+
+
+def _summary(s):
+    out = {"records": s.records, "bases": s.bases, "min_length": s.min_length, "max_length": s.max_length,
+           "mean_length": round(s.mean_length, 2), "n50": s.n50, "n90": s.n90,
+           "gc_fraction": round(s.gc_fraction, 4), "n_fraction": round(s.n_fraction, 4)}
+    quality = s.mean_quality
+    if quality is not None:
+        out["mean_quality"] = round(float(quality.mean()), 2) if len(quality) else 0.0
+    return out
+
+
+def command_stats(args):
+    results = {}
+    try:
+        for path in args.inputs:
+            file_format = _format(path, args.source_format)
+            if file_format not in (FASTA, FASTQ):
+                raise SystemExit("error: statistics are available for FASTA and FASTQ files")
+            with open_document(path) as document:
+                results[path] = _summary(stats.compute(document, file_format))
+    finally:
+        workers.shutdown()
+    if args.json:
+        json.dump(results if len(results) > 1 else next(iter(results.values())), sys.stdout, indent=2)
+        print()
+        return 0
+    for path, summary in results.items():
+        if len(results) > 1:
+            print(path)
+        for key, value in summary.items():
+            print("{}{:<12} {}".format("  " if len(results) > 1 else "", key, value))
+    return 0
+
+
+def command_validate(args):
+    # Each file is cut into chunks checked in worker processes
+    failed = 0
+    try:
+        for path in args.inputs:
+            file_format = _format(path, args.source_format)
+            with open_document(path) as document:
+                report = validate(document, file_format, MAX_PROBLEMS)
+            for problem in report.problems:
+                print("{}:{}:{}: {}".format(path, problem.line + 1, problem.column + 1, problem.message))
+            if report.count > len(report.problems):
+                print("{}: {} more problems".format(path, report.count - len(report.problems)))
+            failed += report.count > 0
+    finally:
+        workers.shutdown()
+    return 1 if failed else 0
+
+
+def parser():
+    formats = dict(choices=FORMATS, metavar="FORMAT", help="one of " + ", ".join(FORMATS))
+    parser = argparse.ArgumentParser(prog="sequence-editor", description=__doc__.strip().splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    p = commands.add_parser("convert", help="convert between formats")
+    p.add_argument("input", nargs="?", default=STDIO)
+    p.add_argument("output", nargs="?", default=STDIO)
+    p.add_argument("--from", dest="source_format", **formats)
+    p.add_argument("--to", dest="target_format", **formats)
+    p.add_argument("--interleaved", action="store_true", help="interleaved NEXUS or PHYLIP output")
+    p.set_defaults(run=command_convert)
+
+    p = commands.add_parser("index", help="build the .fai index of a FASTA or FASTQ file")
+    p.add_argument("input", nargs="?", default=STDIO)
+    p.add_argument("-o", "--output", help="where to write the index, next to the input by default")
+    p.add_argument("--from", dest="source_format", **formats)
+    p.set_defaults(run=command_index)
+
+    p = commands.add_parser("grep", help="print the lines matching a pattern")
+    p.add_argument("pattern")
+    p.add_argument("inputs", nargs="*", default=[STDIO])
+    p.add_argument("-E", "--regex", action="store_true", help="the pattern is a regular expression")
+    p.add_argument("-i", "--ignore-case", action="store_true")
+    p.add_argument("-c", "--count", action="store_true", help="print the number of matches only")
+    kind = p.add_mutually_exclusive_group()
+    kind.add_argument("--names", action="store_true", help="match record names only")
+    kind.add_argument("--sequences", action="store_true", help="match sequences only")
+    kind.add_argument("--dna", action="store_true",
+                      help="match a DNA motif with IUPAC codes in the sequences, across line wraps")
+    p.add_argument("-k", "--differences", type=int, default=0, help="mismatches allowed with --dna")
+    p.add_argument("--edits", action="store_true", help="count insertions and deletions as differences too")
+    p.add_argument("--both-strands", action="store_true", help="match the reverse complement too")
+    p.add_argument("--from", dest="source_format", **formats)
+    p.set_defaults(run=command_grep)
+
+    p = commands.add_parser("stats", help="record statistics of FASTA and FASTQ files")
+    p.add_argument("inputs", nargs="*", default=[STDIO])
+    p.add_argument("--json", action="store_true")
+    p.add_argument("--from", dest="source_format", **formats)
+    p.set_defaults(run=command_stats)
+
+    p = commands.add_parser("validate", help="check files against their format")
+    p.add_argument("inputs", nargs="*", default=[STDIO])
+    p.add_argument("--from", dest="source_format", **formats)
+    p.set_defaults(run=command_validate)
+    return parser
+
+
+def main(argv=None):
+    args = parser().parse_args(argv)
+    try:
+        return args.run(args)
+    except BrokenPipeError:
+        return 0
+    except (OSError, ValueError) as e:
+        print("error: {}".format(e), file=sys.stderr)
+        return 2
+
+
+if __name__ == "__main__":
+    sys.exit(main())
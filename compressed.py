@@ -0,0 +1,308 @@
+import io
+import struct
+import threading
+import zlib
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from formats import COMPRESSED_SUFFIXES
+
+GZIP_MAGIC = b"\x1f\x8b"
+# Compressed bytes handed to zlib per step
+INPUT_SIZE = 1 << 16
+# Uncompressed bytes between the checkpoints of a plain gzip file
+CHECKPOINT_SPAN = 1 << 25
+# Uncompressed bytes per cached page of a plain gzip file
+PAGE_SIZE = 1 << 20
+# Decompressed bytes kept in memory for random access
+CACHE_SIZE = 1 << 26
+# Uncompressed bytes per BGZF block written, the size bgzip uses
+BGZF_BLOCK_DATA = 0xff00
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+
+def is_compressed_path(path):
+    return path.lower().endswith(COMPRESSED_SUFFIXES)
+
+
+def is_gzip(data):
+    return data[:2] == GZIP_MAGIC
+
+
+def _bgzf_block_size(data, pos):
+    """Size of the BGZF block at pos, None if it is a gzip member without the BC field."""
+    if data[pos:pos + 4] != b"\x1f\x8b\x08\x04":
+        return None
+    xlen = struct.unpack_from("<H", data, pos + 10)[0]
+    field = pos + 12
+    while field + 4 <= pos + 12 + xlen:
+        si, slen = data[field:field + 2], struct.unpack_from("<H", data, field + 2)[0]
+        if si == b"BC" and slen == 2:
+            return struct.unpack_from("<H", data, field + 4)[0] + 1
+        field += 4 + slen
+    return None
+
+
+def is_bgzf(data):
+    return len(data) >= 18 and _bgzf_block_size(data, 0) is not None
+
+
+class _Reader:
+    """
+    Random access to the uncompressed bytes of a compressed file, sliced like
+    the mapping of a plain file. chunks() decompresses the whole file once,
+    in order, and builds the index used for random access as it goes, so
+    only the part of the file already scanned can be read.
+    """
+
+    def __init__(self, data):
+        self._data = data
+        # Uncompressed size, known once the whole file has been scanned
+        self.size = None
+        self._scanned = 0
+        self._cache = OrderedDict()
+        self._cached = 0
+        self._lock = threading.Lock()
+        self._prefetcher = ThreadPoolExecutor(max_workers=1)
+
+    def _from_cache(self, key):
+        with self._lock:
+            data = self._cache.get(key)
+            if data is not None:
+                self._cache.move_to_end(key)
+            return data
+
+    def _to_cache(self, key, data):
+        with self._lock:
+            if key not in self._cache:
+                self._cache[key] = data
+                self._cached += len(data)
+            while self._cached > CACHE_SIZE and len(self._cache) > 1:
+                _, old = self._cache.popitem(last=False)
+                self._cached -= len(old)
+
+    def __len__(self):
+        return self.size if self.size is not None else self._scanned
+
+    def __getitem__(self, item):
+        begin = max(item.start or 0, 0)
+        end = len(self) if item.stop is None else min(item.stop, len(self))
+        return self.read(begin, end) if begin < end else b""
+
+    def bytes_at(self, positions):
+        """Bytes at an array of offsets, read a page of neighbouring offsets at a time."""
+        positions = np.asarray(positions, dtype=np.int64)
+        out = np.empty(len(positions), dtype=np.uint8)
+        if not len(positions):
+            return out
+        order = np.argsort(positions, kind="stable")
+        ordered = positions[order]
+        bounds = np.flatnonzero(np.diff(ordered // PAGE_SIZE)) + 1
+        for a, b in zip(np.concatenate(([0], bounds)), np.concatenate((bounds, [len(ordered)]))):
+            lo = int(ordered[a])
+            data = np.frombuffer(self.read(lo, int(ordered[b - 1]) + 1), dtype=np.uint8)
+            out[order[a:b]] = data[ordered[a:b] - lo]
+        return out
+
+    def prefetch(self, begin, end):
+        """Decompress a range on a background thread so it is cached by the time it is read."""
+        end = min(end, len(self))
+        if begin < end:
+            self._prefetcher.submit(self.read, begin, end)
+
+    def close(self):
+        self._prefetcher.shutdown(wait=True, cancel_futures=True)
+        self._cache.clear()
+
+
+class BgzfReader(_Reader):
+    """
+    BGZF file, a series of gzip members of at most 64 KiB each. The index
+    keeps where every block starts, compressed and uncompressed, the two
+    halves of a BGZF virtual offset, so any byte is one block away.
+    """
+
+    def __init__(self, data):
+        super().__init__(data)
+        self._compressed_starts = array("q")
+        self._starts = array("q")
+
+    def _inflate(self, pos):
+        size = _bgzf_block_size(self._data, pos)
+        if size is None:
+            raise zlib.error("Not a BGZF block at offset {}".format(pos))
+        xlen = struct.unpack_from("<H", self._data, pos + 10)[0]
+        return size, zlib.decompress(self._data[pos + 12 + xlen:pos + size - 8], -15)
+
+    def chunks(self, chunk_size):
+        """Yield (offset, bytes, fraction scanned, last) over the whole file."""
+        total = len(self._data)
+        pos = upos = start = 0
+        parts = []
+        while pos < total:
+            size, block = self._inflate(pos)
+            self._compressed_starts.append(pos)
+            self._starts.append(upos)
+            pos += size
+            upos += len(block)
+            parts.append(block)
+            if upos - start >= chunk_size or pos >= total:
+                if pos >= total:
+                    self.size = upos
+                self._scanned = upos
+                yield start, np.frombuffer(b"".join(parts), dtype=np.uint8), pos / total, pos >= total
+                start = upos
+                parts = []
+
+    def read(self, begin, end):
+        parts = []
+        i = bisect_right(self._starts, begin) - 1
+        while begin < end and 0 <= i < len(self._starts):
+            block = self._from_cache(i)
+            if block is None:
+                block = self._inflate(self._compressed_starts[i])[1]
+                self._to_cache(i, block)
+            start = self._starts[i]
+            parts.append(block[begin - start:end - start])
+            begin = start + len(block)
+            i += 1
+        return b"".join(parts)
+
+
+class GzipReader(_Reader):
+    """
+    Plain gzip file, which can only be decompressed from the start. As in
+    zlib's zran example, the first scan saves the decompressor state every
+    CHECKPOINT_SPAN bytes of output, so a read starts from the nearest
+    checkpoint instead of the beginning of the file. Reads moving forward
+    carry on from where the last one stopped.
+    """
+
+    def __init__(self, data):
+        super().__init__(data)
+        # (compressed offset, uncompressed offset, decompressor, output not handed out yet)
+        self._checkpoints = [(0, 0, zlib.decompressobj(31), b"")]
+        self._checkpoint_starts = array("q", [0])
+        self._cursor = None
+
+    def _step(self, pos, decompressor):
+        """Feed the next piece of input, returns (output, next offset, decompressor)."""
+        data = self._data[pos:pos + INPUT_SIZE]
+        out = []
+        while data:
+            if decompressor.eof:
+                # Concatenated gzip members, or padding after the last one
+                if not data.strip(b"\0"):
+                    break
+                decompressor = zlib.decompressobj(31)
+            out.append(decompressor.decompress(data))
+            data = decompressor.unused_data if decompressor.eof else b""
+        return b"".join(out), pos + INPUT_SIZE, decompressor
+
+    def chunks(self, chunk_size):
+        """Yield (offset, bytes, fraction scanned, last) over the whole file."""
+        total = len(self._data)
+        pos = upos = start = 0
+        decompressor = zlib.decompressobj(31)
+        following = CHECKPOINT_SPAN
+        parts = []
+        while pos < total:
+            out, pos, decompressor = self._step(pos, decompressor)
+            upos += len(out)
+            parts.append(out)
+            if upos >= following and pos < total:
+                self._checkpoints.append((pos, upos, decompressor.copy(), b""))
+                self._checkpoint_starts.append(upos)
+                following = upos + CHECKPOINT_SPAN
+            if upos - start >= chunk_size or pos >= total:
+                if pos >= total:
+                    self.size = upos
+                self._scanned = upos
+                yield start, np.frombuffer(b"".join(parts), dtype=np.uint8), min(pos / total, 1.0), pos >= total
+                start = upos
+                parts = []
+
+    def _page(self, page):
+        data = self._from_cache(page)
+        if data is not None:
+            return data
+        start = page * PAGE_SIZE
+        stop = start + PAGE_SIZE
+        state = self._checkpoints[bisect_right(self._checkpoint_starts, start) - 1]
+        cursor = self._cursor
+        if cursor is not None and state[1] <= cursor[1] <= start:
+            state = cursor
+        pos, upos, decompressor, out = state
+        decompressor = decompressor.copy()
+
+        pieces = []
+        while True:
+            if upos + len(out) > start:
+                pieces.append(out[max(start - upos, 0):stop - upos])
+            upos += len(out)
+            if upos >= stop or pos >= len(self._data):
+                break
+            out, pos, decompressor = self._step(pos, decompressor)
+        # Whatever was decompressed past the page is where the next page starts
+        if upos > stop:
+            self._cursor = (pos, stop, decompressor, out[len(out) - (upos - stop):])
+        else:
+            self._cursor = (pos, upos, decompressor, b"")
+        data = b"".join(pieces)
+        self._to_cache(page, data)
+        return data
+
+    def read(self, begin, end):
+        parts = []
+        for page in range(begin // PAGE_SIZE, (end - 1) // PAGE_SIZE + 1):
+            data = self._page(page)
+            offset = page * PAGE_SIZE
+            parts.append(data[max(begin - offset, 0):end - offset])
+        return b"".join(parts)
+
+
+def open_reader(data):
+    """Reader for gzip data, BGZF files get the block index."""
+    return BgzfReader(data) if is_bgzf(data) else GzipReader(data)
+
+
+class BgzfWriter(io.RawIOBase):
+    """
+    Compresses what is written into BGZF blocks, the gzip variant bgzip and
+    samtools use. Any gzip reader can read the result, and it can be opened
+    again with random access. Closing writes the end-of-file block and leaves
+    the underlying file open.
+    """
+
+    def __init__(self, raw, level=6):
+        self._raw = raw
+        self._level = level
+        self._buffer = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._buffer += data
+        while len(self._buffer) >= BGZF_BLOCK_DATA:
+            self._write_block(bytes(self._buffer[:BGZF_BLOCK_DATA]))
+            del self._buffer[:BGZF_BLOCK_DATA]
+        return len(data)
+
+    def _write_block(self, data):
+        compressor = zlib.compressobj(self._level, zlib.DEFLATED, -15)
+        deflated = compressor.compress(data) + compressor.flush()
+        header = struct.pack("<4BI2BH2BHH", 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(deflated) + 25)
+        self._raw.write(header + deflated + struct.pack("<II", zlib.crc32(data), len(data)))
+
+    def close(self):
+        if not self.closed:
+            if self._buffer:
+                self._write_block(bytes(self._buffer))
+                self._buffer.clear()
+            self._raw.write(BGZF_EOF)
+        super().close()
@@ -1,6 +1,6 @@
 class Config:
     def __init__(self):
-        self.FILTER_TYPES = "(*.fas *.fa *.fsa);;(*.fastq);;(*.nex *.nxs);;(*.phy);;(*.gb);;(*.txt);;(*.py);;(*.md)"
+        self.FILTER_TYPES = "(*.fas *.fa *.fsa);;(*.fastq);;(*.fas.gz *.fa.gz *.fasta.gz *.fastq.gz *.fq.gz);;(*.nex *.nxs);;(*.phy);;(*.gb);;(*.txt);;(*.py);;(*.md)"
         self.FONT_SIZE = 10
         self.DEFAULT_FONT = "Consolas"
 
@@ -0,0 +1,448 @@
+import io
+import os
+import re
+import tempfile
+import time
+from array import array
+from collections import namedtuple
+
+from compressed import BgzfWriter, is_compressed_path
+from document import Document, set_file_mode
+from formats import FASTA, FASTQ, NEXUS, PHYLIP, GENBANK, PHYLIP_NAME_WIDTH, detect_format, phylip_layout, split_phylip_name
+from instrument import timed
+from records import Record, RecordStore
+
+# Residues per line in FASTA and GenBank output and per block in interleaved output
+LINE_WIDTH = 60
+# Quality given to every base when the source has none (Phred 40)
+DEFAULT_QUALITY = "I"
+# Residues read at a time when writing sequential alignments
+SPILL_CHUNK_SIZE = 1 << 20
+# Bytes of packed sequences kept in memory before they are spilled to a temporary file
+SPILL_BYTES = 1 << 30
+# Residues of all taxa read at a time when writing interleaved alignments
+WINDOW_SIZE = 1 << 24
+WRITE_BUFFER_SIZE = 1 << 20
+
+# Matrix of a NEXUS DATA or CHARACTERS block, see nexus_rows
+NexusMatrix = namedtuple("NexusMatrix", ["names", "rows", "nchar", "ntax", "interleaved", "dimensions"])
+
+_WHITESPACE = str.maketrans("", "", " \t\r\n")
+_ORIGIN = str.maketrans("", "", "0123456789 \t\r\n")
+_NEXUS_COMMENT = re.compile(r"\[[^\]]*\]")
+_NEXUS_NAME = re.compile(r"\s*('(?:[^']|'')*'|\S+)\s*")
+_NEXUS_DIMENSION = re.compile(r"\b(ntax|nchar)\s*=\s*(\d+)")
+_NEXUS_INTERLEAVE = re.compile(r"\binterleave\b(?:\s*=\s*(\w+))?")
+_NEXUS_SAFE_NAME = re.compile(r"[\w.\-]+$")
+
+
+# Readers take a Document and yield Records in file order
+
+def read_fasta(document):
+    name = None
+    parts = []
+    for line in document.iter_lines():
+        if line.startswith(">"):
+            if name is not None:
+                yield Record(name, "".join(parts), None)
+            name = line[1:].rstrip()
+            parts = []
+        elif name is not None:
+            parts.append(line.translate(_WHITESPACE))
+    if name is not None:
+        yield Record(name, "".join(parts), None)
+
+
+def read_fastq(document):
+    lines = document.iter_lines()
+    for header in lines:
+        if not header.strip():
+            continue
+        sequence = next(lines, "").strip()
+        next(lines, None)
+        quality = next(lines, "").strip()
+        yield Record(header.rstrip()[1:], sequence, quality)
+
+
+def read_genbank(document):
+    name = None
+    parts = []
+    in_origin = False
+    for line in document.iter_lines():
+        if line.startswith("LOCUS"):
+            fields = line.split()
+            name = fields[1] if len(fields) > 1 else ""
+            parts = []
+        elif line.startswith("ORIGIN"):
+            in_origin = True
+        elif line.startswith("//"):
+            if name is not None:
+                yield Record(name, "".join(parts), None)
+            name = None
+            in_origin = False
+        elif in_origin:
+            parts.append(line.translate(_ORIGIN))
+
+
+def read_phylip(document):
+    layout = phylip_layout(document)
+    if not layout.valid:
+        raise ValueError(layout.error)
+    if layout.interleaved:
+        # The layout tells which line holds each taxon in every block
+        for taxon in range(layout.num_species):
+            name, first = split_phylip_name(document.line(layout.taxon_line(taxon)), layout.strict)
+            parts = [first.translate(_WHITESPACE)]
+            for block in range(1, len(layout.block_starts)):
+                parts.append(document.line(layout.taxon_line(taxon, block)).translate(_WHITESPACE))
+            yield Record(name, "".join(parts), None)
+    else:
+        ends = layout.taxon_lines[1:] + [len(document)]
+        for start, stop in zip(layout.taxon_lines, ends):
+            lines = document.iter_lines(start, stop)
+            name, first = split_phylip_name(next(lines), layout.strict)
+            parts = [first.translate(_WHITESPACE)]
+            parts.extend(line.translate(_WHITESPACE) for line in lines)
+            yield Record(name, "".join(parts), None)
+
+
+def _nexus_name(text):
+    """Split a matrix row into the unquoted taxon name and the rest of the row."""
+    m = _NEXUS_NAME.match(text)
+    name = m.group(1)
+    if name.startswith("'"):
+        name = name[1:-1].replace("''", "'")
+    return name, text[m.end():]
+
+
+def _nexus_row(line):
+    text = _NEXUS_COMMENT.sub("", line).strip()
+    end = text.endswith(";")
+    return text.rstrip(";").strip(), end
+
+
+def nexus_sequence(line, named):
+    """The sequence part of a matrix line, after the taxon name if the line starts with one."""
+    text, _ = _nexus_row(line)
+    return _nexus_name(text)[1] if named else text
+
+
+def nexus_rows(document):
+    """
+    Lines of the matrix of the DATA or CHARACTERS block as a NexusMatrix:
+    the taxon names in order, the lines of every taxon as an array of n for
+    a line starting with the name and -n-1 for a continuation, NCHAR and
+    NTAX if they are declared, whether the matrix is interleaved and the
+    line of the DIMENSIONS command (None without one).
+    """
+    in_block = in_matrix = interleave = False
+    nchar = ntax = dimensions = None
+    names = []
+    rows = {}
+    current = None
+    remaining = 0
+    for number, line in enumerate(document.iter_lines()):
+        if not in_matrix:
+            text = _NEXUS_COMMENT.sub("", line).strip().lower()
+            if text.startswith("begin"):
+                fields = text.rstrip(";").split()
+                in_block = len(fields) > 1 and fields[1] in ("data", "characters")
+            elif in_block and text.startswith("dimensions"):
+                dimensions = number
+                for key, value in _NEXUS_DIMENSION.findall(text):
+                    if key == "nchar":
+                        nchar = int(value)
+                    else:
+                        ntax = int(value)
+            elif in_block and text.startswith("format"):
+                m = _NEXUS_INTERLEAVE.search(text)
+                interleave = bool(m) and m.group(1) not in ("no", "false")
+            elif in_block and text.startswith("matrix"):
+                in_matrix = True
+            continue
+
+        text, end = _nexus_row(line)
+        if text:
+            if not interleave and current is not None and nchar is not None and remaining > 0:
+                # Sequential rows may wrap over several lines without a name
+                rows[current].append(-number - 1)
+                remaining -= len(text.translate(_WHITESPACE))
+            else:
+                name, rest = _nexus_name(text)
+                if name not in rows:
+                    names.append(name)
+                    rows[name] = array("q")
+                rows[name].append(number)
+                current = name
+                remaining = (nchar or 0) - len(rest.translate(_WHITESPACE))
+        if end:
+            break
+
+    if not in_matrix:
+        raise ValueError("No DATA or CHARACTERS matrix found")
+    return NexusMatrix(names, rows, nchar, ntax, interleave, dimensions)
+
+
+def read_nexus(document):
+    """
+    Read the matrix in two passes: the first one only notes which lines
+    belong to each taxon, the second one joins them up a taxon at a time, so
+    interleaved matrices are not held in memory.
+    """
+    matrix = nexus_rows(document)
+    names, rows = matrix.names, matrix.rows
+    for name in names:
+        parts = []
+        for number in rows[name]:
+            text = nexus_sequence(document.line(number if number >= 0 else -number - 1), number >= 0)
+            parts.append(text.translate(_WHITESPACE))
+        yield Record(name, "".join(parts), None)
+
+
+# Writers take an iterable of Records and a text file
+
+def write_fasta(records, out, width=LINE_WIDTH):
+    for record in records:
+        out.write(">" + record.name + "\n")
+        sequence = record.sequence
+        for i in range(0, len(sequence), width):
+            out.write(sequence[i:i + width] + "\n")
+
+
+def write_fastq(records, out):
+    for record in records:
+        quality = record.quality or DEFAULT_QUALITY * len(record.sequence)
+        out.write("@{}\n{}\n+\n{}\n".format(record.name, record.sequence, quality))
+
+
+def write_genbank(records, out):
+    for record in records:
+        sequence = record.sequence.lower()
+        name = record.name.split()[0] if record.name.strip() else "unnamed"
+        out.write("LOCUS       {:<16} {:>11} bp    DNA\n".format(name, len(sequence)))
+        out.write("DEFINITION  {}\n".format(record.name))
+        out.write("ORIGIN\n")
+        for i in range(0, len(sequence), 60):
+            groups = [sequence[j:j + 10] for j in range(i, min(i + 60, len(sequence)), 10)]
+            out.write("{:>9} {}\n".format(i + 1, " ".join(groups)))
+        out.write("//\n")
+
+
+class _Alignment:
+    """
+    Sequences of the records, for the alignment formats that need the
+    dimensions before the first row and interleaved output that needs every
+    taxon again for each block. They are kept packed in a RecordStore and
+    decoded a slice at a time, or once that takes more than SPILL_BYTES,
+    spilled to a temporary file with an index of where each starts.
+    Shorter sequences read back padded with gaps to the longest one.
+    """
+
+    def __init__(self, records):
+        self.store = RecordStore()
+        self.file = None
+        self.names = []
+        self.offsets = array("q")
+        self.lengths = array("q")
+        for record in records:
+            if self.file is None and self.store.nbytes > SPILL_BYTES:
+                self._spill()
+            if self.file is None:
+                self.store.append(record.name, record.sequence)
+                length = self.store.length(len(self.store) - 1)
+            else:
+                data = record.sequence.encode("ascii", errors="replace")
+                self.offsets.append(self.file.tell())
+                self.file.write(data)
+                length = len(data)
+            self.names.append(record.name)
+            self.lengths.append(length)
+        self.nchar = max(self.lengths, default=0)
+
+    def _spill(self):
+        self.file = tempfile.TemporaryFile()
+        for taxon in range(len(self.store)):
+            self.offsets.append(self.file.tell())
+            self.file.write(self.store.array(taxon).tobytes())
+        self.store = None
+
+    def __len__(self):
+        return len(self.names)
+
+    def sequence(self, taxon, start=0, stop=None):
+        stop = self.nchar if stop is None else stop
+        available = max(0, min(stop, self.lengths[taxon]) - start)
+        if self.file is None:
+            data = self.store.sequence(taxon, start, start + available)
+        else:
+            self.file.seek(self.offsets[taxon] + start)
+            data = self.file.read(available).decode("ascii")
+        return data + "-" * (stop - start - available)
+
+    def chunks(self, taxon):
+        for start in range(0, self.nchar, SPILL_CHUNK_SIZE):
+            yield self.sequence(taxon, start, min(start + SPILL_CHUNK_SIZE, self.nchar))
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+
+def _write_rows(alignment, out, labels, interleaved, width, repeat_labels=False):
+    if not interleaved:
+        for taxon, label in enumerate(labels):
+            out.write(label)
+            for chunk in alignment.chunks(taxon):
+                out.write(chunk)
+            out.write("\n")
+        return
+    blanks = [" " * len(label) for label in labels]
+    # Every taxon is read a window of blocks at a time
+    window = max(1, WINDOW_SIZE // max(1, len(labels)) // width) * width
+    for begin in range(0, alignment.nchar, window):
+        rows = [alignment.sequence(taxon, begin, min(begin + window, alignment.nchar)) for taxon in range(len(labels))]
+        for start in range(begin, min(begin + window, alignment.nchar), width):
+            if start:
+                out.write("\n")
+            for taxon, label in enumerate(labels):
+                out.write((label if start == 0 or repeat_labels else blanks[taxon]) + rows[taxon][start - begin:start - begin + width] + "\n")
+
+
+def write_phylip(records, out, interleaved=False, strict=False, width=LINE_WIDTH):
+    alignment = _Alignment(records)
+    try:
+        if strict:
+            labels = [name[:PHYLIP_NAME_WIDTH].ljust(PHYLIP_NAME_WIDTH) for name in alignment.names]
+        else:
+            names = ["_".join(name.split()) or "unnamed" for name in alignment.names]
+            pad = max((len(name) for name in names), default=0) + 2
+            labels = [name.ljust(pad) for name in names]
+        out.write("{} {}\n".format(len(alignment), alignment.nchar))
+        _write_rows(alignment, out, labels, interleaved, width)
+    finally:
+        alignment.close()
+
+
+def _nexus_label(name):
+    if _NEXUS_SAFE_NAME.match(name):
+        return name
+    return "'" + name.replace("'", "''") + "'"
+
+
+def write_nexus(records, out, interleaved=False, width=LINE_WIDTH):
+    alignment = _Alignment(records)
+    try:
+        names = [_nexus_label(name) for name in alignment.names]
+        pad = max((len(name) for name in names), default=0) + 2
+        out.write("#NEXUS\n\nBEGIN DATA;\n")
+        out.write("    DIMENSIONS NTAX={} NCHAR={};\n".format(len(alignment), alignment.nchar))
+        out.write("    FORMAT DATATYPE=DNA MISSING=? GAP=-{};\n".format(" INTERLEAVE" if interleaved else ""))
+        out.write("    MATRIX\n")
+        # NEXUS names every row of every block
+        _write_rows(alignment, out, ["    " + name.ljust(pad) for name in names], interleaved, width, repeat_labels=True)
+        out.write("    ;\nEND;\n")
+    finally:
+        alignment.close()
+
+
+READERS = {
+    FASTA: read_fasta,
+    FASTQ: read_fastq,
+    NEXUS: read_nexus,
+    PHYLIP: read_phylip,
+    GENBANK: read_genbank,
+}
+
+WRITERS = {
+    FASTA: write_fasta,
+    FASTQ: write_fastq,
+    NEXUS: write_nexus,
+    PHYLIP: write_phylip,
+    GENBANK: write_genbank,
+}
+
+# Targets that can be written a block of every taxon at a time
+INTERLEAVED_FORMATS = (NEXUS, PHYLIP)
+
+
+def write_records(records, target, target_format, interleaved=False):
+    """
+    Write Records to the target path in the given format, through a temporary
+    file that only replaces an existing file once it is complete.
+    """
+    kwargs = {"interleaved": interleaved} if target_format in INTERLEAVED_FORMATS else {}
+    folder = os.path.dirname(os.path.abspath(target))
+    fd, tmp_path = tempfile.mkstemp(dir=folder, prefix=".", suffix=".tmp")
+    try:
+        with open(fd, "wb", buffering=0) as raw:
+            # .gz targets are written as BGZF
+            sink = BgzfWriter(raw) if is_compressed_path(target) else raw
+            with io.TextIOWrapper(io.BufferedWriter(sink, WRITE_BUFFER_SIZE), encoding="utf-8", newline="\n") as out:
+                WRITERS[target_format](records, out, **kwargs)
+        set_file_mode(tmp_path, target)
+        os.replace(tmp_path, target)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class Conversion:
+    """Counts and timing of a finished conversion."""
+
+    def __init__(self, source_bytes):
+        self.records = 0
+        self.residues = 0
+        self.source_bytes = source_bytes
+        self.target_bytes = 0
+        self.seconds = 0.0
+
+    @property
+    def throughput(self):
+        """Source megabytes converted per second."""
+        return self.source_bytes / 1e6 / self.seconds if self.seconds else 0.0
+
+    def __str__(self):
+        return "Converted {} records ({} residues) in {:.2f} s, {:.1f} MB/s".format(
+            self.records, self.residues, self.seconds, self.throughput)
+
+
+@timed("convert")
+def convert(source, target, source_format=None, target_format=None, interleaved=False, progress=None):
+    """
+    Convert a sequence file to another format, a record at a time.
+
+    source is a path or a Document (unsaved edits included), formats default
+    to the ones given by the file extensions. The target is written through a
+    temporary file and only replaces an existing file once it is complete.
+    progress is called with the number of records converted so far.
+    Returns a Conversion with the counts and throughput.
+    """
+    document = source if isinstance(source, Document) else Document(source)
+    source_format = source_format or detect_format(document.path)
+    target_format = target_format or detect_format(target)
+    if source_format not in READERS:
+        raise ValueError("Cannot read {} files".format(source_format or "these"))
+    if target_format not in WRITERS:
+        raise ValueError("Cannot write {} files".format(target_format or "these"))
+
+    conversion = Conversion(document.size)
+    started = time.perf_counter()
+
+    def counted(records):
+        for record in records:
+            conversion.records += 1
+            conversion.residues += len(record.sequence)
+            if progress is not None and conversion.records % 1000 == 0:
+                progress(conversion.records)
+            yield record
+
+    try:
+        write_records(counted(READERS[source_format](document)), target, target_format, interleaved)
+    finally:
+        if document is not source:
+            document.close()
+
+    conversion.seconds = time.perf_counter() - started
+    conversion.target_bytes = os.path.getsize(target)
+    return conversion
@@ -0,0 +1,33 @@
+"""Nucleotide codes: IUPAC ambiguity codes, complements and the genetic code."""
+import numpy as np
+
+# Bases each IUPAC code stands for, as bits A=1, C=2, G=4, T/U=8
+IUPAC = {"A": 1, "C": 2, "G": 4, "T": 8, "U": 8, "R": 5, "Y": 10, "S": 6, "W": 9,
+         "K": 12, "M": 3, "B": 14, "D": 13, "H": 11, "V": 7, "N": 15}
+
+# Base bits of every byte, upper or lower case, 0 for anything else
+BASES = np.zeros(256, dtype=np.uint8)
+for _code, _bits in IUPAC.items():
+    BASES[ord(_code)] = BASES[ord(_code.lower())] = _bits
+
+_CODES = "ACGTURYSWKMBDHVN"
+_COMPLEMENTS = "TGCAAYRSWMKVHDBN"
+# Complement of every IUPAC code, case kept, other characters left alone
+COMPLEMENT = bytes.maketrans((_CODES + _CODES.lower()).encode(), (_COMPLEMENTS + _COMPLEMENTS.lower()).encode())
+# The same for RNA, where A pairs with U
+RNA_COMPLEMENT = COMPLEMENT.translate(bytes.maketrans(b"Tt", b"Uu"))
+TO_RNA = bytes.maketrans(b"Tt", b"Uu")
+TO_DNA = bytes.maketrans(b"Uu", b"Tt")
+
+# Standard genetic code, codons ordered by bases T, C, A, G
+GENETIC_CODE = b"FFLLSSSSYY**CC*WLLLLPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGG"
+# Place of every byte in that order, U as T, 4 for anything else
+CODON_BASES = np.full(256, 4, dtype=np.uint8)
+for _place, _base in enumerate("TCAG"):
+    CODON_BASES[ord(_base)] = CODON_BASES[ord(_base.lower())] = _place
+CODON_BASES[ord("U")] = CODON_BASES[ord("u")] = 0
+
+
+def reverse_complement(sequence):
+    """Reverse complement of a DNA sequence given as a str."""
+    return sequence.encode("ascii").translate(COMPLEMENT)[::-1].decode("ascii")
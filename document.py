@@ -0,0 +1,676 @@
+import copy
+import mmap
+import os
+import shutil
+import tempfile
+import threading
+from array import array
+from bisect import bisect_right
+
+import numpy as np
+
+from compressed import BgzfWriter, is_compressed_path, is_gzip, open_reader
+from instrument import timed
+
+# Bytes scanned per step while building the line index
+INDEX_CHUNK_SIZE = 1 << 24
+# Bytes written per call when saving
+WRITE_CHUNK_SIZE = 1 << 20
+# Bytes copied per system call when saving unchanged regions
+COPY_CHUNK_SIZE = 1 << 30
+# Edited lines joined per write when saving
+WRITE_LINES = 1 << 14
+
+# Piece sources
+ORIGINAL = 0
+ADDED = 1
+SPILLED = 2
+
+
+def _copy_file_range(src, dst, offset, count):
+    return os.copy_file_range(src, dst, count, offset)
+
+
+def _sendfile(src, dst, offset, count):
+    return os.sendfile(dst, src, offset, count)
+
+
+# Ways to copy between files inside the kernel, in order of preference
+KERNEL_COPIES = [copy for name, copy in (("copy_file_range", _copy_file_range), ("sendfile", _sendfile))
+                 if hasattr(os, name)]
+
+
+def split_lines(text):
+    """Split text into lines, newlines included, only at newline characters as the line index does."""
+    lines = text.split("\n")
+    last = lines.pop()
+    lines = [line + "\n" for line in lines]
+    if last:
+        lines.append(last)
+    return lines
+
+
+def set_file_mode(tmp_path, path):
+    """
+    Give a temporary file about to replace path the mode of path, or where
+    there is no such file yet the mode open() would give a new one.
+    """
+    if os.path.exists(path):
+        shutil.copymode(path, tmp_path)
+        return
+    # mkstemp() makes the file readable by its owner only
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(tmp_path, 0o666 & ~umask)
+
+
+class SpillBuffer:
+    """
+    Append-only buffer of edited lines kept in a temporary file as encoded
+    bytes, with the end of every line, for edits too large to hold as
+    strings such as a transform of a whole file. Lines can be added from a
+    worker thread while others are read. The file is only made once the
+    first lines come.
+    """
+
+    def __init__(self):
+        self._file = None
+        self._ends = array("q")
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._ends)
+
+    def append(self, data):
+        """Add the lines of encoded data and return (first, count) of them."""
+        ends = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == 10) + 1
+        if data and not data.endswith(b"\n"):
+            ends = np.append(ends, len(data))
+        with self._lock:
+            if self._file is None:
+                self._file = tempfile.TemporaryFile(buffering=0)
+            base = self._ends[-1] if self._ends else 0
+            view = memoryview(data)
+            while view:
+                view = view[self._file.write(view):]
+            first = len(self._ends)
+            self._ends.extend((ends + base).tolist())
+        return first, len(ends)
+
+    def _range(self, first, count):
+        return self._ends[first - 1] if first else 0, self._ends[first + count - 1]
+
+    def read(self, first, count):
+        """Bytes of lines [first, first + count)."""
+        if not count:
+            return b""
+        begin, end = self._range(first, count)
+        return os.pread(self._file.fileno(), end - begin, begin)
+
+    def write_to(self, out, first, count):
+        """Write lines [first, first + count) to a binary file."""
+        if not count:
+            return
+        begin, end = self._range(first, count)
+        while begin < end:
+            data = os.pread(self._file.fileno(), min(end - begin, WRITE_CHUNK_SIZE), begin)
+            begin += len(data)
+            view = memoryview(data)
+            while view:
+                view = view[out.write(view):]
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+
+
+class EditJournal:
+    """
+    Undo record of edits made inside lines, such as a Replace All. Every
+    entry is where the new text is, as line, column and length, and the text
+    it replaced, so it takes about as much memory as the text replaced
+    rather than copies of the lines. Entries are recorded in document order
+    and only apply to the document version they were made for.
+    """
+
+    def __init__(self):
+        self.lines = array("q")
+        self.columns = array("q")
+        self.lengths = array("q")
+        self._ends = array("q")
+        self._parts = []
+        self._size = 0
+        self.version = None
+
+    def record(self, line, column, length, replaced):
+        self.lines.append(line)
+        self.columns.append(column)
+        self.lengths.append(length)
+        self._parts.append(replaced)
+        self._size += len(replaced)
+        self._ends.append(self._size)
+
+    def __len__(self):
+        return len(self.lines)
+
+    def replaced(self, i):
+        if len(self._parts) > 1:
+            self._parts = ["".join(self._parts)]
+        begin = self._ends[i - 1] if i else 0
+        return self._parts[0][begin:self._ends[i]] if self._parts else ""
+
+    def undo(self, document):
+        """Put the replaced text back, as one edit of the document."""
+        changes = []
+        i = len(self)
+        # Walk back so that the columns of earlier entries on a line stay valid
+        while i > 0:
+            line = self.lines[i - 1]
+            text = document.line(line)
+            while i > 0 and self.lines[i - 1] == line:
+                i -= 1
+                column = self.columns[i]
+                text = text[:column] + self.replaced(i) + text[column + self.lengths[i]:]
+            changes.append((line, text))
+        changes.reverse()
+        document.set_lines(changes)
+
+
+class PieceJournal:
+    """
+    Undo record of an edit of whole ranges of lines, such as a transform of
+    every sequence of a file: the piece list before the edit. The edit
+    buffer is append-only, so the old pieces still show the old lines and
+    keeping them costs nothing like a copy of the text, however many lines
+    changed. It only applies to the document version it was made for.
+    """
+
+    def __init__(self, document):
+        self.pieces = list(document._pieces)
+        self.version = None
+
+    def undo(self, document):
+        """Bring back the lines as they were, as one edit of the document."""
+        document.restore_pieces(self.pieces)
+
+
+class Document:
+    """
+    Line addressable view of a file on disk.
+
+    The file is memory mapped and only the start offset of every line is kept,
+    in a NumPy array, so opening costs a single scan over the bytes and memory
+    grows with the number of lines instead of the size of the file. Lines are
+    decoded on demand when a window of them is requested.
+
+    Edits are kept in a line based piece table: the document is a list of
+    pieces (source, first line, line count) where the source is either the
+    mapped file or an append-only buffer of edited lines. Unmodified regions
+    stay references into the file, so memory only grows with the edits.
+
+    The index can be built on another thread with index=False and
+    build_index(). Lines become part of the document as refresh() is called
+    from the owning thread, the part of the file not indexed yet always
+    follows them and is still written out on save.
+
+    Gzip and BGZF files are read through a decompressing view of the mapped
+    file (see compressed.py), which is indexed while the line index is built.
+    Their size is None until then. Saving to a .gz path writes BGZF.
+    """
+
+    def __init__(self, path, encoding="utf-8", index=True):
+        self.path = path
+        self.encoding = encoding
+        self._file = open(path, "rb")
+        stat = os.fstat(self._file.fileno())
+        self.size = stat.st_size
+        # Size and modification time of the file as opened, to tell when it changed
+        self.stamp = (stat.st_size, stat.st_mtime_ns)
+        if self.size:
+            self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self._data = b""
+        self.compressed = self.size > 0 and is_gzip(self._data)
+        # Uncompressed bytes of the file, sliced like the mapping
+        self._source = open_reader(self._data) if self.compressed else self._data
+        if self.compressed:
+            self.size = None
+
+        # (line starts array, number of starts filled in, number of complete lines),
+        # replaced as a whole so readers on other threads always see a consistent index
+        self._index = (np.zeros(1, dtype=np.int64), 0 if self.size == 0 else 1, 0)
+        self.indexed = self.size == 0
+        self._cancel_index = threading.Event()
+        self._index_lock = threading.Lock()
+
+        self._added = []
+        # Edited lines too many to keep as strings, shared with snapshots
+        self._spilled = SpillBuffer()
+        self._pieces = []
+        self._starts = []
+        self._length = 0
+        # Number of lines of the file already part of the piece table
+        self._adopted = 0
+        # Bumped on every edit, with the first line the last edit touched
+        self.version = 0
+        self.last_edit = 0
+        # Results worked out from the whole document, such as the PHYLIP layout
+        self.analysis = {}
+
+        if index:
+            self.build_index()
+            self.refresh()
+
+    @timed("document.index")
+    def build_index(self, progress=None):
+        """
+        Scan the file for line starts. Safe to run on a worker thread, progress
+        is called with (indexed lines, fraction of bytes scanned) after each chunk.
+        """
+        if self.indexed:
+            return
+        offsets, count, lines = self._index
+        chunks = self._chunks()
+        while True:
+            with self._index_lock:
+                if self._cancel_index.is_set():
+                    return
+                chunk = next(chunks, None)
+                if chunk is None:
+                    break
+                pos, buf, fraction, done = chunk
+                # Every newline starts a new line, except one at the very end
+                starts = np.flatnonzero(buf == 10) + (pos + 1)
+                del buf, chunk
+            if done and self.compressed:
+                self.size = self._source.size
+                if self.size == 0:
+                    count = 0
+            starts = starts[starts < self.size] if done else starts
+
+            if count + len(starts) > len(offsets):
+                grown = np.empty(max(2 * len(offsets), count + len(starts)), dtype=np.int64)
+                grown[:count] = offsets[:count]
+                offsets = grown
+            offsets[count:count + len(starts)] = starts
+            count += len(starts)
+            # The line after the last start found so far may not be complete yet
+            self._index = (offsets, count, count if done else count - 1)
+            if progress is not None:
+                progress(self._index[2], fraction)
+        self.indexed = True
+
+    def _chunks(self):
+        """Yield (offset, byte array, fraction scanned, last) over the whole file."""
+        if self.compressed:
+            yield from self._source.chunks(INDEX_CHUNK_SIZE)
+            return
+        for pos in range(0, self.size, INDEX_CHUNK_SIZE):
+            length = min(INDEX_CHUNK_SIZE, self.size - pos)
+            yield (pos, np.frombuffer(self._data, dtype=np.uint8, count=length, offset=pos),
+                   (pos + length) / self.size, pos + length >= self.size)
+
+    def adopt_index(self, offsets):
+        """
+        Take the start of every line from an index built before for this
+        very file, such as one kept in the cache, instead of scanning it.
+        """
+        with self._index_lock:
+            self._index = (offsets, len(offsets), len(offsets))
+            self.indexed = True
+        self.refresh()
+
+    def cancel_index(self):
+        self._cancel_index.set()
+
+    def refresh(self):
+        """Append the lines indexed since the last call, returns how many were added."""
+        lines = self._index[2]
+        added = lines - self._adopted
+        if added <= 0:
+            return 0
+        source, first, count = self._pieces[-1] if self._pieces else (ADDED, 0, 0)
+        if source == ORIGINAL and first + count == self._adopted:
+            self._pieces[-1] = (source, first, count + added)
+        else:
+            self._pieces.append((ORIGINAL, self._adopted, added))
+            self._starts.append(self._length)
+        self._adopted = lines
+        self._length += added
+        return added
+
+    def __len__(self):
+        return self._length
+
+    @property
+    def line_count(self):
+        return len(self)
+
+    def line_range(self, start, stop):
+        """Byte range covered by lines [start, stop) of the file on disk."""
+        offsets, count, lines = self._index
+        start = max(0, min(start, lines))
+        stop = max(start, min(stop, lines))
+        begin = int(offsets[start]) if start < count else self.size
+        end = int(offsets[stop]) if stop < count else self.size
+        return begin, end
+
+    def line_offsets(self):
+        """Start offset in the file of every indexed line."""
+        offsets, count, lines = self._index
+        return offsets[:lines]
+
+    def bytes_at(self, positions):
+        """Bytes of the file at an array of offsets."""
+        if self.compressed:
+            return self._source.bytes_at(positions)
+        data = np.frombuffer(self._data, dtype=np.uint8)
+        try:
+            return data[positions]
+        finally:
+            del data
+
+    def raw(self, begin, end):
+        return bytes(self._source[begin:end])
+
+    def prefetch(self, start, stop):
+        """Have lines [start, stop) of a compressed file decompressed ahead of being read."""
+        if self.compressed:
+            self._source.prefetch(*self.line_range(start, stop))
+
+    def from_original(self, line):
+        """Line of the document showing the given line of the file, None if it was edited away."""
+        for start, (source, first, count) in zip(self._starts, self._pieces):
+            if source == ORIGINAL and first <= line < first + count:
+                return start + line - first
+        if line >= self._adopted:
+            # Not part of the document yet, it will follow the current last line
+            return self._length + line - self._adopted
+        return None
+
+    def snapshot(self):
+        """
+        Read-only copy of the current state for use from other threads. It
+        shares the mapping and the append-only edit buffer, only the piece
+        list is copied.
+        """
+        snapshot = copy.copy(self)
+        snapshot._pieces = list(self._pieces)
+        snapshot._starts = list(self._starts)
+        return snapshot
+
+    def _original_text(self, start, stop):
+        begin, end = self.line_range(start, stop)
+        return self._source[begin:end].decode(self.encoding, errors="replace")
+
+    def iter_pieces(self, start, stop):
+        """Yield (source, first, count) for the parts of the pieces covering lines [start, stop)."""
+        start = max(0, start)
+        stop = min(stop, self._length)
+        i = max(bisect_right(self._starts, start) - 1, 0)
+        while start < stop and i < len(self._pieces):
+            source, first, count = self._pieces[i]
+            skip = start - self._starts[i]
+            take = min(count - skip, stop - start)
+            yield source, first + skip, take
+            start += take
+            i += 1
+
+    @timed("document.text", lambda self, start, stop: {"lines": stop - start})
+    def text(self, start, stop):
+        """Text of lines [start, stop), newlines included."""
+        parts = []
+        for source, first, count in self.iter_pieces(start, stop):
+            if source == ORIGINAL:
+                parts.append(self._original_text(first, first + count))
+            elif source == SPILLED:
+                parts.append(self._spilled.read(first, count).decode(self.encoding, errors="replace"))
+            else:
+                parts.extend(self._added[first:first + count])
+        return "".join(parts)
+
+    def line(self, index):
+        return self.text(index, index + 1)
+
+    def _split(self, line):
+        """Make line a piece boundary and return the index of the piece starting there."""
+        i = bisect_right(self._starts, line) - 1
+        if i < 0:
+            return 0
+        source, first, count = self._pieces[i]
+        offset = line - self._starts[i]
+        if offset == 0:
+            return i
+        if offset >= count:
+            return i + 1
+        self._pieces[i:i + 1] = [(source, first, offset), (source, first + offset, count - offset)]
+        self._starts.insert(i + 1, line)
+        return i + 1
+
+    def replace_lines(self, start, stop, lines):
+        """Replace lines [start, stop) with the given list of lines."""
+        start = max(0, min(start, self._length))
+        stop = max(start, min(stop, self._length))
+        lines = list(lines)
+        if lines and stop < self._length and not lines[-1].endswith("\n"):
+            # Keep the following line a line of its own
+            lines[-1] += "\n"
+        if lines and start == self._length > 0:
+            last = self.text(start - 1, start)
+            if not last.endswith("\n"):
+                # Lines added past a last line without a newline start a line of their own
+                start -= 1
+                lines.insert(0, last + "\n")
+
+        i = self._split(start)
+        j = self._split(stop)
+        new = []
+        if lines:
+            new.append((ADDED, len(self._added), len(lines)))
+            self._added.extend(lines)
+        self._pieces[i:j] = new
+        self.version += 1
+        self.last_edit = start
+        self._count_pieces()
+
+    def set_lines(self, changes):
+        """
+        Replace single lines, given as (line, text) pairs sorted by line, in
+        one pass over the piece list however many there are. Lines changed
+        one after another share a piece.
+        """
+        changes = [(line, text) for line, text in changes if 0 <= line < self._length]
+        if not changes:
+            return
+        pieces = []
+        k = 0
+        for start, (source, first, count) in zip(self._starts, self._pieces):
+            end = start + count
+            line = start
+            while k < len(changes) and changes[k][0] < end:
+                changed = changes[k][0]
+                if changed > line:
+                    pieces.append((source, first + line - start, changed - line))
+                added = len(self._added)
+                line = changed
+                while k < len(changes) and changes[k][0] == line < end:
+                    self._added.append(changes[k][1])
+                    line += 1
+                    k += 1
+                pieces.append((ADDED, added, line - changed))
+            if line < end:
+                pieces.append((source, first + line - start, end - line))
+        self._pieces = pieces
+        self.version += 1
+        self.last_edit = changes[0][0]
+        self._count_pieces()
+
+    def spill(self, data):
+        """
+        Keep encoded lines in a temporary file rather than in memory and
+        return them as (first, count), to give replace_ranges() in place of
+        a list of lines. Safe to call from a worker thread, on a snapshot.
+        """
+        return self._spilled.append(data)
+
+    def replace_ranges(self, changes):
+        """
+        Replace ranges of lines, given as (start, stop, lines) sorted and not
+        overlapping, in one pass over the piece list however many there are.
+        lines is a list of lines, or (first, count) of lines kept by spill().
+        """
+        pieces = []
+        line = 0
+        for start, stop, lines in changes:
+            start, stop = max(line, min(start, self._length)), max(line, min(stop, self._length))
+            pieces.extend(self.iter_pieces(line, start))
+            if isinstance(lines, tuple):
+                first, count = lines
+                last = self._spilled.read(first + count - 1, 1) if count else b"\n"
+                if stop < self._length and not last.endswith(b"\n"):
+                    # The line after the range has to stay a line of its own
+                    count -= 1
+                    lines = [last.decode(self.encoding, errors="replace") + "\n"]
+                else:
+                    lines = []
+                if count:
+                    pieces.append((SPILLED, first, count))
+            if lines:
+                if stop < self._length and not lines[-1].endswith("\n"):
+                    lines = lines[:-1] + [lines[-1] + "\n"]
+                pieces.append((ADDED, len(self._added), len(lines)))
+                self._added.extend(lines)
+            line = stop
+        pieces.extend(self.iter_pieces(line, self._length))
+        self._pieces = pieces
+        self.version += 1
+        self.last_edit = changes[0][0] if changes else 0
+        self._count_pieces()
+
+    def restore_pieces(self, pieces):
+        """Go back to a piece list taken before edits, see PieceJournal."""
+        self._pieces = list(pieces)
+        self.version += 1
+        self.last_edit = 0
+        self._count_pieces()
+
+    def _count_pieces(self):
+        self._starts = []
+        self._length = 0
+        for _, _, count in self._pieces:
+            self._starts.append(self._length)
+            self._length += count
+
+    def iter_chunks(self, lines_per_chunk=1 << 14, start=0, stop=None):
+        """Yield the document as text, a bounded number of lines at a time."""
+        stop = len(self) if stop is None else min(stop, len(self))
+        for first in range(start, stop, lines_per_chunk):
+            yield self.text(first, min(first + lines_per_chunk, stop))
+
+    def iter_lines(self, start=0, stop=None):
+        """Yield lines [start, stop) one at a time, newlines included."""
+        for chunk in self.iter_chunks(start=start, stop=stop):
+            yield from split_lines(chunk)
+
+    def _regions(self):
+        """
+        Yield the document as (ORIGINAL, begin byte, end byte) ranges of the
+        file, neighbouring pieces merged, and (ADDED or SPILLED, first, count)
+        runs of edited lines.
+        """
+        copy = None
+        for source, first, count in self._pieces:
+            if source == ORIGINAL:
+                begin, end = self.line_range(first, first + count)
+                if copy is not None and copy[1] == begin:
+                    copy = (copy[0], end)
+                    continue
+                if copy is not None:
+                    yield (ORIGINAL,) + copy
+                copy = (begin, end)
+            else:
+                if copy is not None:
+                    yield (ORIGINAL,) + copy
+                    copy = None
+                yield source, first, count
+        # The part of the file not indexed yet follows as it is
+        offsets, count, _ = self._index
+        tail = int(offsets[self._adopted]) if self._adopted < count else self.size
+        if copy is not None and copy[1] == tail:
+            copy = (copy[0], self.size)
+        elif tail < self.size:
+            if copy is not None:
+                yield (ORIGINAL,) + copy
+            copy = (tail, self.size)
+        if copy is not None and copy[0] < copy[1]:
+            yield (ORIGINAL,) + copy
+
+    def _copy_original(self, out, begin, end, copies):
+        """Copy bytes [begin, end) of the file to out, inside the kernel where it can."""
+        while begin < end:
+            count = min(end - begin, COPY_CHUNK_SIZE)
+            copied = 0
+            while copies and not copied:
+                try:
+                    copied = copies[0](self._file.fileno(), out.fileno(), begin, count)
+                except OSError:
+                    copied = 0
+                if not copied:
+                    # Not supported between these files, do not try it again
+                    copies.pop(0)
+            if not copied:
+                copied = out.write(self._source[begin:begin + min(count, WRITE_CHUNK_SIZE)])
+                if not copied:
+                    raise IOError("{} changed while it was being saved".format(self.path))
+            begin += copied
+
+    @timed("document.save")
+    def save(self, path):
+        """
+        Write the document to path through a temporary file in the same folder,
+        so the mapped source stays valid while it is being read and the old
+        file is only replaced once the new one is complete and synced.
+        Unchanged regions are copied straight from the source file, by the
+        kernel where the platform allows, and only edited lines are encoded.
+        """
+        if self.size is None:
+            raise ValueError("{} has to finish loading before it can be saved".format(self.path))
+        folder = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=folder, prefix=".", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb", buffering=0) as f:
+                out = BgzfWriter(f) if is_compressed_path(path) else f
+                # Bytes can only be copied as they are between two uncompressed files
+                copies = list(KERNEL_COPIES) if out is f and not self.compressed else []
+                for source, first, count in self._regions():
+                    if source == ORIGINAL:
+                        self._copy_original(out, first, count, copies)
+                        continue
+                    if source == SPILLED:
+                        self._spilled.write_to(out, first, count)
+                        continue
+                    for start in range(first, first + count, WRITE_LINES):
+                        data = "".join(self._added[start:min(start + WRITE_LINES, first + count)]).encode(self.encoding)
+                        view = memoryview(data)
+                        while view:
+                            view = view[out.write(view):]
+                if out is not f:
+                    out.close()
+                os.fsync(f.fileno())
+            set_file_mode(tmp_path, path)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def close(self):
+        self.cancel_index()
+        if self.compressed:
+            self._source.close()
+        with self._index_lock:
+            if isinstance(self._data, mmap.mmap):
+                self._data.close()
+        self._spilled.close()
+        self._file.close()
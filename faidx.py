@@ -0,0 +1,230 @@
+import os
+import re
+from collections import namedtuple
+
+import numpy as np
+
+from compressed import is_compressed_path
+from formats import FASTQ
+
+# One line of a samtools .fai file, qual_offset is None for FASTA
+FaiEntry = namedtuple("FaiEntry", ["name", "length", "offset", "line_bases", "line_width", "qual_offset"])
+
+_REGION = re.compile(r"^(.+):([\d,]+)(?:-([\d,]+))?$")
+
+
+def fai_path(path):
+    return path + ".fai"
+
+
+def parse_region(text):
+    """Split name:start-end into (name, start, end), 1-based and inclusive, end None if open."""
+    m = _REGION.match(text)
+    if not m:
+        return text, None, None
+    start = int(m.group(2).replace(",", ""))
+    end = int(m.group(3).replace(",", "")) if m.group(3) else None
+    return m.group(1), start, end
+
+
+class FastaIndex:
+    """
+    Record index of a FASTA or FASTQ file, the same as samtools faidx.
+
+    Records are found by name and positions inside them turned into file
+    lines without reading the sequence data, since every record is laid out
+    with a fixed number of bases per line. lines holds the 0-based file line
+    of every record's header.
+
+    A FASTA record whose lines are not all as long as its first, but for the
+    last, cannot be described by a .fai. uneven maps such records to the
+    bases before each of their lines, found when building the index, and an
+    index holding any cannot be written, like samtools faidx refuses to.
+    """
+
+    def __init__(self, entries, file_format, lines=None, uneven=None):
+        self.entries = entries
+        self.file_format = file_format
+        self.uneven = uneven or {}
+        self.names = {entry.name: i for i, entry in enumerate(entries)}
+        if lines is None:
+            if file_format == FASTQ:
+                lines = [4 * i for i in range(len(entries))]
+            else:
+                lines, line = [], 0
+                for entry in entries:
+                    lines.append(line)
+                    line += 1 + (-(-entry.length // entry.line_bases) if entry.line_bases else 0)
+        self.lines = lines
+
+    def __len__(self):
+        return len(self.entries)
+
+    @classmethod
+    def build(cls, document, file_format):
+        """Index a document from the line offsets of the file, it has to be fully indexed."""
+        starts = document.line_offsets()
+        n = len(starts)
+        ends = np.append(starts[1:], document.size)
+        # Bytes of every line without its line ending
+        newline = document.bytes_at(ends - 1) == 10 if n else np.zeros(0, dtype=bool)
+        cr = newline & (ends - 2 >= starts) & (document.bytes_at(np.maximum(ends - 2, 0)) == 13) if n else newline
+        bases = ends - starts - newline - cr
+
+        def name(line):
+            header = document.raw(int(starts[line]) + 1, int(starts[line] + bases[line])).decode(document.encoding, errors="replace")
+            return header.split()[0] if header.strip() else ""
+
+        entries = []
+        if file_format == FASTQ:
+            headers = list(range(0, n - 3, 4))
+            for h in headers:
+                entries.append(FaiEntry(name(h), int(bases[h + 1]), int(starts[h + 1]), int(bases[h + 1]),
+                                        int(ends[h + 1] - starts[h + 1]), int(starts[h + 3])))
+        else:
+            headers = np.flatnonzero(document.bytes_at(starts) == ord(">")).tolist() if n else []
+            total = np.concatenate(([0], np.cumsum(bases)))
+            uneven = {}
+            for i in _uneven_records(headers, bases, ends - starts):
+                h, following = headers[i], headers[i + 1] if i + 1 < len(headers) else n
+                uneven[i] = total[h + 1:following] - total[h + 1]
+            for h, following in zip(headers, headers[1:] + [n]):
+                first = h + 1
+                if first < following:
+                    entries.append(FaiEntry(name(h), int(total[following] - total[first]), int(starts[first]),
+                                            int(bases[first]), int(ends[first] - starts[first]), None))
+                else:
+                    entries.append(FaiEntry(name(h), 0, int(ends[h]), 0, 0, None))
+            return cls(entries, file_format, headers, uneven)
+        return cls(entries, file_format, headers)
+
+    @classmethod
+    def read(cls, path, file_format):
+        entries = []
+        with open(path) as f:
+            for line in f:
+                fields = line.rstrip("\n").split("\t")
+                if len(fields) < 5:
+                    continue
+                qual_offset = int(fields[5]) if len(fields) > 5 else None
+                entries.append(FaiEntry(fields[0], *map(int, fields[1:5]), qual_offset))
+        return cls(entries, file_format)
+
+    def uneven_name(self):
+        """Name of the first record with uneven lines, None if all of them can be indexed."""
+        return self.entries[min(self.uneven)].name if self.uneven else None
+
+    def write(self, path):
+        self._check_writable()
+        with open(path, "w") as f:
+            self.dump(f)
+
+    def _check_writable(self):
+        if self.uneven:
+            raise ValueError("Different line lengths in record {}, it cannot be indexed".format(self.uneven_name()))
+
+    def dump(self, out):
+        """Write the index in .fai format to a text file."""
+        self._check_writable()
+        for entry in self.entries:
+            fields = entry if entry.qual_offset is not None else entry[:5]
+            out.write("\t".join(map(str, fields)) + "\n")
+
+    def end_offset(self):
+        """Offset just past the last record, line ending included, as the index describes it."""
+        if not self.entries:
+            return 0
+        entry = self.entries[-1]
+        if entry.qual_offset is not None:
+            return entry.qual_offset + entry.line_width
+        if not entry.line_bases:
+            return entry.offset
+        full, rest = divmod(entry.length, entry.line_bases)
+        return entry.offset + full * entry.line_width + (rest + entry.line_width - entry.line_bases if rest else 0)
+
+    def locate(self, query):
+        """
+        File position of a record name or a name:start-end region, as
+        (line, column, end line, end column) with 0-based lines and columns.
+        """
+        if query in self.names:
+            name, start, end = query, None, None
+        else:
+            name, start, end = parse_region(query)
+        if name not in self.names:
+            raise ValueError("No record named {}".format(name))
+        i = self.names[name]
+        entry = self.entries[i]
+        header = self.lines[i]
+        if start is None:
+            return header, 0, header, 0
+        if start < 1 or end is not None and end < start or start > entry.length:
+            raise ValueError("Invalid region {}".format(query))
+        end = entry.length if end is None else min(end, entry.length)
+        if self.file_format == FASTQ:
+            return header + 1, start - 1, header + 1, end
+        if i in self.uneven:
+            # Bases before each line of the record, its empty lines skipped by searching from the right
+            before = self.uneven[i]
+            first = int(np.searchsorted(before, start - 1, side="right")) - 1
+            last = int(np.searchsorted(before, end - 1, side="right")) - 1
+            return (header + 1 + first, start - 1 - int(before[first]),
+                    header + 1 + last, end - int(before[last]))
+        line_bases = entry.line_bases or 1
+        return (header + 1 + (start - 1) // line_bases, (start - 1) % line_bases,
+                header + 1 + (end - 1) // line_bases, (end - 1) % line_bases + 1)
+
+
+def _uneven_records(headers, bases, widths):
+    """
+    Numbers of the FASTA records with a line of a length other than that of
+    their first line, bases and width, where the last may only be shorter.
+    """
+    if not headers:
+        return []
+    headers = np.asarray(headers)
+    lines = np.arange(headers[0] + 1, len(bases))
+    record = np.searchsorted(headers, lines, side="right") - 1
+    sequence = lines != headers[record]
+    lines, record = lines[sequence], record[sequence]
+    first = headers[record] + 1
+    last = np.append(headers[1:], len(bases))[record] - 1
+    different = (bases[lines] != bases[first]) | (widths[lines] != widths[first])
+    uneven = np.where(lines == last, bases[lines] > bases[first], different)
+    return np.unique(record[uneven]).tolist()
+
+
+def load_index(path, file_format):
+    """
+    The .fai index saved next to a file, None if there is none or the file
+    changed since. A saved index carries the modification time of its file.
+    """
+    index_path = fai_path(path)
+    try:
+        stat = os.stat(path)
+        if os.stat(index_path).st_mtime_ns != stat.st_mtime_ns:
+            return None
+        index = FastaIndex.read(index_path, file_format)
+    except (OSError, ValueError):
+        return None
+    # The file size has to agree with where the index says the last record ends,
+    # offsets in the index of a compressed file are offsets in its uncompressed data
+    if not is_compressed_path(path) and abs(index.end_offset() - stat.st_size) > 2:
+        return None
+    return index
+
+
+def save_index(index, path):
+    """
+    Write the index next to its file, silently skipped where that is not
+    writable or the index cannot be written as a .fai.
+    """
+    if index.uneven:
+        return
+    index_path = fai_path(path)
+    try:
+        index.write(index_path)
+        stat = os.stat(path)
+        os.utime(index_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    except OSError:
+        pass
@@ -0,0 +1,251 @@
+import re
+
+FASTA = "fasta"
+FASTQ = "fastq"
+NEXUS = "nexus"
+PHYLIP = "phylip"
+GENBANK = "genbank"
+
+EXTENSIONS = {
+    "fa": FASTA,
+    "fas": FASTA,
+    "fsa": FASTA,
+    "fasta": FASTA,
+    "fastq": FASTQ,
+    "fq": FASTQ,
+    "nex": NEXUS,
+    "nxs": NEXUS,
+    "phy": PHYLIP,
+    "gb": GENBANK,
+    "gbk": GENBANK,
+}
+
+
+# Suffixes of compressed files, the format comes from the extension before them
+COMPRESSED_SUFFIXES = (".gz", ".bgz")
+
+
+def extension(path):
+    """Extension of a file, the one before .gz for compressed files."""
+    name = path.lower()
+    for suffix in COMPRESSED_SUFFIXES:
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+    return name.split(".")[-1]
+
+
+def detect_format(path):
+    """Sequence format of a file from its extension, None if it is not one."""
+    return EXTENSIONS.get(extension(path))
+
+
+# Width of the name field in strict PHYLIP
+PHYLIP_NAME_WIDTH = 10
+# Lines analysed while the document is still being indexed
+PHYLIP_SAMPLE_LINES = 1 << 16
+
+_PHYLIP_HEADER = re.compile(r"\s*(\d+)\s+(\d+)")
+_WHITESPACE = str.maketrans("", "", " \t\r\n")
+
+
+def _residues(text):
+    return len(text.translate(_WHITESPACE))
+
+
+def split_phylip_name(line, strict):
+    """Split a line that starts with a taxon name into the name and the sequence part."""
+    if strict:
+        return line[:PHYLIP_NAME_WIDTH].strip(), line[PHYLIP_NAME_WIDTH:]
+    parts = line.split(None, 1)
+    if not parts:
+        return "", ""
+    return parts[0], parts[1] if len(parts) > 1 else ""
+
+
+def _phylip_sequence(line, strict):
+    return split_phylip_name(line, strict)[1]
+
+
+class _Sequential:
+    def __init__(self, strict, ntax, nchar):
+        self.strict = strict
+        self.ntax = ntax
+        self.nchar = nchar
+        self.taxon_lines = []
+        self.remaining = None
+        self.failed = None
+
+    def feed(self, number, line):
+        if len(self.taxon_lines) > self.ntax or len(self.taxon_lines) == self.ntax and self.remaining is None:
+            self.failed = number
+            return
+        if self.remaining is None:
+            self.taxon_lines.append(number)
+            self.remaining = self.nchar - _residues(_phylip_sequence(line, self.strict))
+        else:
+            self.remaining -= _residues(line)
+        if self.remaining < 0:
+            self.failed = number
+        elif self.remaining == 0:
+            self.remaining = None
+
+    def complete(self):
+        return self.failed is None and len(self.taxon_lines) == self.ntax and self.remaining is None
+
+
+class _Interleaved:
+    def __init__(self, strict, ntax, nchar):
+        self.strict = strict
+        self.ntax = ntax
+        self.nchar = nchar
+        self.taxon_lines = []
+        self.block_starts = []
+        self.lengths = [0] * ntax
+        self.count = 0
+        self.failed = None
+
+    def feed(self, number, line):
+        taxon = self.count % self.ntax
+        if taxon == 0:
+            self.block_starts.append(number)
+        if self.count < self.ntax:
+            self.taxon_lines.append(number)
+            self.lengths[taxon] += _residues(_phylip_sequence(line, self.strict))
+        else:
+            self.lengths[taxon] += _residues(line)
+        if self.lengths[taxon] > self.nchar:
+            self.failed = number
+        self.count += 1
+
+    def complete(self):
+        return self.failed is None and self.count % self.ntax == 0 and all(n == self.nchar for n in self.lengths)
+
+
+class PhylipLayout:
+    """
+    Layout of a PHYLIP file, worked out from the whole file in one pass.
+
+    Tells strict (10 character name field) from relaxed names and sequential
+    from interleaved data, and records the line each taxon's name is on and
+    the first line of every interleaved block. Lines are 0-based document lines.
+    """
+
+    def __init__(self):
+        self.num_species = None
+        self.seq_length = None
+        self.header_line = None
+        self.strict = False
+        self.interleaved = False
+        self.valid = False
+        self.error = None
+        # Line the error was found on, None when it is about the whole file
+        self.error_line = None
+        self.taxon_lines = []
+        self.block_starts = []
+        self.name_lines = frozenset()
+
+    @classmethod
+    def analyze(cls, lines):
+        """Build the layout from an iterable of lines."""
+        layout = cls()
+        hypotheses = None
+        for number, line in enumerate(lines):
+            if not line.strip():
+                continue
+            if hypotheses is None:
+                m = _PHYLIP_HEADER.match(line)
+                if not m or int(m.group(1)) == 0:
+                    layout.error = "Invalid PHYLIP header on line {}".format(number + 1)
+                    layout.error_line = number
+                    return layout
+                layout.header_line = number
+                layout.num_species = int(m.group(1))
+                layout.seq_length = int(m.group(2))
+                # Preferred first when more than one reading fits the data
+                hypotheses = [kind(strict, layout.num_species, layout.seq_length)
+                              for kind in (_Sequential, _Interleaved) for strict in (True, False)]
+                continue
+            alive = [h for h in hypotheses if h.failed is None]
+            if not alive:
+                break
+            for hypothesis in alive:
+                hypothesis.feed(number, line)
+
+        if hypotheses is None:
+            layout.error = "Missing PHYLIP header"
+            return layout
+
+        complete = [h for h in hypotheses if h.complete()]
+        if complete:
+            best = complete[0]
+            layout.valid = True
+        else:
+            # Best guess for display: the reading that held out longest
+            best = max(hypotheses, key=lambda h: float("inf") if h.failed is None else h.failed)
+            layout.error = "Sequence data does not match the PHYLIP header"
+            layout.error_line = best.failed
+        layout.strict = best.strict
+        layout.interleaved = isinstance(best, _Interleaved)
+        layout.taxon_lines = best.taxon_lines
+        layout.block_starts = getattr(best, "block_starts", [])
+        layout.name_lines = frozenset(best.taxon_lines)
+        return layout
+
+    @property
+    def type(self):
+        """SS, SI, RS or RI for strict/relaxed sequential/interleaved."""
+        if self.num_species is None:
+            return None
+        return ("S" if self.strict else "R") + ("I" if self.interleaved else "S")
+
+    def is_name_line(self, line):
+        return line in self.name_lines
+
+    def name_length(self, line):
+        """Length of the name field at the start of a name line."""
+        if self.strict:
+            return min(PHYLIP_NAME_WIDTH, len(line.rstrip("\r\n")))
+        stripped = line.lstrip()
+        return len(line) - len(stripped) + len(stripped.split(None, 1)[0]) if stripped else 0
+
+    def taxon_line(self, taxon, block=0):
+        """Line holding the data of a taxon in the given interleaved block."""
+        if self.interleaved:
+            return self.block_starts[block] + taxon
+        return self.taxon_lines[taxon]
+
+
+def _layout_lines(document):
+    # While the document is still being indexed only its first lines are sampled
+    return len(document) if document.indexed else min(len(document), PHYLIP_SAMPLE_LINES)
+
+
+def cached_phylip_layout(document):
+    """
+    The last layout worked out for a PHYLIP document and whether it still
+    holds, (None, False) if there is none. Never reads more than the first
+    line, so it can be asked on every repaint.
+    """
+    cached = document.analysis.get(PHYLIP)
+    if cached is None:
+        return None, False
+    key, header, layout = cached
+    return layout, key == (_layout_lines(document), document.indexed) and header == document.line(0)
+
+
+def phylip_layout(document):
+    """
+    Layout of a PHYLIP document, cached on the document.
+
+    The layout only depends on the header and the line structure, so it is
+    reused until the line count changes or an edit touches the header.
+    Working it out reads the whole document, so it is done off the GUI
+    thread, see cached_phylip_layout().
+    """
+    layout, current = cached_phylip_layout(document)
+    if current:
+        return layout
+    stop = _layout_lines(document)
+    layout = PhylipLayout.analyze(document.iter_lines(0, stop))
+    document.analysis[PHYLIP] = ((stop, document.indexed), document.line(0), layout)
+    return layout
@@ -0,0 +1,146 @@
+"""
+Timing spans around the hot paths of the editor.
+
+Spans are recorded only while instrumentation is enabled, with the
+SEQUENCE_EDITOR_TRACE environment variable or from the Tools menu.
+Disabled, a span costs a flag check. Recorded spans can be exported in the
+Chrome trace format, to be opened in chrome://tracing or Perfetto, and the
+last one of every name is kept for the live overlay.
+
+SEQUENCE_EDITOR_PROFILE=path additionally runs the whole session under
+cProfile and writes the statistics to path on exit.
+"""
+import atexit
+import cProfile
+import functools
+import json
+import os
+import threading
+import time
+from collections import deque
+
+TRACE_VARIABLE = "SEQUENCE_EDITOR_TRACE"
+PROFILE_VARIABLE = "SEQUENCE_EDITOR_PROFILE"
+# Spans kept for export, the oldest are dropped past this
+MAX_EVENTS = 1 << 18
+
+enabled = False
+# Chrome trace "complete" events
+events = deque(maxlen=MAX_EVENTS)
+# Last (duration in seconds, args) of every span name
+last = {}
+_origin = time.perf_counter()
+_profiler = None
+
+
+def enable(on=True):
+    global enabled
+    enabled = on
+
+
+class _Span:
+    __slots__ = ("name", "args", "start")
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record(self.name, self.start, time.perf_counter(), self.args)
+
+    def set(self, **args):
+        self.args.update(args)
+
+
+class _NoSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def set(self, **args):
+        pass
+
+
+_NO_SPAN = _NoSpan()
+
+
+def span(name, **args):
+    """
+    Context manager timing its body. args end up in the trace, more can be
+    added with set() on the span inside the body.
+    """
+    return _Span(name, args) if enabled else _NO_SPAN
+
+
+def record(name, start, stop, args=None):
+    events.append({"name": name, "ph": "X", "pid": os.getpid(), "tid": threading.get_ident(),
+                   "ts": (start - _origin) * 1e6, "dur": (stop - start) * 1e6, "args": args or {}})
+    last[name] = (stop - start, args or {})
+
+
+def timed(name, describe=None):
+    """
+    Decorator timing every call as a span. describe(*args) returns the span
+    arguments and is only called while enabled.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                record(name, start, time.perf_counter(), describe(*args) if describe else None)
+        return wrapper
+    return decorator
+
+
+def clear():
+    events.clear()
+    last.clear()
+
+
+def export(path):
+    """Write the recorded spans as a Chrome trace file."""
+    with open(path, "w") as f:
+        json.dump({"traceEvents": list(events), "displayTimeUnit": "ms"}, f)
+
+
+def profiling():
+    return _profiler is not None
+
+
+def start_profile():
+    global _profiler
+    if _profiler is None:
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+
+
+def stop_profile(path=None):
+    """Stop profiling, writing the statistics to path for pstats or snakeviz."""
+    global _profiler
+    profiler, _profiler = _profiler, None
+    if profiler is None:
+        return None
+    profiler.disable()
+    if path:
+        profiler.dump_stats(path)
+    return profiler
+
+
+if os.environ.get(TRACE_VARIABLE, "") not in ("", "0"):
+    enable()
+if os.environ.get(PROFILE_VARIABLE):
+    start_profile()
+    atexit.register(stop_profile, os.environ[PROFILE_VARIABLE])
@@ -1,8 +1,54 @@
 import re
 from config import config
+from formats import PhylipLayout, cached_phylip_layout
+from instrument import timed
 
 from PyQt5.QtGui import QFont, QColor
-from PyQt5.Qsci import QsciLexerPython, QsciLexerMarkdown, QsciLexerCustom
+from PyQt5.Qsci import QsciLexerPython, QsciLexerMarkdown, QsciLexerCustom, QsciScintilla
+
+
+def styled_bytes(lexer, start, end):
+    """Raw bytes of the editor between start and end, as Scintilla positions count them."""
+    return bytes(lexer.parent().bytes(start, end))[:end - start]
+
+
+def _styled_range(lexer, start, end):
+    editor = lexer.parent()
+    lines = (editor.SendScintilla(QsciScintilla.SCI_LINEFROMPOSITION, end)
+             - editor.SendScintilla(QsciScintilla.SCI_LINEFROMPOSITION, start) + 1)
+    return {"lexer": type(lexer).__name__, "bytes": end - start, "lines": lines}
+
+
+class StyleEngine:
+    """
+    Classify a range of text into styles in a single pass.
+
+    Every byte gets a style from a 256 entry translation table, then the rules,
+    byte regexes for things like whole header lines, overwrite the spans they
+    match. The resulting style buffer is handed to Scintilla in one call.
+    """
+
+    def __init__(self, chars=None, rules=(), default=0):
+        table = bytearray([default]) * 256
+        for letters, style in (chars or {}).items():
+            for byte in letters.encode():
+                table[byte] = style
+        self.table = bytes(table)
+        self.rules = list(rules)
+
+    def classify(self, data):
+        styles = bytearray(data.translate(self.table))
+        for pattern, style in self.rules:
+            for m in pattern.finditer(data):
+                styles[m.start():m.end()] = bytes([style]) * (m.end() - m.start())
+        return styles
+
+    def apply(self, lexer, start, styles):
+        lexer.startStyling(start)
+        lexer.parent().SendScintilla(QsciScintilla.SCI_SETSTYLINGEX, len(styles), bytes(styles))
+
+    def style(self, lexer, start, end):
+        self.apply(lexer, start, self.classify(styled_bytes(lexer, start, end)))
 
 
 class PythonLexer(QsciLexerPython):
@@ -37,13 +83,12 @@ class FastaLexer(QsciLexerCustom):
         self.setColor(QColor("#C411C7"), 5)
         self.setFont(QFont(config.DEFAULT_FONT, config.FONT_SIZE, weight=QFont.Bold), 5)
 
-        self.rules = [
-            (re.compile(r"[Aa]", re.MULTILINE), 2),
-            (re.compile(r"[Tt]", re.MULTILINE), 3),
-            (re.compile(r"[Cc]", re.MULTILINE), 4),
-            (re.compile(r"[Gg]", re.MULTILINE), 5),
-            (re.compile(r"^>[^\n]*", re.MULTILINE), 1),  # style 1
-        ]
+        self.engine = StyleEngine(
+            chars={"Aa": 2, "Tt": 3, "Cc": 4, "Gg": 5},
+            rules=[
+                (re.compile(rb"^>[^\n]*", re.MULTILINE), 1),  # style 1
+            ],
+        )
 
     def language(self):
         return "Fasta"
@@ -51,19 +96,9 @@ class FastaLexer(QsciLexerCustom):
     def description(self, style):
         return f"style_{style}"
 
+    @timed("style", _styled_range)
     def styleText(self, start, end):
-        text = self.parent().text()[start:end]
-
-        highlights = []
-        for rule in self.rules:
-            highlights += [
-                (m.start(0), len(bytearray(m.group(0), "utf-8")), rule[1])
-                for m in re.finditer(rule[0], text)
-            ]
-
-        for highlight in highlights:
-            self.startStyling(start + highlight[0])
-            self.setStyling(highlight[1], highlight[2])
+        self.engine.style(self, start, end)
 
 
 class FastqLexer(QsciLexerCustom):
@@ -78,12 +113,12 @@ class FastqLexer(QsciLexerCustom):
         self.setColor(QColor("#3c8aa7"), 2)  # blue
         self.setFont(QFont(config.DEFAULT_FONT, config.FONT_SIZE, weight=QFont.Bold), 2)
 
-        self.rules = [
+        self.engine = StyleEngine(rules=[
             # From '@' until a newline
-            (re.compile(r"^@[^\n]*", re.MULTILINE), 1),  # style 1
+            (re.compile(rb"^@[^\n]*", re.MULTILINE), 1),  # style 1
             # From '+' until a newline
-            (re.compile(r"^\+[^\n]*", re.MULTILINE), 2),  # style 2
-        ]
+            (re.compile(rb"^\+[^\n]*", re.MULTILINE), 2),  # style 2
+        ])
 
     def language(self):
         return "Fastq"
@@ -91,20 +126,12 @@ class FastqLexer(QsciLexerCustom):
     def description(self, style):
         return f"style_{style}"
 
+    @timed("style", _styled_range)
     def styleText(self, start, end):
+        self.engine.style(self, start, end)
 
-        text = self.parent().text()[start:end]
-
-        highlights = []
-        for rule in self.rules:
-            highlights += [
-                (m.start(0), len(bytearray(m.group(0), "utf-8")), rule[1])
-                for m in re.finditer(rule[0], text)
-            ]
 
-        for highlight in highlights:
-            self.startStyling(start + highlight[0])
-            self.setStyling(highlight[1], highlight[2])
+_PHYLIP_STYLES = StyleEngine()
 
 
 class PhylipLexer(QsciLexerCustom):
@@ -119,18 +146,12 @@ class PhylipLexer(QsciLexerCustom):
         self.setColor(QColor("#f04a3e"), 2)  # blue
         self.setFont(QFont(config.DEFAULT_FONT, config.FONT_SIZE, weight=QFont.Bold), 2)
 
-        # Extract metadata from Phylip files, useful for lexer
-        metadata = self.parent().text()[0:100].split('\n')[0].split(' ')
-
-        self.num_species = int(metadata[0])
-        self.seq_length = int(metadata[1])
-
-        self.rules = [
-            [re.compile(r"^.+ ", re.MULTILINE), 1],
-            (re.compile(r'^[0-9]+ [0-9]+$', re.MULTILINE), 2),
-        ]
-
-        self.type = None
+        # Layout of the whole file, set along with the first visible line
+        self.layout = PhylipLayout()
+        self._document = None
+        self.first_line = 0
+        self.num_species = None
+        self.seq_length = None
 
     def language(self):
         return "Phylip"
@@ -138,10 +159,10 @@ class PhylipLexer(QsciLexerCustom):
     def description(self, style):
         return f"style_{style}"
 
-    def classify_type(self, text):
-
+    @property
+    def type(self):
         """
-        Classify Phylip style as:
+        Phylip style of the file:
 
         1. Strict Sequential (SS)
         2. Strict Interleaved (SI)
@@ -149,48 +170,167 @@ class PhylipLexer(QsciLexerCustom):
         4. Relaxed Interleaved (RI)
 
         """
+        return self.layout.type
 
-        self.type = None
-
-        lines = text.strip().split('\n')
-
-        # TODO: handle all text, not just visible on screen
-
-        if len(lines) - 1 == self.num_species:
-            # Sequential Format
-
-            # Check for lengths in each sequence
-            lengths = [len(line) for line in lines[1:]]
-
-            # Strict must have all lines of equal length, i.e. sequence length + 10
-            if all(line == self.seq_length + 10 for line in lengths):
-                # Strict Format
-
-                self.type = 'SS'
-            else:
-                self.type = 'RS'
-
-        print('type', self.type)
-
+    def set_context(self, document, first_line):
+        """
+        Style with the last layout worked out for the document. Returns True
+        when it no longer holds, for the caller to work it out again with
+        formats.phylip_layout() off the GUI thread.
+        """
+        layout, current = cached_phylip_layout(document)
+        if layout is not None:
+            self.layout = layout
+        elif document is not self._document:
+            self.layout = PhylipLayout()
+        self._document = document
+        self.first_line = first_line
+        self.num_species = self.layout.num_species
+        self.seq_length = self.layout.seq_length
+        return not current
+
+    @timed("style", _styled_range)
     def styleText(self, start, end):
+        editor = self.parent()
+        line = self.first_line + editor.SendScintilla(QsciScintilla.SCI_LINEFROMPOSITION, start)
+        pos = editor.SendScintilla(QsciScintilla.SCI_POSITIONFROMLINE, line - self.first_line)
+        data = styled_bytes(self, pos, end)
+
+        styles = bytearray(len(data))
+        offset = 0
+        for text in data.split(b"\n"):
+            if line == self.layout.header_line:
+                length = len(text.rstrip())
+                styles[offset:offset + length] = b"\x02" * length
+            elif self.layout.is_name_line(line):
+                # Decoded one byte per character so the length counts bytes
+                length = self.layout.name_length(text.decode("latin-1"))
+                styles[offset:offset + length] = b"\x01" * length
+            offset += len(text) + 1
+            line += 1
+        _PHYLIP_STYLES.apply(self, pos, styles)
+
+
+# NEXUS lexer state kept per line: block type, inside MATRIX, comment depth
+# and whether a block name is expected after 'begin'
+NEXUS_BLOCKS = {b"taxa": 1, b"characters": 2, b"data": 2, b"unaligned": 2,
+                b"trees": 3, b"sets": 4, b"assumptions": 5}
+NEXUS_OTHER_BLOCK = 6
+NEXUS_BLOCK_MASK = 0x7
+NEXUS_IN_MATRIX = 0x8
+NEXUS_COMMENT_SHIFT = 4
+NEXUS_COMMENT_MASK = 0xF0
+NEXUS_AFTER_BEGIN = 0x100
+# Set on every stored line state, tells styled lines apart from new ones
+NEXUS_STYLED = 0x200
+
+NEXUS_KEYWORDS = {b"dimensions", b"format", b"matrix", b"charset", b"outgroup", b"taxlabels",
+                  b"translate", b"tree", b"charstatelabels", b"exset", b"taxset"}
+NEXUS_PARAMETERS = {b"ntax", b"nchar", b"datatype", b"gap", b"missing", b"interleave",
+                    b"symbols", b"equate", b"matchchar", b"respectcase"}
+
+_NEXUS_TOKEN = re.compile(rb"\[|;|=|'(?:[^']|'')*'|[^\s\[\];=']+")
+_NEXUS_COMMENT_DELIMITER = re.compile(rb"[\[\]]")
+# Taxon name at the start of a matrix row, followed by its sequence
+_NEXUS_ROW = re.compile(rb"[ \t]*('(?:[^']|'')*'|[^\s\[;']+)(?=[ \t]+[^\s;\[])")
+
+_NEXUS_BASES = StyleEngine(chars={"Aa": 2, "Tt": 3, "Cc": 4, "Gg": 5, "Nn": 6})
+
+
+def nexus_lex_line(data, state, styles=None):
+    """
+    Lex one line of NEXUS starting in state and return the state at its end.
+    If styles, a bytearray as long as data, is given it is filled in.
+    """
+    block = state & NEXUS_BLOCK_MASK
+    matrix = state & NEXUS_IN_MATRIX
+    depth = (state & NEXUS_COMMENT_MASK) >> NEXUS_COMMENT_SHIFT
+    after_begin = state & NEXUS_AFTER_BEGIN
+
+    if matrix and not depth and b"[" not in data and b";" not in data:
+        # Plain matrix row, styled with one translation
+        if styles is not None:
+            styles[:] = data.translate(_NEXUS_BASES.table)
+            m = _NEXUS_ROW.match(data)
+            if m:
+                styles[m.start(1):m.end(1)] = b"\x01" * (m.end(1) - m.start(1))
+        return state
+
+    pos = 0
+    value = False
+    row_start = True
+    while pos < len(data):
+        if depth:
+            m = _NEXUS_COMMENT_DELIMITER.search(data, pos)
+            stop = m.end() if m else len(data)
+            if styles is not None:
+                styles[pos:stop] = b"\x06" * (stop - pos)
+            if m:
+                depth += 1 if m.group() == b"[" else -1
+            pos = stop
+            continue
+
+        m = _NEXUS_TOKEN.search(data, pos)
+        if not m:
+            break
+        token = m.group()
+        start, pos = m.span()
+        style = 0
+        if token == b"[":
+            depth = 1
+            style = 6
+        elif token == b";":
+            matrix = 0
+            after_begin = 0
+            style = 3
+        elif matrix:
+            if row_start and _NEXUS_ROW.match(data, start):
+                style = 1
+            elif styles is not None:
+                styles[start:pos] = token.translate(_NEXUS_BASES.table)
+        elif after_begin:
+            block = NEXUS_BLOCKS.get(token.lower(), NEXUS_OTHER_BLOCK)
+            after_begin = 0
+            style = 3
+        else:
+            word = token.lower()
+            if word == b"begin":
+                after_begin = NEXUS_AFTER_BEGIN
+                style = 3
+            elif word in (b"end", b"endblock"):
+                block = 0
+                style = 3
+            elif word == b"#nexus":
+                style = 3
+            elif word in NEXUS_KEYWORDS:
+                if word == b"matrix":
+                    matrix = NEXUS_IN_MATRIX
+                style = 7
+            elif word in NEXUS_PARAMETERS:
+                style = 8
+            elif token == b"=" or value:
+                style = 2
+        value = token == b"="
+        row_start = False
+        if style and styles is not None:
+            styles[start:pos] = bytes([style]) * (pos - start)
+
+    return block | matrix | (min(depth, 15) << NEXUS_COMMENT_SHIFT) | after_begin
 
-        text = self.parent().text()[start:end]
 
-        phylip_type = self.classify_type(text)
-
-        highlights = []
-        for rule in self.rules:
-            highlights += [
-                (m.start(0), len(bytearray(m.group(0), "utf-8")), rule[1])
-                for m in re.finditer(rule[0], text)
-            ]
-
-        for highlight in highlights:
-            self.startStyling(start + highlight[0])
-            self.setStyling(highlight[1], highlight[2])
+class NexusLexer(QsciLexerCustom):
+    """
+    Incremental NEXUS lexer.
 
+    The state at the end of every line (block, inside MATRIX, inside a comment)
+    is stored as the Scintilla line state, so a restyle starts at the edited
+    line from the state of the line above and stops as soon as a line ends in
+    the state it had before. The state of the first line of the viewport comes
+    from checkpoints over the document lines above it.
+    """
 
-class NexusLexer(QsciLexerCustom):
+    # Lines between two cached document states
+    CHECKPOINT_LINES = 1024
 
     def __init__(self, parent):
         super(NexusLexer, self).__init__(parent)
@@ -227,20 +367,11 @@ class NexusLexer(QsciLexerCustom):
         self.setColor(QColor("#7A1919"), 8)
         self.setFont(QFont(config.DEFAULT_FONT, config.FONT_SIZE, weight=QFont.Bold), 8)
 
-        self.rules = [
-            (re.compile(r"[A]", re.MULTILINE), 2),
-            (re.compile(r"[T]", re.MULTILINE), 3),
-            (re.compile(r"[C]", re.MULTILINE), 4),
-            (re.compile(r"[G]", re.MULTILINE), 5),
-            (re.compile(r"[N]", re.MULTILINE), 6),
-            (re.compile(r"(#NEXUS|end|;)", re.MULTILINE | re.IGNORECASE), 3),
-            (re.compile(r"\=\{?[0-9A-Z_!@#$*?-]+\}?", re.MULTILINE), 2),
-            (re.compile(r"^(begin).*;", re.MULTILINE | re.IGNORECASE), 3),
-            (re.compile(r"(dimensions|format|matrix|charset|outgroup)", re.MULTILINE | re.IGNORECASE), 7),
-            (re.compile(r"(ntax|nchar|datatype|gap|missing|interleave)", re.MULTILINE | re.IGNORECASE), 8),
-            (re.compile(r"^\[.*\]", re.MULTILINE), 6),
-
-        ]
+        # State at the start of the first line in the editor
+        self.first_state = 0
+        self._document = None
+        self._version = None
+        self._checkpoints = {0: 0}
 
     def language(self):
         return "Nexus"
@@ -248,16 +379,78 @@ class NexusLexer(QsciLexerCustom):
     def description(self, style):
         return f"style_{style}"
 
+    def set_context(self, document, first_line):
+        """Called before the viewport shows document lines from first_line on."""
+        if document is not self._document:
+            self._document = document
+            self._checkpoints = {0: 0}
+        elif document.version != self._version:
+            # Only states after the edited line can have changed
+            keep = document.last_edit if document.version == self._version + 1 else 0
+            self._checkpoints = {line: state for line, state in self._checkpoints.items() if line <= keep}
+        self._version = document.version
+        self.first_state = self.state_at(first_line)
+
+    def state_at(self, line):
+        step = self.CHECKPOINT_LINES
+        checkpoint = line - line % step
+        while checkpoint not in self._checkpoints:
+            checkpoint -= step
+        state = self._checkpoints[checkpoint]
+        while checkpoint < line:
+            stop = min(checkpoint + step, line)
+            text = self._document.text(checkpoint, stop).encode(self._document.encoding)
+            for data in text.splitlines(keepends=True):
+                state = nexus_lex_line(data, state)
+            checkpoint = stop
+            if checkpoint % step == 0:
+                self._checkpoints[checkpoint] = state
+        return state
+
+    @timed("style", _styled_range)
     def styleText(self, start, end):
-        text = self.parent().text()[start:end]
-
-        highlights = []
-        for rule in self.rules:
-            highlights += [
-                (m.start(0), len(bytearray(m.group(0), "utf-8")), rule[1])
-                for m in re.finditer(rule[0], text)
-            ]
-
-        for highlight in highlights:
-            self.startStyling(start + highlight[0])
-            self.setStyling(highlight[1], highlight[2])
+        editor = self.parent()
+        line = editor.SendScintilla(QsciScintilla.SCI_LINEFROMPOSITION, start)
+        pos = editor.SendScintilla(QsciScintilla.SCI_POSITIONFROMLINE, line)
+        if line:
+            state = editor.SendScintilla(QsciScintilla.SCI_GETLINESTATE, line - 1) & ~NEXUS_STYLED
+        else:
+            state = self.first_state
+        lines = editor.lines()
+        length = editor.length()
+
+        first = pos
+        styles = bytearray()
+        settled = False
+        # Past the requested range only keep going until the state settles
+        while line < lines and (pos < end or not settled):
+            next_pos = editor.SendScintilla(QsciScintilla.SCI_POSITIONFROMLINE, line + 1) if line + 1 < lines else length
+            previous = editor.SendScintilla(QsciScintilla.SCI_GETLINESTATE, line)
+            # Inserted lines copy the state of the line they were inserted at,
+            # so only lines past the requested range can be taken as styled
+            if settled and pos >= end and previous & NEXUS_STYLED:
+                # Same state as last time up to here, the styles of this line still hold
+                state = previous & ~NEXUS_STYLED
+                line += 1
+                pos = next_pos
+                continue
+            if first + len(styles) < pos:
+                # Resume after the lines skipped
+                _NEXUS_BASES.apply(self, first, styles)
+                first = pos
+                styles = bytearray()
+
+            data = styled_bytes(self, pos, next_pos)
+            line_styles = bytearray(len(data))
+            state = nexus_lex_line(data, state, line_styles)
+            styles += line_styles
+            editor.SendScintilla(QsciScintilla.SCI_SETLINESTATE, line, state | NEXUS_STYLED)
+            settled = previous == state | NEXUS_STYLED
+            line += 1
+            pos = next_pos
+
+        if styles:
+            _NEXUS_BASES.apply(self, first, styles)
+        if pos > first + len(styles):
+            # Mark the skipped lines as styled
+            self.startStyling(pos)
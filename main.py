@@ -1,5 +1,7 @@
 import sys, os
-import subprocess
+import importlib.util
+from bisect import bisect_left
+import tempfile
 from PyQt5.QtWidgets import (
     QApplication,
     QMainWindow,
@@ -8,51 +10,525 @@ from PyQt5.QtWidgets import (
     QDialog,
     QLabel,
     QScrollBar,
+    QProgressBar,
+    QPushButton,
+    QDockWidget,
+    QVBoxLayout,
+    QListWidget,
+    QListWidgetItem,
     qApp,
 )
-import platform
 
 from PyQt5.QtCore import *
-from PyQt5.QtGui import QIcon, QFont, QColor, QBrush, QWheelEvent
+from PyQt5.QtGui import QIcon, QFont, QColor, QBrush, QWheelEvent, QPainter
 from PyQt5.QtWidgets import (QApplication, QWidget, QInputDialog, QRadioButton,
-                             QLineEdit, QDialogButtonBox, QFormLayout)
+                             QLineEdit, QDialogButtonBox, QFormLayout, QCheckBox, QSpinBox)
 
-from PyQt5.uic import loadUiType
+from PyQt5 import sip
 from PyQt5.Qsci import QsciScintilla
 
+import alignment
+import cache
+import instrument
 import lexers
+import stats
+import workers
 from config import config
+from convert import convert, write_records, Record, READERS, WRITERS, INTERLEAVED_FORMATS
+from document import Document, PieceJournal, split_lines
+from faidx import FastaIndex, load_index, save_index
+from formats import FASTA, FASTQ, NEXUS, PHYLIP, detect_format, extension, phylip_layout
+from motif import MAX_LENGTH
+from search import Search, SequenceSearch, Replace, HitIndex, NAME, SEQUENCE
+from transform import (Transform, record_range, REVERSE_COMPLEMENT, COMPLEMENT_ONLY, UPPERCASE, LOWERCASE,
+                       T_TO_U, U_TO_T, TRANSLATE)
+from validate import validate
+from viewport import Viewport
 
 import re
+import numpy as np
+
+# Paths are relative to this file so the editor can be started from anywhere
+HERE = os.path.dirname(os.path.abspath(__file__))
+UI_PATH = os.path.join(HERE, "ui", "main.ui")
+FORM_PATH = os.path.join(HERE, "ui", "main_ui.py")
+# Problems listed by the problem panel, the rest are only counted
+MAX_PROBLEMS = 10000
+# Parts of a file a sequence transform applies to
+SELECTION = "Selection"
+RECORDS = "Records in the selection"
+WHOLE_FILE = "Whole file"
+
+
+def load_form():
+    """
+    Form class of the main window. Compiling the .ui file takes longer than
+    the rest of the window setup, so the generated module is kept next to it
+    and only compiled again when the .ui file changes.
+    """
+    try:
+        if not os.path.exists(FORM_PATH) or os.path.getmtime(FORM_PATH) < os.path.getmtime(UI_PATH):
+            from PyQt5.uic import compileUi
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(FORM_PATH), prefix=".", suffix=".tmp")
+            try:
+                with open(fd, "w") as f:
+                    compileUi(UI_PATH, f)
+                os.replace(tmp_path, FORM_PATH)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+    except OSError:
+        # Read-only installs compile the form on every start
+        from PyQt5.uic import loadUiType
+        return loadUiType(UI_PATH)[0]
+    spec = importlib.util.spec_from_file_location("main_ui", FORM_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.Ui_MainWindow
+
 
-FORM_CLASS, _ = loadUiType("ui/main.ui")
+FORM_CLASS = load_form()
 
 
 class FindInputDialog(QDialog):
-    def __init__(self, file_ext, parent=None):
+    def __init__(self, file_format, replace=False, parent=None):
         super().__init__(parent)
 
         self.text = QLineEdit(self)
+        self.replacement = QLineEdit(self)
         buttonBox = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel, self)
         self.radioChoice1 = QRadioButton(self)
         self.radioChoice1.setText('Find in sequence names')
         self.radioChoice2 = QRadioButton(self)
         self.radioChoice2.setText('Find in DNA sequences')
-
-        if file_ext not in ['fastq', 'fas']:
+        self.regex = QCheckBox(self)
+        self.regex.setText('Regular expression')
+        # DNA search: IUPAC codes, across line wraps, with differences allowed
+        self.reverseComplement = QCheckBox(self)
+        self.reverseComplement.setText('Also find the reverse complement')
+        self.differences = QSpinBox(self)
+        self.differences.setRange(0, MAX_LENGTH - 1)
+        self.edits = QCheckBox(self)
+        self.edits.setText('Count insertions and deletions')
+        dna = file_format in [FASTA, FASTQ] and not replace
+
+        if file_format not in [FASTA, FASTQ]:
             self.radioChoice1.hide()
             self.radioChoice2.hide()
         layout = QFormLayout(self)
         layout.addRow("Find:", self.text)
+        if replace:
+            layout.addRow("Replace with:", self.replacement)
+            self.radioChoice1.setText('Replace in sequence names')
+            self.radioChoice2.setText('Replace in DNA sequences')
+        else:
+            self.replacement.hide()
         layout.addWidget(self.radioChoice1)
         layout.addWidget(self.radioChoice2)
+        layout.addWidget(self.regex)
+        if dna:
+            layout.addWidget(self.reverseComplement)
+            layout.addRow("Differences allowed:", self.differences)
+            layout.addWidget(self.edits)
+        else:
+            self.reverseComplement.hide()
+            self.differences.hide()
+            self.edits.hide()
         layout.addWidget(buttonBox)
 
+        self.radioChoice2.toggled.connect(self.update_dna_options)
+        self.regex.toggled.connect(self.update_dna_options)
+        self.update_dna_options()
         buttonBox.accepted.connect(self.accept)
         buttonBox.rejected.connect(self.reject)
 
+    def update_dna_options(self):
+        enabled = self.radioChoice2.isChecked() and not self.regex.isChecked()
+        for widget in (self.reverseComplement, self.differences, self.edits):
+            widget.setEnabled(enabled)
+
     def getInputs(self):
-        return self.text.text(), self.radioChoice1.isChecked(), self.radioChoice2.isChecked()
+        return self.text.text(), self.radioChoice1.isChecked(), self.radioChoice2.isChecked(), self.regex.isChecked()
+
+    def getReplacement(self):
+        return self.replacement.text()
+
+    def getSequenceOptions(self):
+        """(differences, insertions and deletions count, reverse complement too) of a DNA search."""
+        return self.differences.value(), self.edits.isChecked(), self.reverseComplement.isChecked()
+
+
+class SearchThread(QThread):
+    found = pyqtSignal(list)
+    failed = pyqtSignal(str)
+
+    def __init__(self, search, parent=None):
+        super().__init__(parent)
+        self.search = search
+
+    def run(self):
+        try:
+            for hits in self.search:
+                self.found.emit(hits)
+        except Exception as e:
+            self.failed.emit(str(e))
+
+
+class ReplaceThread(QThread):
+    done = pyqtSignal(object, object)
+    failed = pyqtSignal(str)
+
+    def __init__(self, replace, parent=None):
+        super().__init__(parent)
+        self.replace = replace
+
+    def run(self):
+        try:
+            changes, journal = self.replace.collect()
+        except Exception as e:
+            self.failed.emit(str(e))
+            return
+        self.done.emit(changes, journal)
+
+
+class TransformThread(QThread):
+    done = pyqtSignal(object)
+    failed = pyqtSignal(str)
+
+    def __init__(self, transform, parent=None):
+        super().__init__(parent)
+        self.transform = transform
+
+    def run(self):
+        try:
+            self.done.emit(self.transform.collect())
+        except Exception as e:
+            self.failed.emit(str(e))
+
+
+class StatisticsThread(QThread):
+    done = pyqtSignal(object)
+    failed = pyqtSignal(str)
+    progress = pyqtSignal(float)
+
+    def __init__(self, document, file_format, parent=None):
+        super().__init__(parent)
+        self.document = document
+        self.file_format = file_format
+
+    def run(self):
+        try:
+            self.done.emit(stats.compute(self.document, self.file_format, self.progress.emit))
+        except Exception as e:
+            self.failed.emit(str(e))
+
+
+class ValidateThread(QThread):
+    done = pyqtSignal(object)
+    failed = pyqtSignal(str)
+    progress = pyqtSignal(float)
+
+    def __init__(self, document, file_format, parent=None):
+        super().__init__(parent)
+        self.document = document
+        self.file_format = file_format
+
+    def run(self):
+        try:
+            self.done.emit(validate(self.document, self.file_format, MAX_PROBLEMS, self.progress.emit))
+        except Exception as e:
+            self.failed.emit(str(e))
+
+
+class AlignmentThread(QThread):
+    done = pyqtSignal(object)
+    failed = pyqtSignal(str)
+
+    def __init__(self, document, file_format, operation, parent=None):
+        super().__init__(parent)
+        self.document = document
+        self.file_format = file_format
+        self.operation = operation
+
+    def run(self):
+        try:
+            self.done.emit(self.operation(alignment.load(self.document, self.file_format)))
+        except Exception as e:
+            self.failed.emit(str(e))
+
+
+class LayoutThread(QThread):
+    done = pyqtSignal()
+    failed = pyqtSignal(str)
+
+    def __init__(self, document, parent=None):
+        super().__init__(parent)
+        self.document = document
+
+    def run(self):
+        # Cached on the document, which a snapshot shares its analyses with
+        try:
+            phylip_layout(self.document)
+            self.done.emit()
+        except Exception as e:
+            self.failed.emit(str(e))
+
+
+class IndexThread(QThread):
+    progress = pyqtSignal(int, float)
+    records = pyqtSignal(object)
+    failed = pyqtSignal(str)
+
+    def __init__(self, document, record_index=False, parent=None):
+        super().__init__(parent)
+        self.document = document
+        self.record_index = record_index
+
+    def run(self):
+        try:
+            self.document.build_index(lambda lines, fraction: self.progress.emit(lines, fraction))
+            # FASTA and FASTQ records are indexed from the line offsets once they are all known
+            index = None
+            if self.record_index and self.document.indexed:
+                file_format = detect_format(self.document.path)
+                index = cache.load_records(self.document, file_format)
+                if index is None:
+                    index = FastaIndex.build(self.document, file_format)
+                    save_index(index, self.document.path)
+                self.records.emit(index)
+            cache.save(self.document, index)
+        except Exception as e:
+            self.failed.emit(str(e))
+
+
+class ConvertThread(QThread):
+    done = pyqtSignal(object)
+    failed = pyqtSignal(str)
+
+    def __init__(self, document, path, source_format, target_format, interleaved, parent=None):
+        super().__init__(parent)
+        self.document = document
+        self.path = path
+        self.source_format = source_format
+        self.target_format = target_format
+        self.interleaved = interleaved
+
+    def run(self):
+        try:
+            self.done.emit(convert(self.document, self.path, self.source_format,
+                                   self.target_format, self.interleaved))
+        except Exception as e:
+            self.failed.emit(str(e))
+
+
+class OverviewRuler(QWidget):
+    """
+    Strip next to the scroll bar with a mark wherever the document has
+    search hits, the current one in another colour. Clicking it scrolls
+    to that part of the document.
+    """
+    jump = pyqtSignal(int)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.hits = HitIndex()
+        self.lines = 0
+        self.current = None
+        self._density = None
+        self._key = None
+
+    def set_hits(self, hits, lines, current=None):
+        self.hits = hits
+        self.lines = lines
+        self.current = current
+        self.update()
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        painter.fillRect(self.rect(), QColor("#f0f0f0"))
+        height = self.height()
+        if not len(self.hits) or not self.lines:
+            return
+        # Hits are binned once per pixel row until they or the size change
+        key = (len(self.hits), self.lines, height)
+        if key != self._key:
+            self._density = self.hits.density(height, self.lines)
+            self._key = key
+        for y in self._density.nonzero()[0]:
+            painter.fillRect(0, int(y), self.width(), 2, QColor("#e0a000"))
+        if self.current is not None:
+            y = self.current * height // self.lines
+            painter.fillRect(0, y, self.width(), 3, QColor("#c00000"))
+
+    def mousePressEvent(self, event):
+        if self.lines:
+            self.jump.emit(event.y() * self.lines // max(self.height(), 1))
+
+
+class BarChart(QWidget):
+    """Bars of an array of values, with a title and the labels of both ends."""
+
+    def __init__(self, title, parent=None):
+        super().__init__(parent)
+        self.title = title
+        self.values = []
+        self.first = self.last = ""
+        self.setMinimumHeight(110)
+
+    def set_values(self, values, first="", last=""):
+        self.values = list(values)
+        self.first, self.last = str(first), str(last)
+        self.update()
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        width, height = self.width(), self.height()
+        text = self.fontMetrics().height()
+        painter.drawText(0, 0, width, text, Qt.AlignLeft, self.title)
+        top, bottom = text + 2, height - text
+        painter.drawText(0, bottom, width, text, Qt.AlignLeft, self.first)
+        painter.drawText(0, bottom, width, text, Qt.AlignRight, self.last)
+        peak = max(self.values, default=0)
+        if not peak:
+            return
+        bar = width / len(self.values)
+        for i, value in enumerate(self.values):
+            h = (bottom - top) * value / peak
+            painter.fillRect(int(i * bar), int(bottom - h), max(int(bar) - 1, 1), int(h), QColor("#3c8aa7"))
+
+
+class StatisticsPanel(QDockWidget):
+    """Record statistics of a FASTA or FASTQ file, docked next to the editor."""
+
+    def __init__(self, parent=None):
+        super().__init__("Statistics", parent)
+        self.status = QLabel(self)
+        self.summary = QLabel(self)
+        self.summary.setTextInteractionFlags(Qt.TextSelectableByMouse)
+        self.lengths = BarChart("Record lengths", self)
+        self.mean_quality = BarChart("Mean quality by position", self)
+        self.qualities = BarChart("Quality scores", self)
+        body = QWidget(self)
+        layout = QVBoxLayout(body)
+        for widget in (self.status, self.summary, self.lengths, self.mean_quality, self.qualities):
+            layout.addWidget(widget)
+        layout.addStretch()
+        self.setWidget(body)
+        self.setMinimumWidth(260)
+
+    def show_message(self, message):
+        self.status.setText(message)
+        self.summary.clear()
+        for chart in (self.lengths, self.mean_quality, self.qualities):
+            chart.set_values([])
+
+    def show_progress(self, fraction):
+        self.status.setText("Counting... {:.0f}%".format(100 * fraction))
+
+    def show_statistics(self, s):
+        self.status.clear()
+        rows = [("Records", "{:,}".format(s.records)),
+                ("Bases", "{:,}".format(s.bases)),
+                ("GC", "{:.2f}%".format(100 * s.gc_fraction)),
+                ("N", "{:.2f}%".format(100 * s.n_fraction)),
+                ("N50", "{:,}".format(s.n50)),
+                ("N90", "{:,}".format(s.n90)),
+                ("Shortest", "{:,}".format(s.min_length)),
+                ("Longest", "{:,}".format(s.max_length)),
+                ("Mean length", "{:,.1f}".format(s.mean_length))]
+        self.summary.setText("<table>" + "".join("<tr><td>{}</td><td align=right>&nbsp;{}</td></tr>".format(*row)
+                                                 for row in rows) + "</table>")
+        edges, counts = s.length_histogram()
+        self.lengths.set_values(counts, int(edges[0]), int(edges[-1]))
+        quality = s.mean_quality
+        fastq = quality is not None
+        self.mean_quality.setVisible(fastq)
+        self.qualities.setVisible(fastq)
+        if fastq:
+            self.mean_quality.set_values(quality, 1, len(quality))
+            used = np.flatnonzero(s.quality_hist)
+            end = int(used[-1]) + 1 if len(used) else 1
+            self.qualities.set_values(s.quality_hist[:end], 0, end - 1)
+
+
+class ProblemPanel(QDockWidget):
+    """Problems found in the open file by validating it, clicking one goes to its line."""
+    jump = pyqtSignal(int, int)
+
+    def __init__(self, parent=None):
+        super().__init__("Problems", parent)
+        self.status = QLabel(self)
+        self.list = QListWidget(self)
+        self.list.itemClicked.connect(self.activated)
+        self.list.itemActivated.connect(self.activated)
+        body = QWidget(self)
+        layout = QVBoxLayout(body)
+        layout.addWidget(self.status)
+        layout.addWidget(self.list)
+        self.setWidget(body)
+        self.setMinimumWidth(260)
+
+    def show_message(self, message):
+        self.status.setText(message)
+        self.list.clear()
+
+    def show_progress(self, fraction):
+        self.status.setText("Checking... {:.0f}%".format(100 * fraction))
+
+    def show_report(self, report):
+        if not report.count:
+            self.status.setText("No problems found")
+        elif report.count > len(report.problems):
+            self.status.setText("{:,} problems, the first {:,} listed".format(report.count, len(report.problems)))
+        else:
+            self.status.setText("{:,} problems".format(report.count))
+        self.list.clear()
+        for problem in report.problems:
+            item = QListWidgetItem("{}:{}  {}".format(problem.line + 1, problem.column + 1, problem.message))
+            item.setData(Qt.UserRole, (problem.line, problem.column))
+            self.list.addItem(item)
+
+    def activated(self, item):
+        self.jump.emit(*item.data(Qt.UserRole))
+
+
+class InstrumentOverlay(QLabel):
+    """Live readout of the last spans recorded, over the corner of the editor."""
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setStyleSheet("background: rgba(0, 0, 0, 170); color: white; padding: 4px;"
+                           " font-family: monospace; font-size: 9pt;")
+        self.setAttribute(Qt.WA_TransparentForMouseEvents)
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.refresh)
+
+    def setVisible(self, visible):
+        super().setVisible(visible)
+        if visible:
+            self.timer.start(250)
+        else:
+            self.timer.stop()
+
+    def refresh(self):
+        last = instrument.last
+        lines = []
+        if "frame" in last:
+            lines.append("frame    {:7.2f} ms".format(last["frame"][0] * 1000))
+        if "viewport.show" in last:
+            seconds, args = last["viewport.show"]
+            lines.append("viewport {:7.2f} ms {}".format(seconds * 1000, args.get("mode", "")))
+        if "style" in last:
+            seconds, args = last["style"]
+            lines.append("style    {:7.2f} ms {} lines".format(seconds * 1000, args.get("lines", 0)))
+        if "document.text" in last:
+            seconds, args = last["document.text"]
+            lines.append("read     {:7.2f} ms {} lines".format(seconds * 1000, args.get("lines", 0)))
+        self.setText("\n".join(lines) or "waiting for spans")
+        self.adjustSize()
+        parent = self.parentWidget()
+        self.move(parent.width() - self.width() - 40, 70)
+        self.raise_()
 
 
 class SequenceEditor(QMainWindow, FORM_CLASS):
@@ -61,15 +537,16 @@ class SequenceEditor(QMainWindow, FORM_CLASS):
     def __init__(self):
         super().__init__()
         self.setWindowTitle("Sequence Editor")
-        self.setWindowIcon(QIcon("ui/resources/itaxo.png"))
+        self.setWindowIcon(QIcon(os.path.join(HERE, "ui", "resources", "itaxo.png")))
         self.path = "Untitled"
-        self.txt = ""
+        self.document = None
         self.setWindowTitle(os.path.basename(self.path))
 
         self.setupUi(self)
         self.connectTriggers()
 
         self.value = 0
+        self.window_end = 0
         # ScrollBar for lazy loading
         self.scroll = QScrollBar(self)
         scroll_x = 780
@@ -77,13 +554,93 @@ class SequenceEditor(QMainWindow, FORM_CLASS):
         self.scroll.setGeometry(scroll_x, 60, 20, scroll_y)
         self.scroll.valueChanged.connect(lambda: self.scroll_text())
         self.scroll.setFocusPolicy(Qt.WheelFocus)
-
-        self.find = []
-        self.find_pos = []
+        self.ruler = OverviewRuler(self)
+        self.ruler.setGeometry(scroll_x - 8, 60, 8, scroll_y)
+        self.ruler.jump.connect(self.scroll.setValue)
+
+        # Files are indexed in the background, the window is usable while it runs
+        self.index_thread = None
+        # Why the last indexing stopped, shown once it has finished
+        self.index_error = None
+        self.progress = QProgressBar(self)
+        self.progress.setRange(0, 100)
+        self.progress.setMaximumWidth(200)
+        self.cancel_button = QPushButton("Cancel", self)
+        self.cancel_button.clicked.connect(self.cancel_loading)
+        self.statusbar.addPermanentWidget(self.progress)
+        self.statusbar.addPermanentWidget(self.cancel_button)
+        self.progress.hide()
+        self.cancel_button.hide()
+        self.match_label = QLabel(self)
+        self.statusbar.addPermanentWidget(self.match_label)
+
+        # Statistics of FASTA/FASTQ files, worked out again after edits while the panel is open
+        self.statistics = StatisticsPanel(self)
+        self.addDockWidget(Qt.RightDockWidgetArea, self.statistics)
+        self.statistics.hide()
+        self.statistics.visibilityChanged.connect(self.statistics_visibility)
+        self.statistics_thread = None
+        self.statistics_pending = False
+        self.statistics_timer = QTimer(self)
+        self.statistics_timer.setSingleShot(True)
+        self.statistics_timer.setInterval(1000)
+        self.statistics_timer.timeout.connect(self.refresh_statistics)
+
+        # Problems of the open file, checked again after edits while the panel is open
+        self.problem_panel = ProblemPanel(self)
+        self.addDockWidget(Qt.RightDockWidgetArea, self.problem_panel)
+        self.problem_panel.hide()
+        self.problem_panel.visibilityChanged.connect(self.problems_visibility)
+        self.problem_panel.jump.connect(self.jump_to_problem)
+        self.problems = None
+        self.problems_thread = None
+        self.problems_pending = False
+        self.problems_timer = QTimer(self)
+        self.problems_timer.setSingleShot(True)
+        self.problems_timer.setInterval(1000)
+        self.problems_timer.timeout.connect(self.refresh_problems)
+
+        # Alignment operations run one at a time on a worker thread, the variable
+        # sites of the matrix are found again once edits settle
+        self.alignment_thread = None
+        self.variable_sites = None
+        self.alignment_timer = QTimer(self)
+        self.alignment_timer.setSingleShot(True)
+        self.alignment_timer.setInterval(1000)
+        self.alignment_timer.timeout.connect(self.refresh_variable_sites)
+
+        # The PHYLIP layout is worked out again on a worker thread, styling
+        # goes on with the last one until it is done
+        self.layout_thread = None
+
+        # Spans are recorded while the overlay is on, or from the start with SEQUENCE_EDITOR_TRACE set
+        self.overlay = InstrumentOverlay(self)
+        self.overlay.setVisible(instrument.enabled)
+        self.action_Overlay.setChecked(instrument.enabled)
+        self.action_Profile.setChecked(instrument.profiling())
+
+        self.find = HitIndex()
         self.find_string = ""
         self.find_count = 0
+        self.search = None
+        self.search_thread = None
+        # Undo journals of the Replace All runs and sequence transforms with
+        # their status message, most recent last
+        self.journals = []
+
+        # Record index of FASTA and FASTQ files, with a jump waiting for its lines to load
+        self.record_index = None
+        self.pending_jump = None
+
+        # Document read by a conversion running in the background
+        self.converting = None
+        self.convert_thread = None
+
+        # Documents set aside, reopened without indexing them again
+        self.recent = cache.RecentDocuments()
 
         # Editor
+        self.viewport = Viewport(self.editor)
         self.editor.setUtf8(True)
         self.editor.setFont(QFont(config.DEFAULT_FONT, config.FONT_SIZE))
         self.editor.setAutoCompletionSource(QsciScintilla.AcsDocument)
@@ -109,17 +666,30 @@ class SequenceEditor(QMainWindow, FORM_CLASS):
             "fa": lexers.FastaLexer,
             "fas": lexers.FastaLexer,
             "fsa": lexers.FastaLexer,
+            "fasta": lexers.FastaLexer,
             "fastq": lexers.FastqLexer,
+            "fq": lexers.FastqLexer,
             "nex": lexers.NexusLexer,
             "nxs": lexers.NexusLexer,
             "phy": lexers.PhylipLexer,
         }
-        self.setLexer(self.LEXERS["py"])
+        # Lexers are only built once a file of their type is opened
+        self.lexer = None
+        self.lexer_cache = {}
 
         # search indicator
         self.SEARCH_INDICATOR_ID = 16
         self.editor.indicatorDefine(QsciScintilla.FullBoxIndicator, self.SEARCH_INDICATOR_ID)
         self.editor.indicatorDefine(QsciScintilla.BoxIndicator, self.SEARCH_INDICATOR_ID + 1)
+        # variable sites indicator
+        self.VARIABLE_INDICATOR_ID = self.SEARCH_INDICATOR_ID + 2
+        self.editor.indicatorDefine(QsciScintilla.StraightBoxIndicator, self.VARIABLE_INDICATOR_ID)
+        self.editor.setIndicatorForegroundColor(QColor(240, 160, 40, 90), self.VARIABLE_INDICATOR_ID)
+        # validation problem indicator
+        self.PROBLEM_INDICATOR_ID = self.SEARCH_INDICATOR_ID + 3
+        self.editor.indicatorDefine(QsciScintilla.SquiggleIndicator, self.PROBLEM_INDICATOR_ID)
+        self.editor.setIndicatorForegroundColor(QColor(220, 0, 0), self.PROBLEM_INDICATOR_ID)
+        self.editor.SCN_UPDATEUI.connect(self.editor_updated)
 
         # Enable/Disable find_next and find_prev
         self.FIND_ACTIVE = False
@@ -130,26 +700,84 @@ class SequenceEditor(QMainWindow, FORM_CLASS):
     def wheelEvent(self, event):
         self.scroll.setValue(int(self.value - event.angleDelta().y() / 20))
 
+    def window_lines(self):
+        return int(self.geometry().height()/20)
+
+    def flush_window(self):
+        # Write the visible lines back into the document only if they were edited
+        if self.document is None or not self.editor.isModified():
+            return
+        lines = split_lines(self.editor.text())
+        self.document.replace_lines(self.value, self.window_end, lines)
+        self.editor.setModified(False)
+        self.viewport.synced(self.value + len(lines))
+        self.scroll.setMaximum(len(self.document))
+        self.document_changed()
+
+    def show_window(self, start):
+        self.value = start
+        self.window_end = start + self.window_lines()
+        self.update_lexer_context()
+        self.viewport.show(self.document, start, self.window_end)
+        if self.FIND_ACTIVE and self.find:
+            # Lines scrolled into view get the highlights of their hits
+            self.find_highlight_util(self.window_end)
+        self.highlight_variable_sites()
+        self.highlight_problems()
+        self.editor.setModified(False)
+        # Compressed files decompress the next screens in the background
+        self.document.prefetch(self.window_end, self.window_end + 4 * self.window_lines())
+
     def scroll_text(self):
-        buffer_text = self.editor.text()
-        buffer_arr = buffer_text.split("\n")
-        buffer_arr = buffer_arr[:-1]
-        buffer_arr = [i + "\n" for i in buffer_arr]
-        self.txt[self.value:self.value+(int(self.geometry().height()/20))] = buffer_arr
-        self.value = self.scroll.value()
-        self.editor.setText(''.join(self.txt[self.value:self.value+(int(self.geometry().height()/20))]))
+        if self.document is None:
+            return
+        with instrument.span("frame"):
+            self.flush_window()
+            self.show_window(self.scroll.value())
 
     def setLexer(self, lexer):
-        self.lexer = lexer(self.editor)
-        self.lexer.setDefaultFont(QFont(config.DEFAULT_FONT, config.FONT_SIZE))
+        if lexer not in self.lexer_cache:
+            self.lexer_cache[lexer] = lexer(self.editor)
+            self.lexer_cache[lexer].setDefaultFont(QFont(config.DEFAULT_FONT, config.FONT_SIZE))
+        self.lexer = self.lexer_cache[lexer]
+        self.update_lexer_context()
         self.editor.setLexer(self.lexer)
 
+    def update_lexer_context(self):
+        # Stateful lexers need to know where in the document the viewport starts
+        set_context = getattr(self.lexer, "set_context", None)
+        if set_context is not None and self.document is not None:
+            if set_context(self.document, self.value):
+                self.refresh_layout()
+
+    def refresh_layout(self):
+        if self.layout_thread is not None:
+            # Checked again once the running one is done
+            return
+        thread = LayoutThread(self.document.snapshot(), self)
+        thread.done.connect(self.layout_done)
+        thread.failed.connect(self.layout_failed)
+        thread.finished.connect(thread.deleteLater)
+        self.layout_thread = thread
+        thread.start()
+
+    def layout_done(self):
+        self.layout_thread = None
+        # Starts over if the document changed or another one was opened meanwhile
+        self.update_lexer_context()
+        self.editor.recolor()
+
+    def layout_failed(self, message):
+        self.layout_thread = None
+        self.statusbar.showMessage(message)
+
     def connectTriggers(self):
         self.action_Open.triggered.connect(self.file_open)
         self.action_Save.triggered.connect(self.file_save)
         self.actionSave_As.triggered.connect(self.file_saveAs)
+        self.action_Convert.triggered.connect(self.file_convert)
         self.action_Exit.triggered.connect(qApp.quit)
-        self.action_Undo.triggered.connect(self.editor.undo)
+        self.action_Undo.triggered.connect(self.undo)
         self.action_Redo.triggered.connect(self.editor.redo)
         self.action_Cut.triggered.connect(self.editor.cut)
         self.action_Copy.triggered.connect(self.editor.copy)
@@ -159,10 +787,47 @@ class SequenceEditor(QMainWindow, FORM_CLASS):
         self.action_Find_Prev.triggered.connect(self.find_prev)
         self.action_Find_Next.triggered.connect(self.find_next)
         self.action_Replace.triggered.connect(self.replace)
+        self.action_Replace_All.triggered.connect(self.replace_all)
+        self.action_Goto_Record.triggered.connect(self.goto_record)
+        self.action_Statistics.toggled.connect(self.toggle_statistics)
+        self.action_Problems.toggled.connect(self.toggle_problems)
+        self.action_Variable_Sites.toggled.connect(self.toggle_variable_sites)
+        self.action_Column_Summary.triggered.connect(self.column_summary)
+        self.action_Consensus.triggered.connect(self.save_consensus)
+        self.action_Strip_Gaps.triggered.connect(self.save_strip_gaps)
+        self.action_Extract_Columns.triggered.connect(self.save_columns)
+        for action, operation in ((self.action_Reverse_Complement, REVERSE_COMPLEMENT),
+                                  (self.action_Complement, COMPLEMENT_ONLY), (self.action_Uppercase, UPPERCASE),
+                                  (self.action_Lowercase, LOWERCASE), (self.action_T_To_U, T_TO_U),
+                                  (self.action_U_To_T, U_TO_T), (self.action_Translate, TRANSLATE)):
+            action.triggered.connect(lambda checked, operation=operation: self.transform_sequences(operation))
+        self.action_Overlay.toggled.connect(self.toggle_instrumentation)
+        self.action_Export_Trace.triggered.connect(self.export_trace)
+        self.action_Profile.toggled.connect(self.toggle_profile)
         # self.action_Find_Down.triggered.connect(self.find_down)
         self.action_About.triggered.connect(self.help_about)
         self.resized.connect(self.ScrollBarPosition)
 
+    def closeEvent(self, event):
+        self.cancel_search(wait=True)
+        self.stop_loading()
+        if self.convert_thread is not None and not sip.isdeleted(self.convert_thread):
+            self.convert_thread.wait()
+        if self.statistics_thread is not None and not sip.isdeleted(self.statistics_thread):
+            self.statistics_thread.wait()
+        if self.problems_thread is not None and not sip.isdeleted(self.problems_thread):
+            self.problems_thread.wait()
+        if self.alignment_thread is not None and not sip.isdeleted(self.alignment_thread):
+            self.alignment_thread.wait()
+        if self.layout_thread is not None and not sip.isdeleted(self.layout_thread):
+            self.layout_thread.wait()
+        if self.document is not None and self.document is not self.converting:
+            cache.save(self.document, self.record_index)
+        self.recent.close()
+        cache.shutdown()
+        workers.shutdown()
+        return super(SequenceEditor, self).closeEvent(event)
+
     # Signal For Screen Size Change
     def resizeEvent(self, event):
         self.resized.emit()
@@ -173,8 +838,8 @@ class SequenceEditor(QMainWindow, FORM_CLASS):
         width = self.geometry().width()
         height = self.geometry().height()
         self.scroll.setGeometry(width-20, 60, 20, height-100)
-        value = self.scroll.value()
-        self.editor.setText(''.join(self.txt[value:value+(int(self.geometry().height()/20))]))
+        self.ruler.setGeometry(width-28, 60, 8, height-100)
+        self.scroll_text()
 
 
     def edit_wrap_text(self):
@@ -186,84 +851,102 @@ class SequenceEditor(QMainWindow, FORM_CLASS):
             self.WRAP_MODE = 'unwrapped'
 
     def find_search(self):
-        file_ext = self.path.split(".")[-1]
-        dialog = FindInputDialog(file_ext=file_ext)
+        if self.document is None:
+            return
+        file_format = detect_format(self.path)
+        dialog = FindInputDialog(file_format=file_format)
 
-        outputs = ('', False, False)
+        outputs = ('', False, False, False)
 
         child = dialog.exec_()
         if child == QDialog.Accepted:
             outputs = dialog.getInputs()
         else:
             return
-
-        self.find_string = outputs[0]
-        name = outputs[0]
-        os_name = platform.system()
-        try:
-            if os_name == "Linux":
-                output = str(subprocess.check_output('grep -n ' + str(name) + ' ' + self.path, shell=True))[2:-1]
-            else:
-                t_path = self.path
-                x = '\"' + t_path.replace("/", "\\") + '\"'
-                output = str(subprocess.check_output('findstr /n ' + str(name) + ' ' + x, shell=True))[2:-1]
-        except:
-            # Not found
-            self.dialog_message("Search string not found")
+        if not outputs[0]:
             return
-        tmp_x = output.replace("\\r", "").split("\\n")
-
-        if len(tmp_x) == 0:
-            # Not found
-            self.dialog_message("Search string not found")
-            self.FIND_ACTIVE = False
-            return
-
-        sequence_names = []
-        dna_sequences = []
-        pattern_occurances = []
-
-        for i in tmp_x:
-            try:
-                start = i.split(':')[1]
-                if file_ext == 'fastq':
-                    if start[0] == '+' or start[0] == '@':
-                        sequence_names.append(i)
-                elif file_ext == 'fas':
-                    if start[0] == '>':
-                        sequence_names.append(i)
-                    else:
-                        dna_sequences.append(i)
-                pattern_occurances.append(i)
-            except:
-                dna_sequences.append(i)
-                sequence_names.append(i)
-                pattern_occurances.append(i)
 
         # -1 for text, 0 for sequence names, 1 for dna sequences
         self.search_option = -1
-
-        x = []
-        if not outputs[1] and not outputs[2]:
-            x += pattern_occurances
-        elif outputs[1]:
+        kinds = None
+        if outputs[1]:
             self.search_option = 0
-            x += sequence_names
+            kinds = [NAME]
         elif outputs[2]:
             self.search_option = 1
-            x += dna_sequences
-        self.find = [int(i.split(":")[0]) for i in x[:-1]]
-        self.find_pos = [int(i.split(":")[1].find(self.find_string)) for i in x[:-1]]
+            kinds = [SEQUENCE]
 
+        self.flush_window()
+        try:
+            if outputs[2] and not outputs[3]:
+                # Matches run across line wraps, with IUPAC codes and differences
+                k, edits, both_strands = dialog.getSequenceOptions()
+                search = SequenceSearch(self.document, outputs[0], file_format, k, edits, both_strands)
+            else:
+                search = Search(self.document, outputs[0], regex=outputs[3], file_format=file_format, kinds=kinds)
+        except (re.error, ValueError) as e:
+            self.dialog_message(str(e))
+            return
+
+        self.cancel_search()
+        self.find_string = outputs[0]
+        self.find = HitIndex()
         self.find_count = 0
+        self.FIND_ACTIVE = False
 
-        self.scroll.setValue(self.find[self.find_count] - 1)
-        self.scroll_text()
-        current_window_size_max = self.value+(int(self.geometry().height()/20))
-        self.clear_highlight_util(current_window_size_max)
-        self.find_highlight_util(current_window_size_max)
+        # Hits stream in from a worker thread, the first one is shown as soon as it is found
+        self.search = search
+        thread = SearchThread(search, self)
+        thread.found.connect(lambda hits: self.find_results(search, hits))
+        thread.failed.connect(lambda message: self.search_failed(search, message))
+        thread.finished.connect(lambda: self.find_finished(search))
+        thread.finished.connect(thread.deleteLater)
+        thread.start()
+        self.search_thread = thread
+        self.statusbar.showMessage("Searching...")
+
+    def cancel_search(self, wait=False):
+        if self.search is not None:
+            self.search.cancel()
+        if wait and self.search_thread is not None and not sip.isdeleted(self.search_thread):
+            self.search_thread.wait()
+
+    def find_results(self, search, hits):
+        if search is not self.search:
+            return
+        first = not self.find
+        self.find.extend(hits)
+        self.statusbar.showMessage("Searching... {} matches".format(len(self.find)))
+        self.show_match_count()
+        if first:
+            self.FIND_ACTIVE = True
+            self.find_count = 0
+            self.scroll.setValue(self.find[self.find_count].line)
+            self.scroll_text()
+            current_window_size_max = self.value+(int(self.geometry().height()/20))
+            self.clear_highlight_util(current_window_size_max)
+            self.find_highlight_util(current_window_size_max)
+
+    def find_finished(self, search):
+        if search is not self.search or search.cancelled:
+            return
+        self.statusbar.showMessage("{} matches".format(len(self.find)))
+        self.show_match_count()
+        if not self.find:
+            # Not found
+            self.dialog_message("Search string not found")
 
-        self.FIND_ACTIVE = True
+    def search_failed(self, search, message):
+        if search is not self.search:
+            return
+        # Matches found before the error are dropped with it
+        search.cancel()
+        self.FIND_ACTIVE = False
+        self.find = HitIndex()
+        self.show_match_count()
+        self.clear_highlight_util(self.value + int(self.geometry().height() / 20))
+        self.statusbar.clearMessage()
+        self.dialog_message(message)
 
     def find_prev(self):
         if not self.FIND_ACTIVE:
@@ -271,14 +954,12 @@ class SequenceEditor(QMainWindow, FORM_CLASS):
 
         self.find_count = self.find_count - 1
         try:
-            self.scroll.setValue(self.find[self.find_count]-1)
-            self.value = self.scroll.value()
-            self.editor.setText(''.join(self.txt[self.value:self.value+(int(self.geometry().height()/20))]))
+            self.scroll.setValue(self.find[self.find_count].line)
+            self.scroll_text()
         except:
             self.find_count = len(self.find)-1
-            self.scroll.setValue(self.find[self.find_count]-1)
-            self.value = self.scroll.value()
-            self.editor.setText(''.join(self.txt[self.value:self.value+(int(self.geometry().height()/20))]))
+            self.scroll.setValue(self.find[self.find_count].line)
+            self.scroll_text()
 
         current_window_size_max = self.value+(int(self.geometry().height()/20))
         self.clear_highlight_util(current_window_size_max)
@@ -290,8 +971,152 @@ class SequenceEditor(QMainWindow, FORM_CLASS):
 
         repl, done2 = QInputDialog.getText(
             self, 'Input Dialog', 'Replace:')
-        self.txt[self.value] = self.txt[self.value].replace(self.find_string, repl)
-        self.editor.setText(''.join(self.txt[self.value:self.value+(int(self.geometry().height()/20))]))
+        self.flush_window()
+        line = self.document.line(self.value)
+        self.document.replace_lines(self.value, self.value + 1, [line.replace(self.find_string, repl)])
+        self.show_window(self.value)
+
+    def replace_all(self):
+        if self.document is None:
+            return
+        file_format = detect_format(self.path)
+        dialog = FindInputDialog(file_format=file_format, replace=True)
+        if dialog.exec_() != QDialog.Accepted:
+            return
+        text, names, sequences, regex = dialog.getInputs()
+        if not text:
+            return
+        kinds = [NAME] if names else [SEQUENCE] if sequences else None
+
+        replacement = dialog.getReplacement()
+        self.flush_window()
+        try:
+            replace = Replace(self.document, text, replacement, regex=regex, file_format=file_format, kinds=kinds)
+            if regex:
+                # Group references in the replacement are checked before the workers start
+                replace.pattern.sub(replacement, "")
+        except re.error as e:
+            self.dialog_message(str(e))
+            return
+
+        # The whole document is rewritten on worker threads, then applied in one edit
+        self.cancel_search()
+        self.search = replace
+        thread = ReplaceThread(replace, self)
+        thread.done.connect(lambda changes, journal: self.replace_finished(replace, changes, journal))
+        thread.failed.connect(lambda message: self.search_failed(replace, message))
+        thread.finished.connect(thread.deleteLater)
+        thread.start()
+        self.search_thread = thread
+        self.statusbar.showMessage("Replacing...")
+
+    def replace_finished(self, replace, changes, journal):
+        if replace is not self.search or replace.cancelled:
+            return
+        self.flush_window()
+        if self.document.version != replace.version:
+            self.statusbar.clearMessage()
+            self.dialog_message("The document was edited while replacing, nothing was replaced")
+            return
+        self.document.set_lines(changes)
+        if journal:
+            journal.version = self.document.version
+            self.journals.append((journal, "Undid {} replacements".format(len(journal))))
+        # Hits of the last search moved with the replacements
+        self.FIND_ACTIVE = False
+        self.find = HitIndex()
+        self.show_match_count()
+        self.show_window(self.value)
+        self.statusbar.showMessage("{} replacements on {} lines".format(len(journal), len(changes)))
+        self.document_changed()
+
+    def undo(self):
+        # Edits in the window are undone first, then the Replace All runs
+        if self.editor.isUndoAvailable() or not self.journals:
+            self.editor.undo()
+            return
+        self.flush_window()
+        journal, message = self.journals.pop()
+        if journal.version != self.document.version:
+            self.journals.clear()
+            self.dialog_message("The document changed since that edit, it can no longer be undone")
+            return
+        journal.undo(self.document)
+        if self.journals and self.journals[-1][0].version == journal.version - 1:
+            # Back to the state the previous journal was made for
+            self.journals[-1][0].version = self.document.version
+        self.scroll.setMaximum(len(self.document))
+        self.show_window(min(self.value, max(len(self.document) - 1, 0)))
+        self.document_changed()
+        self.statusbar.showMessage(message)
+
+    def transform_sequences(self, operation):
+        if self.document is None:
+            return
+        file_format = detect_format(self.path)
+        if file_format not in [FASTA, FASTQ]:
+            self.dialog_message("Sequence transforms work on FASTA and FASTQ files")
+            return
+        if not self.document.indexed:
+            self.dialog_message("The file is still loading")
+            return
+        self.flush_window()
+        line_from, index_from, line_to, index_to = self.editor.getSelection()
+        selected = line_from >= 0
+        if not selected:
+            line_from, index_from = line_to, index_to = self.editor.getCursorPosition()
+        scopes = [SELECTION, RECORDS, WHOLE_FILE] if selected and operation != TRANSLATE else [RECORDS, WHOLE_FILE]
+        scope, ok = QInputDialog.getItem(self, operation, "Apply to:", scopes, 0, False)
+        if not ok:
+            return
+
+        start, stop, selection = self.value + line_from, self.value + line_to + 1, None
+        if scope == SELECTION:
+            selection = (index_from, index_to)
+        elif scope == RECORDS:
+            start, stop = record_range(self.document, file_format, start, stop)
+        else:
+            start, stop = 0, len(self.document)
+        try:
+            transform = Transform(self.document, operation, file_format, start, stop, selection)
+        except ValueError as e:
+            self.dialog_message(str(e))
+            return
+
+        # Chunks are transformed on a worker thread, then applied in one edit
+        self.cancel_search()
+        self.search = transform
+        thread = TransformThread(transform, self)
+        thread.done.connect(lambda changes: self.transform_finished(transform, changes))
+        thread.failed.connect(lambda message: self.search_failed(transform, message))
+        thread.finished.connect(thread.deleteLater)
+        thread.start()
+        self.search_thread = thread
+        self.statusbar.showMessage("{}...".format(transform.operation))
+
+    def transform_finished(self, transform, changes):
+        if transform is not self.search or transform.cancelled:
+            return
+        self.flush_window()
+        if self.document.version != transform.version:
+            self.statusbar.clearMessage()
+            self.dialog_message("The document was edited during the transform, nothing was changed")
+            return
+        if not changes:
+            self.statusbar.showMessage("{}: nothing to change".format(transform.operation))
+            return
+        journal = PieceJournal(self.document)
+        self.document.replace_ranges(changes)
+        journal.version = self.document.version
+        self.journals.append((journal, "Undid the {}".format(transform.operation.lower())))
+        # Hits of the last search moved with the transform
+        self.FIND_ACTIVE = False
+        self.find = HitIndex()
+        self.show_match_count()
+        self.scroll.setMaximum(len(self.document))
+        self.show_window(min(self.value, max(len(self.document) - 1, 0)))
+        self.statusbar.showMessage("{} done".format(transform.operation))
+        self.document_changed()
 
     def find_next(self):
         if not self.FIND_ACTIVE:
@@ -299,16 +1124,14 @@ class SequenceEditor(QMainWindow, FORM_CLASS):
 
         self.find_count = self.find_count + 1
         try:
-            if self.find[self.find_count] >= self.value + int(self.geometry().height() / 20) or \
-                    self.find[self.find_count] <= self.value:
-                self.scroll.setValue(self.find[self.find_count]-1)
-                self.value = self.scroll.value()
-                self.editor.setText(''.join(self.txt[self.value:self.value + (int(self.geometry().height()/20))]))
+            if self.find[self.find_count].line >= self.value + int(self.geometry().height() / 20) or \
+                    self.find[self.find_count].line < self.value:
+                self.scroll.setValue(self.find[self.find_count].line)
+                self.scroll_text()
         except:
             self.find_count = 0
-            self.scroll.setValue(self.find[self.find_count]-1)
-            self.value = self.scroll.value()
-            self.editor.setText(''.join(self.txt[self.value:self.value+(int(self.geometry().height()/20))]))
+            self.scroll.setValue(self.find[self.find_count].line)
+            self.scroll_text()
 
         current_window_size_max = self.value+(int(self.geometry().height()/20))
         self.clear_highlight_util(current_window_size_max)
@@ -319,72 +1142,609 @@ class SequenceEditor(QMainWindow, FORM_CLASS):
         self.editor.clearIndicatorRange(min(self.value - 5, 0), 0, window_max+1, 0, self.SEARCH_INDICATOR_ID + 1)
 
     def find_highlight_util(self, window_max):
-        offset = 1
-        if self.search_option == 0:
-            offset = 0
-
-        self.editor.fillIndicatorRange(self.find[self.find_count] - offset - self.value,
-                                       self.find_pos[self.find_count],
-                                       self.find[self.find_count] - offset - self.value,
-                                       self.find_pos[self.find_count] + len(self.find_string),
-                                       self.SEARCH_INDICATOR_ID + 1)
-
-        for line in self.find:
-            if len([re.finditer(self.find_string, self.txt[line - 1])]):
-                self.editor.fillIndicatorRange(line - offset - self.value, 0,
-                                               line - offset - self.value + 1, 0,
-                                               self.SEARCH_INDICATOR_ID)
+        # Only the hits in view are looked up and drawn
+        for hit in self.find.on_lines(self.value, window_max):
+            self.editor.fillIndicatorRange(hit.line - self.value, 0,
+                                           hit.line - self.value + 1, 0,
+                                           self.SEARCH_INDICATOR_ID)
+
+        current = self.find[self.find_count % len(self.find)]
+        if self.value <= current.line < window_max:
+            self.editor.fillIndicatorRange(current.line - self.value,
+                                           current.column,
+                                           current.line - self.value,
+                                           current.column + current.length,
+                                           self.SEARCH_INDICATOR_ID + 1)
+        self.show_match_count()
+
+    def show_match_count(self):
+        if not self.find:
+            self.match_label.clear()
+            self.ruler.set_hits(self.find, 0)
+            return
+        current = self.find_count % len(self.find)
+        self.match_label.setText("Match {} of {}".format(current + 1, len(self.find)))
+        self.ruler.set_hits(self.find, len(self.document), self.find[current].line)
 
     def file_open(self):
         path, _ = QFileDialog.getOpenFileName(
             parent=self, caption="Open file", filter=config.FILTER_TYPES
         )
-        try:
+        if not path:
+            return
+        self.open_path(path)
 
-            #text = open(path , "r").read()
-            text = open(path, "r").readlines()
-            self.scroll.setMaximum(len(text))
-            self.txt = text
-            #self.editor.setText(text)
-            self.editor.setText(''.join(text[0:(int(self.geometry().height()/20))]))
+    def open_path(self, path):
+        try:
+            self.cancel_search()
+            self.FIND_ACTIVE = False
+            self.find = HitIndex()
+            self.show_match_count()
+            self.journals = []
+            self.load_document(path, first_line=0)
             self.path = path
             #print(self.path)
             #print(os.path.abspath(__file__))
             self.setWindowTitle(os.path.basename(path))
-            self.setLexer(self.LEXERS[path.split(".")[-1]])
+            self.setLexer(self.LEXERS[extension(path)])
 
         except Exception as e:
             self.dialog_message(str(e))
 
+    def load_document(self, path, first_line=None):
+        # A document opened a moment ago comes back with its indexes, others
+        # get what the cache kept of their file
+        document, record_index = self.recent.take(path)
+        if document is None:
+            document = Document(path, index=False)
+            cache.load(document)
+        self.cancel_search(wait=True)
+        self.stop_loading()
+        self.set_aside()
+        self.document = document
+        self.variable_sites = None
+        self.problems = None
+        if self.statistics.isVisible():
+            self.statistics.show_message("Waiting for the file to load")
+        if self.problem_panel.isVisible():
+            self.problem_panel.show_message("Waiting for the file to load")
+
+        # A saved .fai is reused while the file is unchanged, otherwise it is built after indexing
+        file_format = detect_format(path)
+        if record_index is None and file_format in (FASTA, FASTQ):
+            record_index = load_index(path, file_format)
+        self.record_index = record_index
+        self.pending_jump = None
+
+        if first_line is not None:
+            self.value = first_line
+        self.scroll.blockSignals(True)
+        self.scroll.setMaximum(0)
+        self.scroll.blockSignals(False)
+        self.show_window(self.value)
+
+        # Lines show up as soon as the first chunk of the file is indexed
+        thread = IndexThread(document, file_format in (FASTA, FASTQ) and self.record_index is None, self)
+        thread.progress.connect(lambda lines, fraction: self.index_progress(document, fraction))
+        thread.records.connect(lambda index: self.records_indexed(document, index))
+        thread.failed.connect(lambda message: self.index_failed(document, message))
+        thread.finished.connect(lambda: self.index_finished(document))
+        thread.finished.connect(thread.deleteLater)
+        self.index_thread = thread
+        self.index_error = None
+        self.progress.setValue(0)
+        self.progress.show()
+        self.cancel_button.show()
+        thread.start()
+
+    def set_aside(self):
+        """Keep the current document for when it is opened again, with what was worked out on it."""
+        if self.document is None or self.document is self.converting:
+            return
+        cache.save(self.document, self.record_index)
+        self.recent.put(self.document, self.record_index)
+
+    def index_progress(self, document, fraction):
+        if document is not self.document:
+            return
+        incomplete = len(document) < self.window_end
+        document.refresh()
+        self.scroll.blockSignals(True)
+        self.scroll.setMaximum(len(document))
+        self.scroll.setValue(self.value)
+        self.scroll.blockSignals(False)
+        if incomplete and not self.editor.isModified():
+            self.show_window(self.value)
+        self.progress.setValue(int(fraction * 100))
+        if self.pending_jump is not None:
+            self.jump_to_record()
+
+    def index_finished(self, document):
+        if document is not self.document:
+            return
+        self.index_progress(document, 1)
+        self.progress.hide()
+        self.cancel_button.hide()
+        if self.index_error is not None:
+            self.statusbar.showMessage("Loading failed, {} lines available: {}".format(len(document), self.index_error))
+        elif document.indexed:
+            self.statusbar.showMessage("{} lines".format(len(document)))
+        else:
+            self.statusbar.showMessage("Loading cancelled, {} lines available".format(len(document)))
+        if self.statistics.isVisible():
+            self.refresh_statistics()
+        if self.problem_panel.isVisible():
+            self.refresh_problems()
+        if self.action_Variable_Sites.isChecked():
+            self.refresh_variable_sites()
+
+    def index_failed(self, document, message):
+        if document is self.document:
+            self.index_error = message
+
+    def records_indexed(self, document, index):
+        if document is self.document:
+            self.record_index = index
+
+    def goto_record(self):
+        if self.document is None:
+            return
+        if self.record_index is None:
+            if detect_format(self.path) in (FASTA, FASTQ):
+                self.dialog_message("Records are still being indexed")
+            else:
+                self.dialog_message("Only FASTA and FASTQ files have records to go to")
+            return
+        query, ok = QInputDialog.getText(self, "Go to record", "Record name or region (chr1:1000-2000):")
+        query = query.strip()
+        if not ok or not query:
+            return
+        try:
+            self.pending_jump = self.record_index.locate(query)
+        except ValueError as e:
+            self.dialog_message(str(e))
+            return
+        self.jump_to_record()
+
+    def jump_to_record(self):
+        line, column, end_line, end_column = self.pending_jump
+        # The index counts lines of the file, edits above may have moved them
+        first = self.document.from_original(line)
+        last = self.document.from_original(end_line)
+        if first is None or last is None:
+            self.pending_jump = None
+            self.dialog_message("The record was edited")
+            return
+        if last >= len(self.document):
+            self.statusbar.showMessage("Waiting for line {} to load...".format(last + 1))
+            return
+        self.pending_jump = None
+        self.flush_window()
+        self.scroll.setValue(first)
+        self.scroll_text()
+        self.editor.setSelection(first - self.value, column, last - self.value, end_column)
+
+    def cancel_loading(self):
+        if self.document is not None:
+            self.document.cancel_index()
+
+    def stop_loading(self):
+        self.cancel_loading()
+        if self.index_thread is not None and not sip.isdeleted(self.index_thread):
+            self.index_thread.wait()
+
+    def write_document(self, path):
+        if self.document is None:
+            with open(path, "w") as f:
+                f.write(self.editor.text())
+        else:
+            self.scroll_text()
+            self.document.save(path)
+        # Reopen from disk so the edits written out no longer take memory
+        self.load_document(path)
+
     def file_save(self):
         if self.path == "Untitled":
             self.file_saveAs()
             return
-        self.scroll_text()
         try:
-            text = ''.join(self.txt)
-            with open(self.path, "w") as f:
-                f.write(text)
+            self.write_document(self.path)
         except Exception as e:
             self.dialog_message(str(e))
 
     def file_saveAs(self):
-        self.scroll_text()
         path, _ = QFileDialog.getSaveFileName(
             parent=self, caption="Save file as", filter=config.FILTER_TYPES
         )
-        text = ''.join(self.txt)
+        if not path:
+            return
 
         try:
-            with open(path, "w") as f:
-                f.write(text)
-                self.path = path
-                self.setWindowTitle(os.path.basename(path))
-                self.setLexer(self.LEXERS[path.split(".")[-1]])
+            self.write_document(path)
+            self.path = path
+            self.setWindowTitle(os.path.basename(path))
+            self.setLexer(self.LEXERS[extension(path)])
 
         except Exception as e:
             self.dialog_message(str(e))
 
+    def file_convert(self):
+        if self.document is None:
+            return
+        source_format = detect_format(self.path)
+        if source_format not in READERS:
+            self.dialog_message("Only sequence files can be converted")
+            return
+        if self.converting is not None:
+            self.dialog_message("A conversion is already running")
+            return
+        if not self.document.indexed:
+            self.dialog_message("Wait for the file to finish loading before converting it")
+            return
+        target = self.ask_target("Convert to", WRITERS)
+        if target is None:
+            return
+        path, target_format, interleaved = target
+
+        # Converts a snapshot, unsaved edits included, while the editor stays usable
+        self.flush_window()
+        document = self.document
+        thread = ConvertThread(document.snapshot(), path, source_format, target_format, interleaved, self)
+        thread.done.connect(lambda conversion: self.convert_finished(document, str(conversion)))
+        thread.failed.connect(lambda message: self.convert_finished(document, None, message))
+        thread.finished.connect(thread.deleteLater)
+        self.converting = document
+        self.convert_thread = thread
+        self.statusbar.showMessage("Converting to {}...".format(os.path.basename(path)))
+        thread.start()
+
+    def ask_target(self, caption, formats):
+        """Ask for a file to write and its layout, returns (path, format, interleaved) or None."""
+        path, _ = QFileDialog.getSaveFileName(parent=self, caption=caption, filter=config.FILTER_TYPES)
+        if not path:
+            return None
+        target_format = detect_format(path)
+        if target_format not in formats:
+            self.dialog_message("Cannot write this file type")
+            return None
+        interleaved = False
+        if target_format in INTERLEAVED_FORMATS:
+            layout, ok = QInputDialog.getItem(self, caption, "Layout:", ["Sequential", "Interleaved"], 0, False)
+            if not ok:
+                return None
+            interleaved = layout == "Interleaved"
+        return path, target_format, interleaved
+
+    def convert_finished(self, document, report, error=None):
+        self.converting = None
+        if document is not self.document:
+            # The file was closed while the conversion was still reading it
+            document.close()
+        if error is not None:
+            self.statusbar.clearMessage()
+            self.dialog_message(error)
+        else:
+            self.statusbar.showMessage(report)
+
+    def document_changed(self):
+        self.statistics_changed()
+        self.problems_changed()
+        self.alignment_changed()
+
+    def toggle_statistics(self, on):
+        self.statistics.setVisible(on)
+
+    def statistics_visibility(self, visible):
+        self.action_Statistics.setChecked(visible)
+        if visible:
+            self.refresh_statistics()
+
+    def statistics_changed(self):
+        # Edits come in bursts, the statistics follow once they settle
+        if self.statistics.isVisible():
+            self.statistics_timer.start()
+
+    def refresh_statistics(self):
+        if self.document is None:
+            self.statistics.show_message("No file open")
+            return
+        file_format = detect_format(self.path)
+        if file_format not in (FASTA, FASTQ):
+            self.statistics.show_message("Statistics are available for FASTA and FASTQ files")
+            return
+        if self.statistics_thread is not None and not sip.isdeleted(self.statistics_thread) \
+                and self.statistics_thread.isRunning():
+            self.statistics_pending = True
+            return
+        self.flush_window()
+        # Chunks of the file already counted are reused from the document's cache
+        document = self.document
+        thread = StatisticsThread(document.snapshot(), file_format, self)
+        thread.progress.connect(self.statistics.show_progress)
+        thread.done.connect(lambda result: self.statistics_done(document, result))
+        thread.failed.connect(self.statistics.show_message)
+        thread.finished.connect(self.statistics_finished)
+        thread.finished.connect(thread.deleteLater)
+        self.statistics_thread = thread
+        thread.start()
+
+    def statistics_done(self, document, result):
+        if document is self.document:
+            self.statistics.show_statistics(result)
+
+    def statistics_finished(self):
+        self.statistics_thread = None
+        if self.statistics_pending:
+            self.statistics_pending = False
+            self.refresh_statistics()
+
+    def toggle_problems(self, on):
+        self.problem_panel.setVisible(on)
+
+    def problems_visibility(self, visible):
+        self.action_Problems.setChecked(visible)
+        if visible:
+            self.refresh_problems()
+        else:
+            self.problems = None
+            self.highlight_problems()
+
+    def problems_changed(self):
+        if self.problem_panel.isVisible():
+            self.problems_timer.start()
+
+    def refresh_problems(self):
+        if self.document is None:
+            self.problem_panel.show_message("No file open")
+            return
+        file_format = detect_format(self.path)
+        if file_format not in (FASTA, FASTQ, NEXUS, PHYLIP):
+            self.problem_panel.show_message("FASTA, FASTQ, NEXUS and PHYLIP files can be checked")
+            return
+        if not self.document.indexed:
+            # Checked once the whole file is indexed
+            self.problem_panel.show_message("Waiting for the file to load")
+            return
+        if self.problems_thread is not None and not sip.isdeleted(self.problems_thread) \
+                and self.problems_thread.isRunning():
+            self.problems_pending = True
+            return
+        self.flush_window()
+        document = self.document
+        version = document.version
+        thread = ValidateThread(document.snapshot(), file_format, self)
+        thread.progress.connect(self.problem_panel.show_progress)
+        thread.done.connect(lambda report: self.problems_done(document, version, report))
+        thread.failed.connect(self.problem_panel.show_message)
+        thread.finished.connect(self.problems_finished)
+        thread.finished.connect(thread.deleteLater)
+        self.problems_thread = thread
+        thread.start()
+
+    def problems_done(self, document, version, report):
+        if document is not self.document or not self.problem_panel.isVisible():
+            return
+        self.problems = (version, report.problems, [problem.line for problem in report.problems])
+        self.problem_panel.show_report(report)
+        self.highlight_problems()
+
+    def problems_finished(self):
+        self.problems_thread = None
+        if self.problems_pending:
+            self.problems_pending = False
+            self.refresh_problems()
+
+    def highlight_problems(self):
+        # Problems are sorted by line, the ones in view are found by bisection
+        self.editor.clearIndicatorRange(0, 0, self.editor.lines(), 0, self.PROBLEM_INDICATOR_ID)
+        if self.problems is None or self.document is None or self.editor.isModified():
+            return
+        version, problems, lines = self.problems
+        if version != self.document.version:
+            return
+        for i in range(bisect_left(lines, self.value), bisect_left(lines, self.window_end)):
+            problem = problems[i]
+            line = problem.line - self.value
+            length = problem.length or len(self.editor.text(line).rstrip("\r\n")) - problem.column
+            self.editor.fillIndicatorRange(line, problem.column, line, problem.column + max(length, 1),
+                                           self.PROBLEM_INDICATOR_ID)
+
+    def jump_to_problem(self, line, column):
+        if self.document is None or line >= len(self.document):
+            return
+        self.flush_window()
+        self.scroll.setValue(line)
+        self.scroll_text()
+        self.editor.setCursorPosition(line - self.value, column)
+        self.editor.setFocus()
+
+    def run_alignment(self, operation, done, message, failed=None):
+        """
+        Run operation(alignment) on a worker thread over a snapshot of the
+        document, then done(document, version, result) with the document and
+        version it ran on, or failed(message). Returns whether it started.
+        """
+        if self.document is None:
+            return False
+        file_format = detect_format(self.path)
+        if file_format not in (NEXUS, PHYLIP):
+            self.dialog_message("Alignment tools work on NEXUS and PHYLIP files")
+            return False
+        if not self.document.indexed:
+            self.dialog_message("Wait for the file to finish loading")
+            return False
+        if self.alignment_thread is not None and not sip.isdeleted(self.alignment_thread) \
+                and self.alignment_thread.isRunning():
+            self.dialog_message("An alignment operation is already running")
+            return False
+        self.flush_window()
+        # The matrix is cached on the document until the next edit
+        document = self.document
+        version = document.version
+        thread = AlignmentThread(document.snapshot(), file_format, operation, self)
+        thread.done.connect(lambda result: done(document, version, result))
+        thread.failed.connect(failed or self.alignment_failed)
+        thread.finished.connect(self.alignment_finished)
+        thread.finished.connect(thread.deleteLater)
+        self.alignment_thread = thread
+        self.statusbar.showMessage(message)
+        thread.start()
+        return True
+
+    def alignment_failed(self, message):
+        self.statusbar.clearMessage()
+        self.dialog_message(message)
+
+    def alignment_finished(self):
+        self.alignment_thread = None
+
+    def alignment_changed(self):
+        if self.action_Variable_Sites.isChecked():
+            self.alignment_timer.start()
+
+    def toggle_variable_sites(self, on):
+        self.variable_sites = None
+        self.highlight_variable_sites()
+        if on:
+            self.refresh_variable_sites()
+
+    def refresh_variable_sites(self):
+        if self.document is None or detect_format(self.path) not in (NEXUS, PHYLIP) or not self.document.indexed:
+            return
+        if self.alignment_thread is not None and not sip.isdeleted(self.alignment_thread) \
+                and self.alignment_thread.isRunning():
+            # Tried again once the running operation is done
+            self.alignment_timer.start()
+            return
+        if not self.run_alignment(lambda a: (a, a.variable_sites()), self.variable_sites_done,
+                                  "Finding variable sites...", self.variable_sites_failed):
+            self.action_Variable_Sites.setChecked(False)
+
+    def variable_sites_failed(self, message):
+        # Edits can leave the matrix unreadable for a while, no need for a dialog every time
+        self.variable_sites = None
+        self.highlight_variable_sites()
+        self.statusbar.showMessage(message)
+
+    def variable_sites_done(self, document, version, result):
+        if document is not self.document or not self.action_Variable_Sites.isChecked():
+            return
+        self.variable_sites = (version, result[0])
+        self.statusbar.showMessage("{} variable sites".format(np.count_nonzero(result[1])))
+        self.highlight_variable_sites()
+
+    def editor_updated(self, updated):
+        if updated & QsciScintilla.SC_UPDATE_H_SCROLL and self.variable_sites is not None:
+            self.highlight_variable_sites()
+
+    def highlight_variable_sites(self):
+        # Only the matrix lines in view are marked, and only the columns in view
+        self.editor.clearIndicatorRange(0, 0, self.editor.lines(), 0, self.VARIABLE_INDICATOR_ID)
+        if self.variable_sites is None or self.document is None or self.editor.isModified():
+            return
+        version, matrix = self.variable_sites
+        if version != self.document.version:
+            return
+        variable = matrix.variable_sites()
+        lines = matrix.lines
+        width = max(1, self.editor.SendScintilla(QsciScintilla.SCI_TEXTWIDTH, QsciScintilla.STYLE_DEFAULT, b"M"))
+        left = self.editor.SendScintilla(QsciScintilla.SCI_GETXOFFSET) // width
+        right = left + self.editor.viewport().width() // width + 1
+        first, last = lines.on_lines(self.value, self.window_end)
+        for i in range(first, last):
+            line, site, column, count = lines.lines[i], lines.sites[i], lines.columns[i], lines.counts[i]
+            if column < 0:
+                continue
+            # Sites are the characters of the line other than the spaces between groups
+            data = np.frombuffer(self.document.line(line).encode(), dtype=np.uint8)
+            positions = column + np.flatnonzero((data[column:] != 32) & (data[column:] != 9))[:count]
+            if len(positions) != count:
+                continue
+            marked = positions[variable[site:site + count]]
+            marked = marked[(marked >= left) & (marked < right)]
+            if not len(marked):
+                continue
+            breaks = np.flatnonzero(np.diff(marked) != 1) + 1
+            for start, stop in zip(marked[np.r_[0, breaks]], marked[np.r_[breaks - 1, len(marked) - 1]] + 1):
+                self.editor.fillIndicatorRange(line - self.value, int(start), line - self.value, int(stop),
+                                               self.VARIABLE_INDICATOR_ID)
+
+    def column_summary(self):
+        def summarize(a):
+            return a.ntax, a.nchar, np.count_nonzero(a.variable_sites()), np.count_nonzero(a.gap_only()), \
+                a.gap_fraction().mean() if a.nchar else 0.0, a.missing_fraction().mean() if a.nchar else 0.0
+        self.run_alignment(summarize, self.show_column_summary, "Summarizing columns...")
+
+    def show_column_summary(self, document, version, result):
+        self.statusbar.clearMessage()
+        QMessageBox.information(self, "Column Summary",
+                                "{} taxa, {} sites\n{} variable sites\n{} gap-only columns\n"
+                                "Gaps: {:.2%}\nMissing: {:.2%}".format(*result))
+
+    def save_alignment(self, caption, transform):
+        # transform(alignment) gives the records to write
+        target = self.ask_target(caption, (NEXUS, PHYLIP))
+        if target is None:
+            return
+        path, target_format, interleaved = target
+
+        def save(a):
+            write_records(transform(a), path, target_format, interleaved)
+            return "Saved {}".format(os.path.basename(path))
+        self.run_alignment(save, lambda document, version, report: self.statusbar.showMessage(report),
+                           "Saving {}...".format(os.path.basename(path)))
+
+    def save_consensus(self):
+        def records(a):
+            yield from a.records()
+            yield Record("consensus", a.consensus(), None)
+        self.save_alignment("Save with consensus row", records)
+
+    def save_strip_gaps(self):
+        self.save_alignment("Save without gap-only columns", lambda a: a.strip_gap_only().records())
+
+    def save_columns(self):
+        if self.document is None:
+            return
+        text, ok = QInputDialog.getText(self, "Extract columns", "Sites (from 1, e.g. 101-200):")
+        m = re.match(r"\s*(\d+)\s*-\s*(\d+)\s*$", text)
+        if not ok:
+            return
+        if not m or not 0 < int(m.group(1)) <= int(m.group(2)):
+            self.dialog_message("Give the sites as first-last, e.g. 101-200")
+            return
+        start, stop = int(m.group(1)) - 1, int(m.group(2))
+        self.save_alignment("Extract columns", lambda a: a.extract(start, min(stop, a.nchar)).records())
+
+    def toggle_instrumentation(self, on):
+        instrument.enable(on)
+        self.overlay.setVisible(on)
+
+    def export_trace(self):
+        if not instrument.events:
+            self.dialog_message("Nothing recorded, turn on the instrumentation overlay first")
+            return
+        path, _ = QFileDialog.getSaveFileName(parent=self, caption="Export trace", filter="Chrome trace (*.json)")
+        if not path:
+            return
+        try:
+            instrument.export(path)
+            self.statusbar.showMessage("{} spans written to {}".format(len(instrument.events), os.path.basename(path)))
+        except OSError as e:
+            self.dialog_message(str(e))
+
+    def toggle_profile(self, on):
+        if on:
+            instrument.start_profile()
+            return
+        if not instrument.profiling():
+            return
+        path, _ = QFileDialog.getSaveFileName(parent=self, caption="Save profile", filter="cProfile statistics (*.prof)")
+        try:
+            instrument.stop_profile(path)
+        except OSError as e:
+            self.dialog_message(str(e))
+
     def dialog_message(self, message):
         dlg = QMessageBox(self)
         dlg.setText(message)
@@ -404,8 +1764,20 @@ class SequenceEditor(QMainWindow, FORM_CLASS):
         mydialog.exec()
 
 
-if __name__ == "__main__":
-    app = QApplication(sys.argv)
+def start(argv):
+    """
+    Create the application and its window, opening the file given as the
+    first argument before the window first shows so it comes up with the
+    file's first lines while the rest is indexed.
+    """
+    app = QApplication(argv)
     toolkit = SequenceEditor()
+    if len(argv) > 1:
+        toolkit.open_path(os.path.abspath(argv[1]))
     toolkit.show()
+    return app, toolkit
+
+
+if __name__ == "__main__":
+    app, toolkit = start(sys.argv)
     sys.exit(app.exec_())
@@ -0,0 +1,264 @@
+"""
+Approximate search of DNA motifs in sequence data. Patterns can hold IUPAC
+ambiguity codes and match with up to k mismatches, found with the
+bit-parallel shift-and algorithm, or up to k edits, found with Myers'
+bit-vector algorithm. Both run over many lanes of the text at once as
+NumPy vectors, a lane being a slice of the text, so a step of either costs
+a few vector operations however long the text is.
+"""
+from collections import namedtuple
+
+import numpy as np
+
+from dna import BASES, IUPAC
+from formats import FASTQ
+from stats import line_bounds
+from workers import read_source
+
+# Bases in a pattern, the bits of a machine word. Patterns of up to 32
+# bases run on 32-bit words, which halves the memory the vectors take.
+MAX_LENGTH = 64
+# Steps run over the lanes of a text at least, and lanes at most
+MIN_STEPS = 256
+MAX_LANES = 1 << 14
+
+# start and end (exclusive) in the text, distance is mismatches or edits
+Match = namedtuple("Match", ["start", "end", "distance"])
+
+
+class Motif:
+    """
+    A pattern compiled for one strand: for every byte of the text, the bits
+    of the pattern positions it matches. A base of the text matches an IUPAC
+    code standing for every base it may be, so N in the pattern matches any
+    base while N in the text only matches N.
+    """
+
+    def __init__(self, pattern, k=0, edits=False):
+        pattern = pattern.strip().upper()
+        if not pattern:
+            raise ValueError("Empty DNA pattern")
+        unknown = set(pattern) - set(IUPAC)
+        if unknown:
+            raise ValueError("Not IUPAC nucleotide codes: {}".format("".join(sorted(unknown))))
+        if len(pattern) > MAX_LENGTH:
+            raise ValueError("DNA patterns are at most {} bases".format(MAX_LENGTH))
+        if k >= len(pattern):
+            raise ValueError("Allow fewer differences than the {} bases of the pattern".format(len(pattern)))
+        self.pattern = pattern
+        self.length = len(pattern)
+        self.k = k
+        self.edits = edits
+        word = np.uint32 if len(pattern) <= 32 else np.uint64
+        self.peq = _match_bits(pattern).astype(word)
+        self.reversed_peq = _match_bits(pattern[::-1]).astype(word)
+
+    @property
+    def span(self):
+        """Longest stretch of text a match can cover."""
+        return self.length + (self.k if self.edits else 0)
+
+
+def _match_bits(pattern):
+    masks = [IUPAC[code] for code in pattern]
+    by_bases = np.zeros(16, dtype=np.uint64)
+    for bases in range(1, 16):
+        by_bases[bases] = sum(1 << i for i, mask in enumerate(masks) if not bases & ~mask)
+    return by_bases[BASES]
+
+
+def _columns(text, overlap):
+    """
+    The text cut into lanes of equal width, each starting overlap bytes
+    before its slice, as a steps × lanes array, with the width.
+    """
+    lanes = max(1, min(len(text) // MIN_STEPS, MAX_LANES))
+    width = -(-len(text) // lanes)
+    padded = np.zeros(overlap + lanes * width, dtype=np.uint8)
+    padded[overlap:overlap + len(text)] = text
+    windows = np.lib.stride_tricks.as_strided(padded, shape=(lanes, width + overlap), strides=(width, 1))
+    return np.ascontiguousarray(windows.T), width
+
+
+def _shift_and(peq, length, k, columns):
+    """
+    Yield (step, lanes, mismatches) for the steps where a match with up to
+    k mismatches ends in some of the lanes.
+    """
+    word = peq.dtype.type
+    one, top = word(1), word(1 << (length - 1))
+    # states[d] has bit i set where the first i + 1 bases match with d mismatches or fewer
+    states = [np.zeros(columns.shape[1], dtype=word) for _ in range(k + 1)]
+    for step, column in enumerate(columns):
+        eq = peq[column]
+        for d in range(k, 0, -1):
+            states[d] = ((states[d] << one) | one) & eq | (states[d - 1] << one) | one
+        states[0] = ((states[0] << one) | one) & eq
+        lanes = np.flatnonzero(states[k] & top)
+        if len(lanes):
+            mismatches = np.full(len(lanes), k)
+            for d in range(k - 1, -1, -1):
+                mismatches[(states[d][lanes] & top) != 0] = d
+            yield step, lanes, mismatches
+
+
+def _myers(peq, length, columns, anchored=False):
+    """
+    Yield (step, scores) after every step: the edit distance of the best
+    match ending there in each lane, or with anchored that of the pattern
+    against the whole lane so far.
+    """
+    word = peq.dtype.type
+    one, mask, top = word(1), word((1 << length) - 1), word(1 << (length - 1))
+    pv = np.full(columns.shape[1], mask, dtype=word)
+    mv = np.zeros(columns.shape[1], dtype=word)
+    score = np.full(columns.shape[1], length, dtype=np.int64)
+    for step, column in enumerate(columns):
+        eq = peq[column]
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | ~(xh | pv)
+        mh = pv & xh
+        score += (ph & top) != 0
+        score -= (mh & top) != 0
+        ph = (ph << one) | one if anchored else ph << one
+        mh = mh << one
+        pv = (mh | ~(xv | ph)) & mask
+        mv = ph & xv
+        yield step, score
+
+
+def _starts(motif, text, ends):
+    """
+    Start of the best alignment of the pattern ending at each end, found by
+    running Myers' algorithm backwards from the ends, one lane per end.
+    """
+    span = motif.span
+    padded = np.concatenate((np.zeros(span, dtype=np.uint8), text))
+    # Step j reads the byte j + 1 before every end
+    columns = padded[ends[None, :] + span - 1 - np.arange(span)[:, None]]
+    best = np.full(len(ends), span + 1, dtype=np.int64)
+    lengths = np.zeros(len(ends), dtype=np.int64)
+    for step, score in _myers(motif.reversed_peq, motif.length, columns, anchored=True):
+        better = score < best
+        best[better] = score[better]
+        lengths[better] = step + 1
+    return ends - lengths
+
+
+def find(motif, text):
+    """
+    Matches of a motif in a text of bytes, in order. Of matches that overlap
+    the one with the fewest differences is kept.
+    """
+    text = np.frombuffer(text, dtype=np.uint8) if isinstance(text, bytes) else text
+    overlap = motif.span - 1
+    columns, width = _columns(text, overlap)
+    ends, distances = [], []
+    if motif.edits:
+        for step, score in _myers(motif.peq, motif.length, columns):
+            if step >= overlap:
+                lanes = np.flatnonzero(score <= motif.k)
+                ends.append(lanes * width + step - overlap + 1)
+                distances.append(score[lanes])
+    else:
+        for step, lanes, mismatches in _shift_and(motif.peq, motif.length, motif.k, columns):
+            if step >= overlap:
+                ends.append(lanes * width + step - overlap + 1)
+                distances.append(mismatches)
+    if not ends:
+        return []
+    ends, distances = np.concatenate(ends), np.concatenate(distances)
+    order = np.argsort(ends, kind="stable")
+    ends, distances = ends[order], distances[order]
+    keep = ends <= len(text)
+    if motif.edits:
+        # Ends next to a better one are the same match with a base more or less
+        adjacent = ends[1:] == ends[:-1] + 1
+        keep[1:] &= ~(adjacent & (distances[:-1] < distances[1:]))
+        keep[:-1] &= ~(adjacent & (distances[1:] < distances[:-1]))
+    ends, distances = ends[keep], distances[keep]
+    starts = _starts(motif, text, ends) if motif.edits else ends - motif.length
+    # A match running off the end of a record into the separators, each one a
+    # difference, is a match of the bases it covers
+    padded = np.concatenate((text, np.zeros(1, dtype=np.uint8)))
+    for _ in range(motif.k):
+        starts += ((starts < 0) | (padded[np.maximum(starts, 0)] == 0)) & (starts < ends)
+        ends -= (padded[ends - 1] == 0) & (starts < ends)
+    keep = starts < ends
+    starts, ends, distances = starts[keep], ends[keep], distances[keep]
+
+    matches = []
+    for start, end, distance in zip(starts.tolist(), ends.tolist(), distances.tolist()):
+        if matches and start < matches[-1].end:
+            if distance < matches[-1].distance and (len(matches) < 2 or start >= matches[-2].end):
+                matches[-1] = Match(start, end, distance)
+            continue
+        matches.append(Match(start, end, distance))
+    return matches
+
+
+def scan_chunk(source, tail, first_line, file_format, motifs):
+    """
+    Find the motifs in the sequences of a chunk of whole lines of a FASTA or
+    FASTQ file, a workers.chunk_source() starting at first_line, followed by
+    the lines of tail as far as a match starting in the chunk can reach.
+    Records are searched across their line wraps, never from one into the
+    next.
+
+    Returns (line, column, length, record) for every hit in order, with
+    length counting a line break as one character, and the number of FASTA
+    headers in the chunk. FASTA records are numbered from the chunk like
+    search._scan_chunk does.
+    """
+    raw = read_source(source)
+    size = len(raw)
+    raw += tail
+    data = np.frombuffer(raw, dtype=np.uint8)
+    starts, ends = line_bounds(data)
+    chunk_lines = int(np.searchsorted(starts, size))
+    if file_format == FASTQ:
+        kind = np.arange(len(starts)) % 4
+        header = kind == 0
+        sequence = kind == 1
+    else:
+        header = (ends > starts) & (data[starts] == ord(">"))
+        sequence = ~header & (ends > starts)
+    owner = np.cumsum(header)
+    lines = np.flatnonzero(sequence)
+    # Records are kept apart by more separators than a match can hold differences
+    separator = b"\0" * (max(motif.k for motif in motifs) + 1)
+    first = np.ones(len(lines), dtype=bool)
+    first[1:] = owner[lines[1:]] != owner[lines[:-1]]
+    parts = []
+    for line, is_first in zip(lines.tolist(), first.tolist()):
+        if is_first:
+            parts.append(separator)
+        parts.append(raw[starts[line]:ends[line]])
+    text = b"".join(parts)
+    lengths = (ends - starts)[lines]
+    offsets = np.cumsum(lengths + first * len(separator)) - lengths
+    # Offset of every line in characters, a line break counting as one
+    flat = np.cumsum(ends - starts + 1) - (ends - starts + 1)
+
+    found = set()
+    for motif in motifs:
+        matches = find(motif, text)
+        if not matches:
+            continue
+        where = np.array([(m.start, m.end - 1) for m in matches], dtype=np.int64)
+        segment = np.searchsorted(offsets, where, side="right") - 1
+        line = lines[segment]
+        column = where - offsets[segment]
+        position = flat[line] + column
+        for (start_line, _), (start_column, _), (begin, end) in zip(line.tolist(), column.tolist(),
+                                                                    position.tolist()):
+            if start_line < chunk_lines:
+                found.add((start_line, start_column, end + 1 - begin))
+
+    hits = []
+    for line, column, length in sorted(found):
+        record = (first_line + line) // 4 if file_format == FASTQ else int(owner[line]) - 1
+        hits.append((first_line + line, column, length, record))
+    headers = 0 if file_format == FASTQ else int(np.count_nonzero(header[:chunk_lines]))
+    return hits, headers
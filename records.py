@@ -0,0 +1,192 @@
+from collections import namedtuple
+
+import numpy as np
+
+# quality is None for formats without qualities
+Record = namedtuple("Record", ["name", "sequence", "quality"])
+
+# Records with more non-ACGT residues than this are kept one byte per residue
+MAX_EXCEPTION_FRACTION = 1 / 8
+
+_ALPHABET = np.frombuffer(b"ACGT", dtype=np.uint8)
+_SHIFTS = np.array([6, 4, 2, 0], dtype=np.uint8)
+# 2-bit code of every byte, 4 for anything that is not A, C, G or T
+_CODES = np.full(256, 4, dtype=np.uint8)
+for _code, _base in enumerate(b"ACGT"):
+    _CODES[_base] = _CODES[_base + 32] = _code
+
+
+class _Buffer:
+    """Growable NumPy array."""
+
+    def __init__(self, dtype):
+        self.data = np.empty(64, dtype=dtype)
+        self.size = 0
+
+    def extend(self, values):
+        end = self.size + len(values)
+        if end > len(self.data):
+            grown = np.empty(max(2 * len(self.data), end), dtype=self.data.dtype)
+            grown[:self.size] = self.data[:self.size]
+            self.data = grown
+        self.data[self.size:end] = values
+        self.size = end
+
+    def append(self, value):
+        self.extend((value,))
+
+    @property
+    def view(self):
+        return self.data[:self.size]
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes
+
+
+def _runs(mask, values=None):
+    """Start and end of every run of True in mask, also split where values changes."""
+    after_gap = ~mask[:-1]
+    before_gap = ~mask[1:]
+    if values is not None:
+        changed = values[1:] != values[:-1]
+        after_gap = after_gap | changed
+        before_gap = before_gap | changed
+    starts = np.flatnonzero(mask & np.concatenate(([True], after_gap)))
+    ends = np.flatnonzero(mask & np.concatenate((before_gap, [True]))) + 1
+    return starts, ends
+
+
+class RecordStore:
+    """
+    Sequence records held compactly in memory.
+
+    Names are kept as strings, residues are packed four to a byte where the
+    sequence is nucleotides. Anything other than A, C, G and T (N, IUPAC
+    ambiguity codes, gaps) goes in a list of runs laid over the packed data on
+    decoding, soft-masked lowercase in another one. Records that are mostly
+    something else, such as proteins, are kept one byte per residue.
+    Slices are decoded on demand, as text or as a NumPy array of bytes for
+    vectorized work.
+    """
+
+    def __init__(self):
+        self.names = []
+        self._start = _Buffer(np.int64)
+        self._length = _Buffer(np.int64)
+        self._packed = _Buffer(np.bool_)
+        self._bits = _Buffer(np.uint8)
+        self._raw = _Buffer(np.uint8)
+        # Base count of the packed records, each starts on a byte boundary
+        self._bases = 0
+        # Runs over the packed records, by position in the packed data
+        self._exception_start = _Buffer(np.int64)
+        self._exception_end = _Buffer(np.int64)
+        self._exception_byte = _Buffer(np.uint8)
+        self._lower_start = _Buffer(np.int64)
+        self._lower_end = _Buffer(np.int64)
+        self._quality_start = _Buffer(np.int64)
+        self._quality = _Buffer(np.uint8)
+
+    @classmethod
+    def from_records(cls, records):
+        store = cls()
+        for record in records:
+            store.append(record.name, record.sequence, record.quality)
+        return store
+
+    def __len__(self):
+        return len(self.names)
+
+    def append(self, name, sequence, quality=None):
+        data = np.frombuffer(sequence.encode("ascii", errors="replace"), dtype=np.uint8)
+        codes = _CODES[data]
+        exceptions = codes == 4
+        n = len(data)
+
+        self.names.append(name)
+        self._length.append(n)
+        self._quality_start.append(self._quality.size)
+        if quality:
+            self._quality.extend(np.frombuffer(quality.encode("ascii", errors="replace"), dtype=np.uint8))
+
+        if n and np.count_nonzero(exceptions) > n * MAX_EXCEPTION_FRACTION:
+            self._packed.append(False)
+            self._start.append(self._raw.size)
+            self._raw.extend(data)
+            return
+
+        base = self._bases
+        self._packed.append(True)
+        self._start.append(base)
+        if n:
+            starts, ends = _runs(exceptions, data)
+            self._exception_start.extend(starts + base)
+            self._exception_end.extend(ends + base)
+            self._exception_byte.extend(data[starts])
+            starts, ends = _runs((data >= 97) & ~exceptions)
+            self._lower_start.extend(starts + base)
+            self._lower_end.extend(ends + base)
+
+            padded = np.zeros(-(-n // 4) * 4, dtype=np.uint8)
+            padded[:n] = codes & 3
+            quads = padded.reshape(-1, 4)
+            self._bits.extend((quads[:, 0] << 6) | (quads[:, 1] << 4) | (quads[:, 2] << 2) | quads[:, 3])
+        self._bases += -(-n // 4) * 4
+
+    def length(self, index):
+        return int(self._length.data[index])
+
+    def array(self, index, start=0, stop=None):
+        """Residues [start, stop) of a record as a NumPy array of bytes."""
+        n = self.length(index)
+        stop = n if stop is None else max(0, min(stop, n))
+        start = max(0, min(start, stop))
+        offset = int(self._start.data[index])
+        if not self._packed.data[index]:
+            return self._raw.data[offset + start:offset + stop].copy()
+
+        begin, end = offset + start, offset + stop
+        data = self._bits.data[begin // 4:-(-end // 4)]
+        codes = ((data[:, None] >> _SHIFTS) & 3).ravel()
+        out = _ALPHABET[codes[begin % 4:begin % 4 + end - begin]]
+        self._overlay(out, begin, end, self._exception_start, self._exception_end, self._exception_byte)
+        self._overlay(out, begin, end, self._lower_start, self._lower_end)
+        return out
+
+    @staticmethod
+    def _overlay(out, begin, end, run_start, run_end, run_byte=None):
+        starts = run_start.view
+        ends = run_end.view
+        first = np.searchsorted(ends, begin, side="right")
+        last = np.searchsorted(starts, end)
+        if first >= last:
+            return
+        s = np.maximum(starts[first:last], begin) - begin
+        lengths = np.minimum(ends[first:last], end) - begin - s
+        # Position of every byte covered by the runs
+        covered = np.arange(lengths.sum()) + np.repeat(s - (np.cumsum(lengths) - lengths), lengths)
+        if run_byte is None:
+            out[covered] |= 0x20
+        else:
+            out[covered] = np.repeat(run_byte.view[first:last], lengths)
+
+    def sequence(self, index, start=0, stop=None):
+        return self.array(index, start, stop).tobytes().decode("ascii")
+
+    def quality(self, index):
+        begin = int(self._quality_start.data[index])
+        end = int(self._quality_start.data[index + 1]) if index + 1 < len(self) else self._quality.size
+        return self._quality.data[begin:end].tobytes().decode("ascii") if end > begin else None
+
+    def records(self):
+        for i, name in enumerate(self.names):
+            yield Record(name, self.sequence(i), self.quality(i))
+
+    @property
+    def nbytes(self):
+        """Memory taken by the sequence data, names not included."""
+        buffers = (self._start, self._length, self._packed, self._bits, self._raw,
+                   self._exception_start, self._exception_end, self._exception_byte,
+                   self._lower_start, self._lower_end, self._quality_start, self._quality)
+        return sum(buffer.nbytes for buffer in buffers)
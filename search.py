@@ -0,0 +1,356 @@
+import os
+import re
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import namedtuple, deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from dna import reverse_complement
+from document import EditJournal
+from formats import FASTA, FASTQ
+from instrument import timed
+from motif import Motif, scan_chunk
+from workers import chunk_source, line_chunks, ordered_map
+
+# Kinds of line a hit can be on
+TEXT = "text"
+NAME = "name"
+SEQUENCE = "sequence"
+QUALITY = "quality"
+KINDS = (TEXT, NAME, SEQUENCE, QUALITY)
+
+# Lines handed to a worker at a time
+LINES_PER_CHUNK = 1 << 15
+
+# line and column are 0-based, record is the index of the FASTA/FASTQ record
+# the hit belongs to (-1 before the first record or for plain text)
+Hit = namedtuple("Hit", ["line", "column", "length", "record", "kind"])
+
+
+def compile_pattern(pattern, regex=False, ignore_case=False):
+    flags = re.MULTILINE
+    if ignore_case:
+        flags |= re.IGNORECASE
+    if not regex:
+        pattern = re.escape(pattern)
+    return re.compile(pattern, flags)
+
+
+def _headers(text, first_line, file_format):
+    """Lines of the FASTA headers in a chunk of whole lines."""
+    headers = []
+    if file_format == FASTA:
+        line, pos = first_line, 0
+        for m in re.finditer(r"^>", text, re.MULTILINE):
+            line += text.count("\n", pos, m.start())
+            pos = m.start()
+            headers.append(line)
+    return headers
+
+
+def _matches(text, first_line, pattern, file_format, kinds, headers):
+    """Yield (match, line, offset of the line in text, record, kind) for every match in a chunk."""
+    line, line_start, pos = first_line, 0, 0
+    for m in pattern.finditer(text):
+        if m.start() == m.end():
+            continue
+        newlines = text.count("\n", pos, m.start())
+        if newlines:
+            line += newlines
+            line_start = text.rfind("\n", pos, m.start()) + 1
+        pos = m.start()
+
+        if file_format == FASTA:
+            record = bisect_right(headers, line) - 1
+            kind = NAME if text.startswith(">", line_start) else SEQUENCE
+        elif file_format == FASTQ:
+            record = line // 4
+            kind = (NAME, SEQUENCE, NAME, QUALITY)[line % 4]
+        else:
+            record = -1
+            kind = TEXT
+
+        if kinds is None or kind in kinds:
+            yield m, line, line_start, record, kind
+
+
+def _scan_chunk(text, first_line, pattern, file_format, kinds):
+    """
+    Find every match in a chunk of whole lines.
+
+    Returns the hits, with FASTA records numbered relative to the chunk, and
+    the number of FASTA headers in the chunk so the caller can rebase them.
+    """
+    headers = _headers(text, first_line, file_format)
+    hits = []
+    for m, line, line_start, record, kind in _matches(text, first_line, pattern, file_format, kinds, headers):
+        hits.append(Hit(line, m.start() - line_start, m.end() - m.start(), record, kind))
+    return hits, len(headers)
+
+
+def _replace_chunk(text, first_line, pattern, replacement, regex, file_format, kinds):
+    """
+    Replace every match in a chunk of whole lines, matches spanning lines
+    excepted. Returns (line, new text, [(column, length, replaced text)])
+    for every line changed, columns and lengths being those of the new text.
+    """
+    headers = _headers(text, first_line, file_format)
+    changed = []
+    current = None
+    for m, line, line_start, record, kind in _matches(text, first_line, pattern, file_format, kinds, headers):
+        old = m.group()
+        new = m.expand(replacement) if regex else replacement
+        if "\n" in old or "\n" in new:
+            continue
+        if line != current:
+            if current is not None:
+                parts.append(text[start + done:end])
+                changed.append((current, "".join(parts), entries))
+            current, start = line, line_start
+            end = text.find("\n", start) + 1 or len(text)
+            parts, entries, done, shift = [], [], 0, 0
+        column = m.start() - start
+        parts.append(text[start + done:m.start()])
+        parts.append(new)
+        entries.append((column + shift, len(new), old))
+        shift += len(new) - len(old)
+        done = m.end() - start
+    if current is not None:
+        parts.append(text[start + done:end])
+        changed.append((current, "".join(parts), entries))
+    return changed
+
+
+def scan_lines(lines, pattern, file_format=None, kinds=None):
+    """
+    Scan an iterable of lines, newlines included, such as a stream that can
+    only be read once. Yields (first line, lines, hits) a chunk at a time,
+    in order, with FASTA records numbered from the start of the stream.
+    """
+    kinds = set(kinds) if kinds else None
+    first_line = records = 0
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) == LINES_PER_CHUNK:
+            hits, headers = _scan_chunk("".join(chunk), first_line, pattern, file_format, kinds)
+            yield first_line, chunk, [hit._replace(record=hit.record + records) for hit in hits] if records else hits
+            first_line, records, chunk = first_line + len(chunk), records + headers, []
+    if chunk:
+        hits, headers = _scan_chunk("".join(chunk), first_line, pattern, file_format, kinds)
+        yield first_line, chunk, [hit._replace(record=hit.record + records) for hit in hits] if records else hits
+
+
+class HitIndex:
+    """
+    Hits of a search in flat arrays sorted by line, as they come in document
+    order from a search. The hits on a range of lines are found by bisection,
+    so drawing the ones in view does not depend on how many there are.
+    """
+
+    def __init__(self):
+        self._line = array("q")
+        self._column = array("q")
+        self._length = array("q")
+        self._record = array("q")
+        self._kind = array("b")
+
+    def extend(self, hits):
+        for hit in hits:
+            self._line.append(hit.line)
+            self._column.append(hit.column)
+            self._length.append(hit.length)
+            self._record.append(hit.record)
+            self._kind.append(KINDS.index(hit.kind))
+
+    def __len__(self):
+        return len(self._line)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("hit index out of range")
+        return Hit(self._line[i], self._column[i], self._length[i], self._record[i], KINDS[self._kind[i]])
+
+    def between(self, start, stop):
+        """Positions [first, last) of the hits on lines [start, stop)."""
+        return bisect_left(self._line, start), bisect_left(self._line, stop)
+
+    def on_lines(self, start, stop):
+        first, last = self.between(start, stop)
+        return [self[i] for i in range(first, last)]
+
+    def density(self, bins, lines):
+        """Number of hits in each of bins equal slices of a document of the given number of lines."""
+        if not len(self) or bins <= 0:
+            return np.zeros(max(bins, 0), dtype=np.int64)
+        positions = np.frombuffer(self._line, dtype=np.int64) * bins // max(lines, 1)
+        return np.bincount(np.minimum(positions, bins - 1), minlength=bins)
+
+
+class Search:
+    """
+    Scan a document for a pattern in chunks of lines spread over worker threads.
+
+    Iterating over a search yields lists of hits chunk by chunk, in document
+    order, as soon as each chunk is done, so the first hits are available long
+    before the scan ends. The scan runs over a snapshot of the document taken
+    when the search starts, unsaved edits included, and stops early once
+    cancel() is called.
+    """
+
+    def __init__(self, document, pattern, regex=False, file_format=None, kinds=None, workers=None, ignore_case=False):
+        self.document = document.snapshot()
+        self.pattern = compile_pattern(pattern, regex, ignore_case)
+        self.file_format = file_format
+        self.kinds = set(kinds) if kinds else None
+        self.workers = workers or os.cpu_count() or 1
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    @timed("search.chunk", lambda self, first_line: {"first_line": first_line})
+    def _chunk(self, first_line):
+        if self.cancelled:
+            return [], 0
+        text = self.document.text(first_line, first_line + LINES_PER_CHUNK)
+        return _scan_chunk(text, first_line, self.pattern, self.file_format, self.kinds)
+
+    def __iter__(self):
+        starts = iter(range(0, len(self.document), LINES_PER_CHUNK))
+        records = 0
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            pending = deque()
+            try:
+                # Keep a bounded number of chunks in flight ahead of the consumer
+                for first_line in starts:
+                    pending.append(pool.submit(self._chunk, first_line))
+                    if len(pending) >= self.workers * 2:
+                        break
+                while pending and not self.cancelled:
+                    hits, headers = pending.popleft().result()
+                    for first_line in starts:
+                        pending.append(pool.submit(self._chunk, first_line))
+                        break
+                    if self.file_format == FASTA and records:
+                        hits = self._rebase(hits, records)
+                    records += headers
+                    if hits:
+                        yield hits
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    def _rebase(self, hits, records):
+        return [hit._replace(record=hit.record + records) for hit in hits]
+
+    def all(self):
+        return [hit for hits in self for hit in hits]
+
+
+class SequenceSearch(Search):
+    """
+    Search the sequences of a FASTA or FASTQ document for a DNA motif, with
+    IUPAC codes, on both strands if asked and with up to k mismatches, or k
+    edits. Matches run across the line wraps of a record and are reported as
+    one hit on the line they start, its length counting every line break as
+    one character. Chunks are scanned in the worker processes.
+    """
+
+    # Lines past the end of a chunk read for a match running into them
+    MAX_TAIL_LINES = 1024
+
+    def __init__(self, document, pattern, file_format, k=0, edits=False, both_strands=False):
+        if file_format not in (FASTA, FASTQ):
+            raise ValueError("DNA search needs a FASTA or FASTQ file")
+        self.document = document.snapshot()
+        self.file_format = file_format
+        self.kinds = {SEQUENCE}
+        self.motifs = [Motif(pattern, k, edits)]
+        if both_strands:
+            reverse = reverse_complement(self.motifs[0].pattern)
+            if reverse != self.motifs[0].pattern:
+                self.motifs.append(Motif(reverse, k, edits))
+        self._cancelled = threading.Event()
+
+    def _tail(self, stop):
+        """The lines after stop holding the bases a match starting before stop can reach."""
+        if self.file_format == FASTQ:
+            return b""
+        need = max(motif.span for motif in self.motifs) - 1
+        lines = []
+        for line in range(stop, min(stop + self.MAX_TAIL_LINES, len(self.document))):
+            text = self.document.line(line)
+            if need <= 0 or text.startswith(">"):
+                break
+            lines.append(text)
+            need -= len(text.rstrip("\r\n"))
+        return "".join(lines).encode(self.document.encoding)
+
+    def _tasks(self, chunks):
+        for start, stop in chunks:
+            yield (chunk_source(self.document, start, stop), self._tail(stop), start, self.file_format,
+                   self.motifs)
+
+    def __iter__(self):
+        chunks = line_chunks(self.document, None, 4 if self.file_format == FASTQ else 1)
+        results = ordered_map(scan_chunk, self._tasks(chunks), len(chunks))
+        records = 0
+        try:
+            for found, headers in results:
+                if self.cancelled:
+                    break
+                hits = [Hit(line, column, length, record + (records if self.file_format == FASTA else 0),
+                            SEQUENCE) for line, column, length, record in found]
+                records += headers
+                if hits:
+                    yield hits
+        finally:
+            results.close()
+
+
+class Replace(Search):
+    """
+    Replace All over a snapshot of a document, scanned in chunks on worker
+    threads like a search. Iterating yields the changed lines chunk by
+    chunk; collect() gathers them with an EditJournal to undo them, to be
+    applied with Document.set_lines() if the document is still at version.
+    """
+
+    def __init__(self, document, pattern, replacement, regex=False, file_format=None, kinds=None, workers=None):
+        super().__init__(document, pattern, regex, file_format, kinds, workers)
+        self.replacement = replacement
+        self.regex = regex
+        self.version = document.version
+
+    @timed("replace.chunk", lambda self, first_line: {"first_line": first_line})
+    def _chunk(self, first_line):
+        if self.cancelled:
+            return [], 0
+        text = self.document.text(first_line, first_line + LINES_PER_CHUNK)
+        changed = _replace_chunk(text, first_line, self.pattern, self.replacement, self.regex,
+                                 self.file_format, self.kinds)
+        return changed, 0
+
+    def _rebase(self, changed, records):
+        return changed
+
+    def collect(self):
+        """Every changed line as (line, text) in document order, and the journal of the replacements."""
+        changes = []
+        journal = EditJournal()
+        for changed in self:
+            for line, text, entries in changed:
+                changes.append((line, text))
+                for column, length, replaced in entries:
+                    journal.record(line, column, length, replaced)
+        return changes, journal
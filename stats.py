@@ -0,0 +1,282 @@
+from collections import namedtuple
+
+import numpy as np
+
+from document import ORIGINAL
+from formats import FASTA, FASTQ
+from instrument import timed
+from workers import CHUNK_BYTES, LINES_PER_CHUNK, ordered_map, read_source
+
+# Phred+33 quality scores counted
+MAX_QUALITY = 94
+# Bins of the length histogram
+LENGTH_BINS = 40
+
+# Counts of one chunk of a file, merged in document order. FASTA records can
+# cross chunks: lead is the bases before the first header of the chunk, which
+# belong to the record before, tail those of the last record, None without a
+# header. lengths and length_counts hold the lengths of the records entirely
+# inside the chunk, as unique values with their counts.
+Partial = namedtuple("Partial", ["records", "counts", "lead", "tail", "lengths", "length_counts",
+                                 "quality_sum", "quality_count", "quality_hist"])
+
+
+class Statistics:
+    """Summary of the records of a FASTA or FASTQ document."""
+
+    def __init__(self, file_format, records, counts, lengths, length_counts,
+                 quality_sum=None, quality_count=None, quality_hist=None):
+        self.file_format = file_format
+        self.records = records
+        # Residue counts by byte value
+        self.counts = counts
+        self.bases = int(counts.sum())
+        self.lengths = lengths
+        self.length_counts = length_counts
+        self.quality_sum = quality_sum
+        self.quality_count = quality_count
+        self.quality_hist = quality_hist
+
+    def count(self, residues):
+        return int(sum(self.counts[b] for b in residues.encode()))
+
+    @property
+    def gc_fraction(self):
+        acgt = self.count("ACGTacgt")
+        return self.count("GCgc") / acgt if acgt else 0.0
+
+    @property
+    def n_fraction(self):
+        return self.count("Nn") / self.bases if self.bases else 0.0
+
+    def nx(self, x):
+        """Length L such that records of length L or more hold x percent of the bases."""
+        if not len(self.lengths):
+            return 0
+        total = np.cumsum((self.lengths * self.length_counts)[::-1])
+        i = np.searchsorted(total, total[-1] * x / 100)
+        return int(self.lengths[::-1][i])
+
+    @property
+    def n50(self):
+        return self.nx(50)
+
+    @property
+    def n90(self):
+        return self.nx(90)
+
+    @property
+    def min_length(self):
+        return int(self.lengths[0]) if len(self.lengths) else 0
+
+    @property
+    def max_length(self):
+        return int(self.lengths[-1]) if len(self.lengths) else 0
+
+    @property
+    def mean_length(self):
+        return self.bases / self.records if self.records else 0.0
+
+    def length_histogram(self, bins=LENGTH_BINS):
+        """(bin edges, record counts) over the record lengths."""
+        if not len(self.lengths):
+            return np.zeros(2), np.zeros(1, dtype=np.int64)
+        counts, edges = np.histogram(self.lengths, bins=bins, weights=self.length_counts)
+        return edges, counts.astype(np.int64)
+
+    @property
+    def mean_quality(self):
+        """Mean Phred quality at every read position, None for FASTA."""
+        if self.quality_sum is None:
+            return None
+        return self.quality_sum / np.maximum(self.quality_count, 1)
+
+
+def line_bounds(data):
+    """Start and end of every line of a chunk, ends before the line ending."""
+    newlines = np.flatnonzero(data == 10)
+    starts = np.concatenate(([0], newlines + 1))
+    ends = np.concatenate((newlines, [len(data)]))
+    if starts[-1] == len(data):
+        starts, ends = starts[:-1], ends[:-1]
+    cr = (ends > starts) & (data[np.maximum(ends - 1, 0)] == 13)
+    return starts, ends - cr
+
+
+def _byte_counts(data):
+    """Count of every byte value, counted as pairs, which halves the work of bincount."""
+    even = len(data) // 2 * 2
+    pairs = np.bincount(data[:even].view(np.uint16), minlength=1 << 16).reshape(256, 256)
+    counts = pairs.sum(axis=0) + pairs.sum(axis=1)
+    if even < len(data):
+        counts[data[-1]] += 1
+    return counts
+
+
+def _line_bytes(data, starts, lengths):
+    """
+    Bytes of the given lines and the position in its line of every byte,
+    or a 2D array and None when the lines are all the same length.
+    """
+    if len(lengths) and (lengths == lengths[0]).all():
+        return data[starts[:, None] + np.arange(lengths[0])], None
+    offsets = np.repeat(np.cumsum(lengths) - lengths, lengths)
+    positions = np.arange(int(lengths.sum()), dtype=np.int64) - offsets
+    return data[np.repeat(starts, lengths) + positions], positions
+
+
+def _unique(lengths):
+    values, counts = np.unique(lengths, return_counts=True)
+    return values.astype(np.int64), counts.astype(np.int64)
+
+
+def count_chunk(data, file_format, phase=0):
+    """
+    Counts of a chunk of whole lines, with phase the line number of its first
+    line modulo 4 for FASTQ.
+    """
+    data = np.frombuffer(data, dtype=np.uint8)
+    starts, ends = line_bounds(data)
+    lengths = ends - starts
+    # Residues are everything but the other lines and the line endings
+    counts = _byte_counts(data)
+    quality_sum = quality_count = quality_hist = None
+    if file_format == FASTQ:
+        kind = (np.arange(len(starts)) + phase) % 4
+        other = (kind == 0) | (kind == 2)
+        records = int(np.count_nonzero(kind == 0))
+        lead, tail = 0, None
+        record_lengths = _unique(lengths[kind == 1])
+
+        quality = kind == 3
+        scores, positions = _line_bytes(data, starts[quality], lengths[quality])
+        if positions is not None:
+            quality_sum = np.bincount(positions, weights=scores)
+            quality_count = np.bincount(positions)
+        else:
+            quality_sum = scores.sum(axis=0, dtype=np.int64).astype(np.float64)
+            quality_count = np.full(scores.shape[1], scores.shape[0], dtype=np.int64)
+            scores = scores.ravel()
+        quality_hist = _byte_counts(scores)
+        counts -= quality_hist
+        quality_sum -= 33 * quality_count
+        quality_hist = quality_hist[33:33 + MAX_QUALITY]
+    else:
+        other = data[starts] == ord(">")
+        records = int(np.count_nonzero(other))
+        # Bases of every line added up per record, record 0 being the one before the first header
+        owner = np.cumsum(other)
+        per_record = np.bincount(owner, weights=np.where(other, 0, lengths), minlength=records + 1).astype(np.int64)
+        lead = int(per_record[0])
+        tail = int(per_record[-1]) if records else None
+        record_lengths = _unique(per_record[1:-1])
+    counts -= _byte_counts(_line_bytes(data, starts[other], lengths[other])[0].ravel())
+    counts[10] = counts[13] = 0
+    return Partial(records, counts, lead, tail, record_lengths[0], record_lengths[1],
+                   quality_sum, quality_count, quality_hist)
+
+
+def _count_source(source, file_format, phase):
+    return count_chunk(read_source(source), file_format, phase)
+
+
+def _add(a, b):
+    """Sum of two arrays of different lengths."""
+    if a is None:
+        return b
+    if b is None:
+        return a
+    if len(a) < len(b):
+        a, b = b, a
+    a = a.copy()
+    a[:len(b)] += b
+    return a
+
+
+def merge(partials, file_format):
+    """Statistics of a document from the counts of its chunks, in order."""
+    records = 0
+    counts = np.zeros(256, dtype=np.int64)
+    lengths, length_counts = [], []
+    current = None
+    quality_sum = quality_count = quality_hist = None
+    for p in partials:
+        records += p.records
+        counts += p.counts
+        lengths.append(p.lengths)
+        length_counts.append(p.length_counts)
+        if file_format == FASTA:
+            if current is not None:
+                current += p.lead
+            if p.tail is not None:
+                if current is not None:
+                    lengths.append(np.array([current], dtype=np.int64))
+                    length_counts.append(np.ones(1, dtype=np.int64))
+                current = p.tail
+        quality_sum = _add(quality_sum, p.quality_sum)
+        quality_count = _add(quality_count, p.quality_count)
+        quality_hist = _add(quality_hist, p.quality_hist)
+    if current is not None:
+        lengths.append(np.array([current], dtype=np.int64))
+        length_counts.append(np.ones(1, dtype=np.int64))
+    values = np.concatenate(lengths) if lengths else np.zeros(0, dtype=np.int64)
+    weights = np.concatenate(length_counts) if length_counts else np.zeros(0, dtype=np.int64)
+    unique, inverse = np.unique(values, return_inverse=True)
+    weights = np.bincount(inverse, weights=weights, minlength=len(unique)).astype(np.int64)
+    return Statistics(file_format, records, counts, unique, weights, quality_sum, quality_count, quality_hist)
+
+
+def _chunks(document, file_format):
+    """
+    Yield (key, where) for every chunk of the document in order, where is
+    (begin, end) bytes of the file or lines [start, stop) of the document
+    where they are edited. Chunks of the file are cut on a fixed grid of
+    its bytes so an edit only changes the keys of the chunks it touches,
+    edited lines every LINES_PER_CHUNK lines like workers.line_chunks().
+    """
+    offsets = document.line_offsets()
+    line = 0
+    for source, first, count in document.iter_pieces(0, len(document)):
+        phase = line % 4 if file_format == FASTQ else 0
+        if source == ORIGINAL:
+            begin, end = document.line_range(first, first + count)
+            grid = np.arange((begin // CHUNK_BYTES + 1) * CHUNK_BYTES, end, CHUNK_BYTES)
+            cuts = np.unique(np.searchsorted(offsets, grid))
+            bounds = [first] + [int(c) for c in cuts if first < c < first + count] + [first + count]
+            for a, b in zip(bounds, bounds[1:]):
+                piece_phase = (phase + a - first) % 4 if file_format == FASTQ else 0
+                yield (ORIGINAL, a, b, piece_phase), document.line_range(a, b)
+        else:
+            for a in range(first, first + count, LINES_PER_CHUNK):
+                size = min(LINES_PER_CHUNK, first + count - a)
+                piece_phase = (phase + a - first) % 4 if file_format == FASTQ else 0
+                yield (source, a, size, piece_phase), (line + a - first, line + a - first + size)
+        line += count
+
+
+def _chunk_source(document, key, where):
+    """A chunk of _chunks() for a worker, like workers.chunk_source()."""
+    if key[0] != ORIGINAL:
+        return document.text(*where).encode(document.encoding)
+    if document.compressed:
+        return document.raw(*where)
+    return (document.path,) + tuple(where)
+
+
+@timed("statistics")
+def compute(document, file_format, progress=None):
+    """
+    Statistics of a FASTA or FASTQ document over its indexed lines. Chunks
+    of the file are counted in worker processes. Counts are cached on the
+    document per chunk, so after an edit only the chunks it touched are
+    counted again.
+    """
+    cache = document.analysis.get("statistics", {})
+    chunks = list(_chunks(document, file_format))
+    missing = {key: where for key, where in chunks if key not in cache}
+    # The bytes of compressed or edited chunks are only read as a worker frees up
+    tasks = ((_chunk_source(document, key, where), file_format, key[3]) for key, where in missing.items())
+    counted = dict(zip(missing, ordered_map(_count_source, tasks, len(missing), progress)))
+    fresh = {key: counted[key] if key in counted else cache[key] for key, _ in chunks}
+    document.analysis["statistics"] = fresh
+    return merge((fresh[key] for key, _ in chunks), file_format)
@@ -0,0 +1,288 @@
+"""
+Transforms of the sequences of FASTA and FASTQ files: complement, reverse
+complement, case, T to U and back, and translation in six frames. The
+residues of a chunk of lines are gathered into one NumPy array and changed
+through lookup tables, and reversed record by record through index
+arithmetic, so no step goes through Python for every character.
+"""
+import threading
+
+import numpy as np
+
+from dna import CODON_BASES, COMPLEMENT, GENETIC_CODE, RNA_COMPLEMENT, TO_DNA, TO_RNA
+from document import split_lines
+from formats import FASTA, FASTQ
+from stats import line_bounds
+from workers import chunk_source, line_chunks, read_source
+
+REVERSE_COMPLEMENT = "Reverse complement"
+COMPLEMENT_ONLY = "Complement"
+UPPERCASE = "Uppercase"
+LOWERCASE = "Lowercase"
+T_TO_U = "T to U"
+U_TO_T = "U to T"
+TRANSLATE = "Translation in six frames"
+OPERATIONS = (REVERSE_COMPLEMENT, COMPLEMENT_ONLY, UPPERCASE, LOWERCASE, T_TO_U, U_TO_T, TRANSLATE)
+# Operations that need every record whole
+WHOLE_RECORDS = (REVERSE_COMPLEMENT, TRANSLATE)
+# Lines read at a time looking for the header of a record
+RECORD_SCAN_LINES = 1 << 12
+
+
+_IDENTITY = bytes(range(256))
+# Byte tables of the operations that change every residue on its own
+_TABLES = {
+    UPPERCASE: _IDENTITY.upper(),
+    LOWERCASE: _IDENTITY.lower(),
+    T_TO_U: TO_RNA,
+    U_TO_T: TO_DNA,
+}
+# Amino acid of the codon of places a, b and c in the order of the genetic
+# code at 25 a + 5 b + c, X where a place is 4, not a base
+_CODONS = np.full(125, ord("X"), dtype=np.uint8)
+_PLACES = np.arange(64)
+_CODONS[25 * (_PLACES >> 4) + 5 * (_PLACES >> 2 & 3) + (_PLACES & 3)] = np.frombuffer(GENETIC_CODE, dtype=np.uint8)
+# Place of the complement of every place
+_CODON_COMPLEMENT = np.array([2, 3, 0, 1, 4], dtype=np.uint8)
+
+
+def _layout(data, file_format, first_line):
+    """Bounds of the lines of a chunk, which are headers, residues and qualities, and the record of each."""
+    starts, ends = line_bounds(data)
+    if file_format == FASTQ:
+        number = first_line + np.arange(len(starts))
+        return starts, ends, number % 4 == 0, number % 4 == 1, number % 4 == 3, number // 4
+    header = (ends > starts) & (data[starts] == ord(">"))
+    return starts, ends, header, ~header, np.zeros(len(starts), dtype=bool), np.cumsum(header)
+
+
+def _spans(starts, ends, lines, begin, end):
+    """The given lines clipped to bytes [begin, end), those left empty dropped, as (lines, starts, ends)."""
+    first, last = np.clip(starts[lines], begin, end), np.clip(ends[lines], begin, end)
+    filled = last > first
+    return lines[filled], first[filled], last[filled]
+
+
+def _mask(size, first, last):
+    """Bytes of a chunk inside the given spans, which neither overlap nor touch."""
+    marks = np.zeros(size + 1, dtype=np.int8)
+    marks[first] += 1
+    marks[last] -= 1
+    return np.cumsum(marks[:-1], dtype=np.int8).view(bool)
+
+
+def _sizes(groups, lengths):
+    """Total length of every run of equal groups, a group being the record of a span."""
+    if not len(groups):
+        return np.zeros(0, dtype=np.int64)
+    first = np.flatnonzero(np.concatenate(([True], groups[1:] != groups[:-1])))
+    return np.add.reduceat(lengths, first)
+
+
+def _reversed(values, sizes):
+    """Blocks of the given sizes of values, each reversed and left in place."""
+    backwards = values[::-1]
+    if len(sizes) < 2:
+        return [backwards]
+    stops = len(values) - np.cumsum(sizes)
+    return [backwards[stop:stop + size] for stop, size in zip(stops.tolist(), sizes.tolist())]
+
+
+def _rna(values, sizes):
+    """Which blocks of residues hold U but no T, None if none holds U."""
+    bases = values | 32
+    u = np.flatnonzero(bases == ord("u"))
+    if not len(u):
+        return None
+    ends = np.cumsum(sizes)
+    rna = np.zeros(len(sizes), dtype=bool)
+    rna[np.searchsorted(ends, u, side="right")] = True
+    rna[np.searchsorted(ends, np.flatnonzero(bases == ord("t")), side="right")] = False
+    return rna
+
+
+def _complement(blocks, rna):
+    if rna is None or not rna.any():
+        return np.concatenate(blocks).tobytes().translate(COMPLEMENT)
+    return b"".join(block.tobytes().translate(RNA_COMPLEMENT if is_rna else COMPLEMENT)
+                    for block, is_rna in zip(blocks, rna.tolist()))
+
+
+def _amino_acids(codes):
+    """Amino acid of the codon starting at every base, X where it holds anything but A, C, G, T or U."""
+    amino_acids = np.full(len(codes), ord("X"), dtype=np.uint8)
+    if len(codes) > 2:
+        amino_acids[:-2] = _CODONS[codes[:-2] * 25 + codes[1:-1] * 5 + codes[2:]]
+    return amino_acids
+
+
+def _translate(raw, data, starts, ends, header, record, lines, first, last):
+    """
+    Six records for every record of a FASTA chunk, named after it with _1
+    to _3 for the frames of the strand given and _4 to _6 for those of its
+    reverse complement, as transeq names them, wrapped like the record.
+    Frames without a whole codon are left out.
+    """
+    newline = b"\r\n" if len(ends) and raw[ends[0]:ends[0] + 2] == b"\r\n" else b"\n"
+    records = record[lines]
+    ids, where = np.unique(records, return_index=True)
+    sizes = _sizes(records, last - first)
+    codes = CODON_BASES[data[_mask(len(data), first, last)]]
+    strands = (_amino_acids(codes), _amino_acids(_CODON_COMPLEMENT[np.concatenate(_reversed(codes, sizes))]))
+    headers = np.flatnonzero(header)
+    names = dict(zip(record[headers].tolist(), headers.tolist()))
+    # A record on more than one line is wrapped at the width of its first
+    counts = np.diff(np.append(where, len(lines)))
+    widths = np.where(counts > 1, (last - first)[where], 0)
+    out = []
+    low = 0
+    for number, size, width in zip(ids.tolist(), sizes.tolist(), widths.tolist()):
+        line = names.get(number)
+        name = raw[starts[line] + 1:ends[line]] if line is not None else b""
+        name, _, description = name.partition(b" ")
+        for frame in range(6):
+            protein = strands[frame // 3][low + frame % 3:low + size - 2:3].tobytes()
+            if not protein:
+                continue
+            out.append(b">" + name + b"_%d" % (frame + 1) + (b" " + description if description else b"") + newline)
+            step = width or len(protein)
+            out.extend(protein[i:i + step] + newline for i in range(0, len(protein), step))
+        low += size
+    return b"".join(out)
+
+
+def transform_chunk(raw, operation, file_format, first_line=0, begin=0, end=None):
+    """
+    Transform the residues of a chunk of whole lines of a FASTA or FASTQ
+    file starting at first_line, or only those in bytes [begin, end) of it.
+    Reversal runs within each record, so chunks have to hold whole records
+    for a reverse complement, the qualities of FASTQ records being reversed
+    with them. Returns the new bytes of the chunk.
+    """
+    data = np.frombuffer(raw, dtype=np.uint8)
+    end = len(raw) if end is None else end
+    starts, ends, header, residues, quality, record = _layout(data, file_format, first_line)
+    lines, first, last = _spans(starts, ends, np.flatnonzero(residues), begin, end)
+    if operation == TRANSLATE:
+        return _translate(raw, data, starts, ends, header, record, lines, first, last)
+    mask = _mask(len(data), first, last)
+    if operation in _TABLES:
+        return np.where(mask, np.frombuffer(raw.translate(_TABLES[operation]), dtype=np.uint8), data).tobytes()
+
+    out = data.copy()
+    values = data[mask]
+    sizes = _sizes(record[lines], last - first)
+    if operation == REVERSE_COMPLEMENT:
+        blocks = _reversed(values, sizes)
+        scores, first, last = _spans(starts, ends, np.flatnonzero(quality), begin, end)
+        if len(scores):
+            marked = _mask(len(data), first, last)
+            out[marked] = np.concatenate(_reversed(data[marked], _sizes(record[scores], last - first)))
+    else:
+        blocks = [values]
+        sizes = np.array([len(values)])
+    out[mask] = np.frombuffer(_complement(blocks, _rna(np.concatenate(blocks), sizes)), dtype=np.uint8)
+    return out.tobytes()
+
+
+def record_range(document, file_format, start, stop):
+    """Lines [first, last) of the records lines [start, stop) belong to."""
+    if file_format == FASTQ:
+        return start - start % 4, min(len(document), -(-stop // 4) * 4)
+    first = start
+    while first > 0:
+        block = split_lines(document.text(max(0, first - RECORD_SCAN_LINES), first + 1))
+        headers = [i for i, line in enumerate(block) if line.startswith(">")]
+        if headers:
+            first = first + 1 - len(block) + headers[-1]
+            break
+        first = max(0, first - RECORD_SCAN_LINES)
+    last = stop
+    while last < len(document):
+        block = split_lines(document.text(last, last + RECORD_SCAN_LINES))
+        headers = [i for i, line in enumerate(block) if line.startswith(">")]
+        if headers:
+            return first, last + headers[0]
+        last += len(block)
+    return first, len(document)
+
+
+class Transform:
+    """
+    A transform of lines [start, stop) of a snapshot of a document, worked
+    out a chunk of lines at a time, or of the part of them selected from a
+    column of the first line to a column of the last. Iterating yields the
+    changed ranges as (start, stop, new lines) in document order, to apply
+    with Document.replace_ranges() if the document is still at version.
+    Chunks are cut between records where the operation needs them whole, so
+    only one chunk and the longest record are in memory at once, and new
+    lines go to the document's spill file as they come, leaving only
+    references to them.
+    """
+
+    def __init__(self, document, operation, file_format, start=0, stop=None, selection=None):
+        if file_format not in (FASTA, FASTQ):
+            raise ValueError("Sequence transforms need a FASTA or FASTQ file")
+        if operation not in OPERATIONS:
+            raise ValueError("Unknown transform {!r}".format(operation))
+        if operation == TRANSLATE and file_format != FASTA:
+            raise ValueError("Translation writes protein FASTA records, it needs a FASTA file")
+        self.document = document.snapshot()
+        self.operation = operation
+        self.file_format = file_format
+        self.start = start
+        self.stop = len(document) if stop is None else stop
+        self.selection = selection
+        self.version = document.version
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def _encode(self, start, stop):
+        return read_source(chunk_source(self.document, start, stop))
+
+    def _selected(self):
+        first, last = self.selection
+        raw = self._encode(self.start, self.stop)
+        begin = len(self.document.line(self.start)[:first].encode(self.document.encoding))
+        end = len(raw) - len(self.document.line(self.stop - 1)[last:].encode(self.document.encoding))
+        return raw, begin, end
+
+    def _chunks(self):
+        for start, stop in line_chunks(self.document, self.stop, 4 if self.file_format == FASTQ else 1):
+            if stop > self.start:
+                yield max(start, self.start), stop
+
+    def __iter__(self):
+        if self.selection is not None:
+            raw, begin, end = self._selected()
+            new = transform_chunk(raw, self.operation, self.file_format, self.start, begin, end)
+            if new != raw:
+                yield self.start, self.stop, self.document.spill(new)
+            return
+        whole = self.operation in WHOLE_RECORDS and self.file_format == FASTA
+        carry, line = b"", self.start
+        for start, stop in self._chunks():
+            if self.cancelled:
+                return
+            raw = carry + self._encode(start, stop)
+            carry = b""
+            if whole and stop < self.stop:
+                # The last record may go on in the next chunk
+                cut = raw.rfind(b"\n>") + 1
+                raw, carry = raw[:cut], raw[cut:]
+                if not raw:
+                    continue
+            count = raw.count(b"\n") if carry else stop - line
+            new = transform_chunk(raw, self.operation, self.file_format, line)
+            if new != raw:
+                yield line, line + count, self.document.spill(new)
+            line += count
+
+    def collect(self):
+        return list(self)
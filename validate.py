@@ -0,0 +1,315 @@
+import re
+from collections import namedtuple
+
+import numpy as np
+
+from alignment import matrix_lines
+from formats import FASTA, FASTQ, NEXUS, PHYLIP, phylip_layout
+from instrument import timed
+from stats import line_bounds
+from workers import chunk_source, line_chunks, ordered_map, read_source
+
+# Problems kept per chunk, the rest are only counted
+MAX_PROBLEMS = 1000
+
+# line and column are 0-based, length is the number of characters at fault,
+# 0 for the rest of the line
+Problem = namedtuple("Problem", ["line", "column", "message", "length"], defaults=[0])
+# Problems in line order, with count the number found including those not kept
+Report = namedtuple("Report", ["problems", "count"])
+
+# Counts of one chunk of a FASTA or FASTQ file, merged in document order.
+# FASTA records can cross chunks: lead is the first sequence line before the
+# first header of the chunk, first_header whether the first non-empty line
+# is a header (None without one) and open the last header when no sequence
+# follows it in the chunk. ids holds 64-bit hashes of the record IDs and
+# id_lines the lines of their headers.
+Partial = namedtuple("Partial", ["problems", "count", "headers", "lead", "first_header", "open", "ids", "id_lines"])
+
+# Bytes allowed in sequence lines: letters, gaps, stops and whitespace
+_RESIDUES = np.zeros(256, dtype=bool)
+for _value in b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz-.*\t\r\n ":
+    _RESIDUES[_value] = True
+# Phred+33 quality characters
+_QUALITY = np.zeros(256, dtype=bool)
+_QUALITY[33:127] = True
+_QUALITY[[10, 13]] = True
+# Characters of alignment matrices: residues, gaps, missing data, digits of
+# discrete characters and the brackets of polymorphisms
+_ALIGNMENT_INVALID = re.compile(r"[^A-Za-z0-9\-?.*~(){}\s]")
+
+_HASH_BASE = np.uint64(0x100000001B3)
+_powers = np.ones(1, dtype=np.uint64)
+
+
+def _hash_powers(n):
+    global _powers
+    if len(_powers) < n:
+        factors = np.full(n, _HASH_BASE, dtype=np.uint64)
+        factors[0] = 1
+        _powers = np.cumprod(factors, dtype=np.uint64)
+    return _powers[:n]
+
+
+def _runs(lines):
+    """First line and line after the last of every run of consecutive lines set in a mask."""
+    edges = np.diff(np.concatenate(([0], lines.view(np.int8), [0])))
+    return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+
+
+def _first_bad(raw, data, starts, ends, allowed, lines):
+    """(line, position) of the first byte not allowed on each of the given lines."""
+    # Most chunks are clean: their lines are screened at the speed of
+    # bytes.translate and only searched byte by byte when that finds a fault
+    first, stop = _runs(lines)
+    text = b"".join([raw[a:b] for a, b in zip(starts[first].tolist(), ends[stop - 1].tolist())])
+    if not text.translate(None, bytes(np.flatnonzero(allowed).tolist())):
+        return []
+    bad = np.flatnonzero(~allowed[data])
+    if not len(bad):
+        return []
+    owner = np.searchsorted(starts, bad, side="right") - 1
+    keep = lines[owner]
+    bad, owner = bad[keep], owner[keep]
+    owner, first = np.unique(owner, return_index=True)
+    return zip(owner.tolist(), bad[first].tolist())
+
+
+def _fasta_chunk(raw, data, starts, ends, first_line, problems):
+    lengths = ends - starts
+    nonempty = lengths > 0
+    header = nonempty & (data[starts] == ord(">"))
+    for line, pos in _first_bad(raw, data, starts, ends, _RESIDUES, nonempty & ~header):
+        problems.append(Problem(first_line + line, pos - int(starts[line]), "Invalid residue {!r}".format(chr(data[pos])), 1))
+    for line in np.flatnonzero(header & (lengths == 1)).tolist():
+        problems.append(Problem(first_line + line, 0, "Record without a name"))
+
+    lines = np.flatnonzero(nonempty)
+    kinds = header[lines]
+    for i in np.flatnonzero(kinds[:-1] & kinds[1:]).tolist():
+        problems.append(Problem(first_line + int(lines[i]), 0, "Record without a sequence"))
+    lead = first_header = open_header = None
+    if len(lines):
+        first_header = bool(kinds[0])
+        if not first_header:
+            lead = first_line + int(lines[0])
+        if kinds[-1]:
+            open_header = first_line + int(lines[-1])
+    return int(np.count_nonzero(header)), lead, first_header, open_header
+
+
+def _fastq_chunk(raw, data, starts, ends, first_line, problems):
+    lengths = ends - starts
+    kind = np.arange(len(starts)) % 4
+    marks = data[starts]
+    for line in np.flatnonzero((kind == 0) & ((lengths == 0) | (marks != ord("@")))).tolist():
+        problems.append(Problem(first_line + line, 0, "Expected a record header starting with '@'"))
+    for line in np.flatnonzero((kind == 2) & ((lengths == 0) | (marks != ord("+")))).tolist():
+        problems.append(Problem(first_line + line, 0, "Expected a '+' separator line"))
+    for line, pos in _first_bad(raw, data, starts, ends, _RESIDUES, kind == 1):
+        problems.append(Problem(first_line + line, pos - int(starts[line]), "Invalid residue {!r}".format(chr(data[pos])), 1))
+    for line, pos in _first_bad(raw, data, starts, ends, _QUALITY, kind == 3):
+        problems.append(Problem(first_line + line, pos - int(starts[line]),
+                                "Invalid quality character {!r}".format(chr(data[pos])), 1))
+
+    records = len(starts) // 4
+    sequence, quality = lengths[1:records * 4:4], lengths[3:records * 4:4]
+    for record in np.flatnonzero(sequence != quality).tolist():
+        problems.append(Problem(first_line + 4 * record + 3, int(min(sequence[record], quality[record])),
+                                "Quality is {} long, the sequence {}".format(quality[record], sequence[record])))
+    if len(starts) % 4:
+        problems.append(Problem(first_line + records * 4, 0, "Incomplete record"))
+
+
+def _id_hashes(data, starts, lengths):
+    """
+    64-bit polynomial hashes of the IDs of header lines, the text after the
+    marker up to the first space or tab, and which of the lines have one.
+    """
+    lengths = lengths - 1
+    owner = np.repeat(np.arange(len(starts)), lengths)
+    positions = np.arange(int(lengths.sum()), dtype=np.int64) - (np.cumsum(lengths) - lengths)[owner]
+    text = data[starts[owner] + 1 + positions]
+    ends = lengths.copy()
+    blank = np.flatnonzero((text == 32) | (text == 9))
+    blank_owner, first = np.unique(owner[blank], return_index=True)
+    ends[blank_owner] = positions[blank[first]]
+    inside = positions < ends[owner]
+    terms = text[inside].astype(np.uint64) * _hash_powers(int(ends.max()) if len(ends) else 0)[positions[inside]]
+    named = ends > 0
+    if not len(terms):
+        return np.zeros(0, dtype=np.uint64), named
+    return np.add.reduceat(terms, (np.cumsum(ends) - ends)[named]), named
+
+
+def check_chunk(data, file_format, first_line):
+    """
+    Problems of a chunk of whole lines of a FASTA or FASTQ file starting at
+    first_line, a multiple of 4 for FASTQ.
+    """
+    raw = bytes(data)
+    data = np.frombuffer(raw, dtype=np.uint8)
+    starts, ends = line_bounds(data)
+    lengths = ends - starts
+    problems = []
+    headers, lead, first_header, open_header = 0, None, None, None
+    header = (lengths > 1) & (data[starts] == ord("@" if file_format == FASTQ else ">"))
+    if file_format == FASTQ:
+        _fastq_chunk(raw, data, starts, ends, first_line, problems)
+        header &= np.arange(len(starts)) % 4 == 0
+    else:
+        headers, lead, first_header, open_header = _fasta_chunk(raw, data, starts, ends, first_line, problems)
+    header = np.flatnonzero(header)
+    ids, named = _id_hashes(data, starts[header], lengths[header])
+    problems.sort()
+    return Partial(problems[:MAX_PROBLEMS], len(problems), headers, lead, first_header, open_header,
+                   ids, header[named] + first_line)
+
+
+def _check_source(source, file_format, first_line):
+    return check_chunk(read_source(source), file_format, first_line)
+
+
+def record_id(header):
+    """ID of a FASTA or FASTQ header line, without the marker."""
+    fields = header[1:].split(None, 1)
+    return fields[0] if fields else ""
+
+
+def _duplicates(ids, lines, id_of, max_problems):
+    """
+    Problems of the headers with the ID of an earlier one, in line order,
+    with their count. Equal hashes are told apart from collisions by the
+    IDs given by id_of(line) for the problems kept.
+    """
+    order = np.argsort(ids, kind="stable")
+    ids, lines = ids[order], lines[order]
+    same = ids[1:] == ids[:-1]
+    # First line of the group of equal hashes of every header
+    group = np.maximum.accumulate(np.where(np.concatenate(([True], ~same)), np.arange(len(ids)), 0))
+    repeated = np.flatnonzero(same) + 1
+    repeated = repeated[np.argsort(lines[repeated], kind="stable")]
+    problems = []
+    count = len(repeated)
+    for i in repeated.tolist():
+        if max_problems is not None and len(problems) >= max_problems:
+            break
+        line, first = int(lines[i]), int(lines[group[i]])
+        name = id_of(line)
+        if name != id_of(first):
+            count -= 1
+            continue
+        problems.append(Problem(line, 1, "Duplicate ID {!r}, first on line {}".format(name, first + 1), len(name)))
+    return problems, count
+
+
+def merge(partials, max_problems=None, id_of=None):
+    """
+    Report of a document from the problems of its chunks, in order. IDs are
+    checked for duplicates when id_of(line) gives the ID of a header line.
+    """
+    problems = []
+    count = 0
+    seen_header = False
+    pending = None
+    ids, id_lines = [], []
+
+    def add(problem):
+        nonlocal count
+        count += 1
+        if max_problems is None or len(problems) < max_problems:
+            problems.append(problem)
+
+    for p in partials:
+        if not seen_header and p.lead is not None:
+            add(Problem(p.lead, 0, "Sequence data before the first header"))
+        if pending is not None and p.first_header is not None:
+            if p.first_header:
+                add(Problem(pending, 0, "Record without a sequence"))
+            pending = None
+        for problem in p.problems:
+            add(problem)
+        count += p.count - len(p.problems)
+        seen_header = seen_header or p.headers > 0
+        if p.open is not None:
+            pending = p.open
+        ids.append(p.ids)
+        id_lines.append(p.id_lines)
+    if pending is not None:
+        add(Problem(pending, 0, "Record without a sequence"))
+    if id_of is not None and ids:
+        duplicates, duplicate_count = _duplicates(np.concatenate(ids), np.concatenate(id_lines), id_of, max_problems)
+        problems.extend(duplicates)
+        count += duplicate_count
+    problems.sort()
+    return Report(problems[:max_problems], count)
+
+
+def _last_line(document):
+    """Number of lines up to the last one that is not blank."""
+    stop = len(document)
+    while stop and not document.line(stop - 1).strip():
+        stop -= 1
+    return stop
+
+
+def _check_alignment(document, file_format):
+    problems = []
+    if file_format == PHYLIP:
+        layout = phylip_layout(document)
+        if not layout.valid:
+            return [Problem(layout.error_line or 0, 0, layout.error)]
+    try:
+        matrix = matrix_lines(document, file_format)
+    except ValueError as e:
+        return [Problem(0, 0, str(e))]
+    header = matrix.header or 0
+    if matrix.ntax is not None and matrix.ntax != len(matrix.taxa):
+        problems.append(Problem(header, 0, "NTAX is {}, the matrix has {} taxa".format(matrix.ntax, len(matrix.taxa))))
+    first_lines = {}
+    for taxon, lines in enumerate(matrix.taxa):
+        sites = 0
+        name = matrix.names[taxon] if matrix.names is not None else None
+        for line, named in lines:
+            text = document.line(line)
+            given, sequence = matrix.split(text, named)
+            name = given if given is not None else name
+            # Interleaved blocks repeat the names on purpose
+            if named and (not matrix.interleaved or line == lines[0][0]):
+                if name in first_lines:
+                    problems.append(Problem(line, 0, "Duplicate taxon {!r}, first on line {}".format(
+                        name, first_lines[name] + 1)))
+                else:
+                    first_lines[name] = line
+            m = _ALIGNMENT_INVALID.search(sequence)
+            if m:
+                column = text.find(sequence) + m.start()
+                problems.append(Problem(line, column, "Invalid character {!r}".format(m.group()), 1))
+            sites += len("".join(sequence.split()))
+        if matrix.nchar is not None and sites != matrix.nchar:
+            problems.append(Problem(lines[0][0] if lines else header, 0,
+                                    "{} has {} sites, NCHAR is {}".format(name, sites, matrix.nchar)))
+    problems.sort()
+    return problems
+
+
+@timed("validate")
+def validate(document, file_format, max_problems=None, progress=None):
+    """
+    Check a document against its format, returns a Report. FASTA and FASTQ
+    files are cut into chunks checked in worker processes: record structure,
+    residue and quality characters, FASTQ sequence and quality lengths, and
+    duplicate record IDs. Alignments are checked for their declared number
+    of taxa and sites, duplicate taxa and invalid characters.
+    """
+    if file_format in (NEXUS, PHYLIP):
+        problems = _check_alignment(document, file_format)
+        return Report(problems[:max_problems], len(problems))
+    if file_format not in (FASTA, FASTQ):
+        raise ValueError("Cannot validate {} files".format(file_format or "these"))
+    # Blank lines at the end of a FASTQ file are not an incomplete record
+    stop = _last_line(document) if file_format == FASTQ else len(document)
+    chunks = line_chunks(document, stop, 4 if file_format == FASTQ else 1)
+    tasks = ((chunk_source(document, start, end), file_format, start) for start, end in chunks)
+    partials = ordered_map(_check_source, tasks, len(chunks), progress)
+    return merge(partials, max_problems, lambda line: record_id(document.line(line)))
@@ -0,0 +1,123 @@
+from PyQt5.Qsci import QsciScintilla, QsciLexerCustom
+
+from document import split_lines
+from instrument import span
+
+# Lines decoded ahead above and below the window
+MARGIN_LINES = 256
+
+
+class Viewport:
+    """
+    Keeps the editor showing a window of document lines.
+
+    When the window moves by less than its height the lines that scrolled out
+    are deleted at one edge and the new ones inserted at the other, so
+    Scintilla keeps its buffer and the styles of the lines still in view and
+    the lexer only sees the new lines. Lines around the window are decoded a
+    margin at a time, so most scroll steps do not touch the document.
+    """
+
+    def __init__(self, editor, margin=MARGIN_LINES):
+        self.editor = editor
+        self.margin = margin
+        self.document = None
+        # Document lines [start, stop) are in the editor, as of document version
+        self.start = 0
+        self.stop = 0
+        self.version = None
+        self._cache = []
+        self._cache_start = 0
+        self._cache_key = None
+
+    def _lines(self, start, stop):
+        """Document lines [start, stop), from the decoded margin where possible."""
+        document = self.document
+        key = (document, document.version, len(document))
+        if key != self._cache_key or start < self._cache_start or stop > self._cache_start + len(self._cache):
+            self._cache_start = max(0, start - self.margin)
+            self._cache = split_lines(document.text(self._cache_start, stop + self.margin))
+            self._cache_key = key
+        return self._cache[start - self._cache_start:stop - self._cache_start]
+
+    def _text(self, start, stop):
+        return "".join(self._lines(start, stop))
+
+    def send(self, *args):
+        return self.editor.SendScintilla(*args)
+
+    def show(self, document, start, stop):
+        """Show document lines [start, stop) in the editor."""
+        with span("viewport.show", start=start) as s:
+            s.set(mode=self._show(document, start, stop))
+
+    def _show(self, document, start, stop):
+        stop = max(start, min(stop, len(document)))
+        in_sync = document is self.document and document.version == self.version
+        self.document = document
+        self.version = document.version
+        if in_sync and (start, stop) == (self.start, self.stop):
+            return "unchanged"
+        if not in_sync or stop <= self.start or start >= self.stop or self.start == self.stop:
+            self.start, self.stop = start, stop
+            self.editor.setText(self._text(start, stop))
+            return "full"
+
+        custom = isinstance(self.editor.lexer(), QsciLexerCustom)
+        end_styled = self.send(QsciScintilla.SCI_GETENDSTYLED)
+        # Moving the window is not an edit the user can undo
+        self.send(QsciScintilla.SCI_SETUNDOCOLLECTION, False)
+        if stop < self.stop:
+            pos = self.send(QsciScintilla.SCI_POSITIONFROMLINE, stop - self.start)
+            self.send(QsciScintilla.SCI_DELETERANGE, pos, self.editor.length() - pos)
+            end_styled = min(end_styled, pos)
+        if start > self.start:
+            pos = self.send(QsciScintilla.SCI_POSITIONFROMLINE, start - self.start)
+            self.send(QsciScintilla.SCI_DELETERANGE, 0, pos)
+            end_styled = max(0, end_styled - pos)
+        if stop > self.stop:
+            self.editor.append(self._text(self.stop, stop))
+            kept = self.stop - max(start, self.start)
+            self._clear_line_states(kept, kept + stop - self.stop + 1)
+        inserted = 0
+        if start < self.start:
+            before = self.editor.length()
+            self.editor.insertAt(self._text(start, self.start), 0, 0)
+            inserted = self.editor.length() - before
+            self._clear_line_states(0, self.start - start)
+        self.send(QsciScintilla.SCI_SETUNDOCOLLECTION, True)
+        self.send(QsciScintilla.SCI_EMPTYUNDOBUFFER)
+        self.send(QsciScintilla.SCI_SETFIRSTVISIBLELINE, 0)
+
+        if custom:
+            # The lines kept have their styles already, only style the ones inserted above
+            lexer = self.editor.lexer()
+            if inserted:
+                lexer.styleText(0, inserted)
+            lexer.startStyling(max(end_styled + inserted, self.send(QsciScintilla.SCI_GETENDSTYLED)))
+        self.start, self.stop = start, stop
+        return "delta"
+
+    def _clear_line_states(self, first, last):
+        # New lines copy the state of the line they were inserted at, which
+        # would make a stateful lexer take them for lines already styled
+        for line in range(first, last):
+            self.send(QsciScintilla.SCI_SETLINESTATE, line, 0)
+
+    def synced(self, stop):
+        """
+        The editor text was written into the document as lines [start, stop),
+        so it is the document again and the next move can be a delta.
+        """
+        text = self.editor.text()
+        if stop < len(self.document) and text and not text.endswith("\n"):
+            # The document added a newline the editor does not have
+            self.version = None
+            return
+        self.stop = stop
+        self.version = self.document.version
+
+    def reset(self):
+        self.document = None
+        self._cache = []
+        self._cache_key = None
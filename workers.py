@@ -0,0 +1,113 @@
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from document import ORIGINAL
+
+# Bytes of the file per chunk handed to a worker process
+CHUNK_BYTES = 1 << 24
+# Lines per chunk where the document has been edited
+LINES_PER_CHUNK = 1 << 16
+
+_pool = None
+
+
+def executor():
+    """The pool of worker processes shared by the chunked scans of documents."""
+    # Workers are spawned rather than forked from the editor and its running threads
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=os.cpu_count() or 1,
+                                    mp_context=multiprocessing.get_context("spawn"))
+    return _pool
+
+
+def shutdown():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(cancel_futures=True)
+        _pool = None
+
+
+def line_chunks(document, stop=None, record_lines=1):
+    """
+    Lines [start, stop) of the chunks of the first stop lines. Unedited
+    lines are cut on a grid of the file bytes, edited ones every
+    LINES_PER_CHUNK lines, and chunks start on a multiple of record_lines.
+    """
+    stop = len(document) if stop is None else stop
+    offsets = document.line_offsets()
+    cuts = {0}
+    line = 0
+    for source, first, count in document.iter_pieces(0, stop):
+        if source == ORIGINAL:
+            begin, end = document.line_range(first, first + count)
+            grid = np.arange((begin // CHUNK_BYTES + 1) * CHUNK_BYTES, end, CHUNK_BYTES)
+            cuts.update((np.searchsorted(offsets, grid) - first + line).tolist())
+        else:
+            cuts.update(range(line, line + count, LINES_PER_CHUNK))
+        cuts.add(line)
+        line += count
+    cuts = sorted({cut - cut % record_lines for cut in cuts if 0 <= cut < stop}) + [stop]
+    return list(zip(cuts, cuts[1:])) if stop else []
+
+
+def chunk_source(document, start, stop):
+    """
+    Lines [start, stop) for a worker: (path, begin, end) of the file when
+    they are unedited lines of an uncompressed file, their bytes otherwise.
+    """
+    pieces = list(document.iter_pieces(start, stop))
+    if len(pieces) == 1 and pieces[0][0] == ORIGINAL:
+        _, first, count = pieces[0]
+        begin, end = document.line_range(first, first + count)
+        if not document.compressed:
+            return document.path, begin, end
+        return document.raw(begin, end)
+    return document.text(start, stop).encode(document.encoding)
+
+
+def read_source(source):
+    """Bytes of a chunk_source()."""
+    if isinstance(source, tuple):
+        path, begin, end = source
+        with open(path, "rb") as f:
+            return os.pread(f.fileno(), end - begin, begin)
+    return source
+
+
+def ordered_map(function, arguments, count, progress=None):
+    """
+    Yield function(*args) for each of the count tuples of arguments, in
+    order, computed in the worker processes a bounded number at a time so
+    that the data sent to them stays within a few chunks. A single call
+    runs in place, sparing the start of the workers.
+    """
+    arguments = iter(arguments)
+    if count == 1:
+        yield function(*next(arguments))
+        return
+    pool = executor()
+    ahead = 2 * (os.cpu_count() or 1)
+    pending = deque()
+    done = 0
+    try:
+        for args in arguments:
+            pending.append(pool.submit(function, *args))
+            if len(pending) < ahead:
+                continue
+            yield pending.popleft().result()
+            done += 1
+            if progress is not None:
+                progress(done / count)
+        while pending:
+            yield pending.popleft().result()
+            done += 1
+            if progress is not None:
+                progress(done / count)
+    finally:
+        for future in pending:
+            future.cancel()